@@ -0,0 +1,6 @@
+"""__init__.py
+
+pytodo-qt: A to-do list program written in Python using PyQt6.
+"""
+
+__version__ = "0.2.8"
@@ -24,23 +24,12 @@ import argparse
 import os
 import sys
 
-from PyQt6.QtWidgets import QApplication
+from . import __version__
+from .net.SingleInstance import InstanceServer, forward
 
-from .core.Logger import Logger
-from .core import settings
-from .core.TodoDatabase import TodoDatabase
-from .gui.MainWindow import MainWindow
 
-
-logger = Logger(__name__)
-
-
-# Main function
-def main():
-    # move to main module dir
-    os.chdir(os.path.dirname(__file__))
-
-    # create a command line arg_parser
+def make_arg_parser():
+    """Create the command line argument parser."""
     arg_parser = argparse.ArgumentParser(
         prog="pytodo-qt",
         description="To-Do List Application written in Python 3 and PyQt6",
@@ -90,17 +79,92 @@ def main():
     )
 
     arg_parser.add_argument(
-        "-V", "--version", action="version", version=f"%(prog)s v{settings.__version__}"
+        "-m",
+        "--collect-metrics",
+        action="store",
+        type=str,
+        choices=["yes", "no"],
+        dest="collect",
+        help="collect performance metrics, see Help -> Performance",
     )
 
-    # parse args then convert to dict format
-    args = arg_parser.parse_args()
+    arg_parser.add_argument(
+        "-V", "--version", action="version", version=f"%(prog)s v{__version__}"
+    )
+
+    return arg_parser
+
+
+# command line arguments, by destination, and the options they set
+ARG_OPTIONS = {
+    "run_server": "run",
+    "allow_pull": "pull",
+    "allow_push": "push",
+    "ip": "address",
+    "port": "port",
+    "collect": "collect",
+}
+
+
+def set_options(args):
+    """Copy the command line arguments given into the options."""
+    from .core import settings
+
     for k, v in vars(args).items():
-        if v is not None:
-            settings.options[k] = v
+        if v is None:
+            continue
+        if v in ("yes", "no"):
+            v = v == "yes"
+        settings.options[ARG_OPTIONS.get(k, k)] = v
+
+
+def forwarded(argv, window):
+    """Apply the arguments of a later launch and show the running window."""
+    from .core import metrics, settings
+
+    args = make_arg_parser().parse_args(argv)
+    set_options(args)
+    if args.collect is not None:
+        metrics.enable(settings.options["collect"])
+    moved = args.ip is not None or args.port is not None
+    if args.run_server is not None or moved:
+        if not settings.options["run"]:
+            if settings.DB.server_running():
+                settings.DB.stop_server()
+        elif moved:
+            settings.DB.restart_server()
+        else:
+            settings.DB.start_server()
+    window.update_status_bar()
+    window.raise_window()
+
+
+# Main function
+def main():
+    # move to main module dir
+    os.chdir(os.path.dirname(__file__))
+
+    # parse args, then hand them to an instance already running, if any,
+    # before anything reads the database or opens the log
+    argv = sys.argv[1:]
+    args = make_arg_parser().parse_args(argv)
+    if forward(argv):
+        sys.exit(0)
+
+    from PyQt6.QtWidgets import QApplication
+
+    from .core import settings
+    from .core.TodoDatabase import TodoDatabase
+    from .gui.MainWindow import MainWindow
+
+    set_options(args)
 
     # create a QApplication, the main window, DB, then hand over control to Qt
     app = QApplication(sys.argv)
+    instance = InstanceServer()
+    if not instance.listen(argv):
+        sys.exit(0)
     settings.DB = TodoDatabase()
-    _ = MainWindow()
+    window = MainWindow()
+    instance.received.connect(lambda later: forwarded(later, window))
     sys.exit(app.exec())
@@ -0,0 +1,220 @@
+"""Archive.py
+
+Cold storage for completed to-dos.
+
+Completed to-dos that have not changed for archive_after days are moved
+out of the lists into an archive file, so the lists that are sorted,
+counted, saved and synced all the time only hold the to-dos still in
+use. Archiving is a delete as far as the lists and peers are concerned,
+the archive itself stays on this machine, it is neither loaded at start
+up nor synced.
+
+The archive is an append-only RecordLog. A record either adds archived
+to-dos or marks some as restored. The archive is only read when it is
+first searched, it is then indexed by a SearchIndex kept current as
+records are appended.
+"""
+
+import threading
+import time
+
+from ..core import settings, timed
+from ..core.Logger import Logger
+from ..core.RecordLog import RecordLog, RecordLogError
+from ..core.SearchIndex import SearchIndex
+from ..core.Transaction import TransactionError
+
+
+logger = Logger(__name__)
+
+
+# record tags, to-dos archived or restored
+ARCHIVED = b"a"
+RESTORED = b"r"
+
+# default age in days of completed to-dos to archive, 0 never archives
+ARCHIVE_AFTER = 30
+
+
+class ArchiveError(RecordLogError):
+    """The archive file can not be read."""
+
+
+class Archive:
+    """Append-only store of archived to-dos, indexed on first use."""
+
+    def __init__(self, db, fn=settings.archive_fn):
+        """Create an archive of db's to-dos in fn, nothing is read yet."""
+        self.db = db
+        self.log = RecordLog(fn, db)
+        self.lock = threading.Lock()
+        # id -> (list name, to-do) of every archived to-do not restored,
+        # None until the archive is first read
+        self.entries = None
+        self.index = SearchIndex()
+
+    @property
+    def fn(self):
+        """Return the archive file name."""
+        return self.log.fn
+
+    def __len__(self):
+        """Return the number of archived to-dos, reading them if need be."""
+        with self.lock:
+            self._load()
+            return len(self.entries)
+
+    # reading
+
+    def _load(self):
+        """Read and index the archive file once, self.lock must be held."""
+        if self.entries is not None:
+            return
+        entries = {}
+        for record in self._records():
+            self._replay(entries, record)
+        self.entries = entries
+        self.index.rebuild({})
+        for list_name, todo in entries.values():
+            self.index.add(list_name, todo)
+        logger.log.info("Loaded %d archived to-dos from %s", len(entries), self.fn)
+
+    @timed("archive.read")
+    def _records(self):
+        """Return every complete record of the archive file."""
+        try:
+            return [doc for _, _, _, doc in self.log.records()]
+        except RecordLogError as e:
+            raise ArchiveError(str(e)) from e
+
+    def _replay(self, entries, record):
+        """Apply one record to entries."""
+        for list_name, todo in record.get("archived", []):
+            entries[todo["id"]] = (list_name, todo)
+        for todo_id in record.get("restored", []):
+            entries.pop(todo_id, None)
+
+    # writing
+
+    @timed("archive.append")
+    def _append(self, record):
+        """Append a record to the file and the loaded entries, if any.
+
+        The record is on disk before this returns, self.lock must be held.
+        """
+        tag = ARCHIVED if "archived" in record else RESTORED
+        self.log.append(tag, record["time"], record, sync=True)
+
+        if self.entries is not None:
+            self._replay(self.entries, record)
+            for list_name, todo in record.get("archived", []):
+                self.index.add(list_name, todo)
+            for todo_id in record.get("restored", []):
+                self.index.discard(todo_id)
+
+    def candidates(self, max_age, now=None):
+        """Return (list name, to-do) of completed to-dos older than max_age seconds."""
+        cutoff = (time.time() if now is None else now) - max_age
+        found = []
+        for list_name, todos in self.db.snapshot().lists.items():
+            for todo in todos:
+                # to-dos from before time stamps were kept have no age
+                modified = todo.get("modified")
+                if todo["complete"] and modified is not None and modified < cutoff:
+                    found.append((list_name, dict(todo)))
+        return found
+
+    def archive(self, days, now=None):
+        """Move completed to-dos unchanged for days into the archive.
+
+        They are appended to the archive before they are deleted from the
+        lists, in one transaction, so a to-do is never only in memory.
+        Returns (bool, msg).
+        """
+        if days <= 0:
+            return True, "Archiving is turned off"
+        if self.db.file_cipher is None and settings.options.get("encrypt"):
+            return False, "Not archiving, the database is encrypted and locked"
+        found = self.candidates(days * 24 * 3600, now)
+        if not found:
+            return True, "No completed to-dos to archive"
+
+        with self.lock:
+            try:
+                self._append({"time": time.time(), "archived": found})
+            except OSError as e:
+                msg = f"Unable to write the archive {self.fn}: {e}"
+                logger.log.exception(msg)
+                return False, msg
+        try:
+            with self.db.transaction(origin="archive") as txn:
+                for list_name, todo in found:
+                    txn.delete_todo(list_name, todo["id"])
+        except TransactionError as e:
+            # edited meanwhile, take them back out of the archive
+            msg = f"Not archiving completed to-dos: {e}"
+            logger.log.warning(msg)
+            with self.lock:
+                self._append(
+                    {"time": time.time(), "restored": [t["id"] for _, t in found]}
+                )
+            return False, msg
+
+        msg = f"Archived {len(found)} completed to-dos"
+        logger.log.info(msg)
+        return True, msg
+
+    # searching and restoring
+
+    def search(self, text="", limit=None):
+        """Search archived to-dos, see SearchIndex.search.
+
+        The archive is read the first time, raises ArchiveError if it can
+        not be.
+        """
+        with self.lock:
+            self._load()
+        return self.index.search(text, limit=limit)
+
+    def restore(self, todo_ids):
+        """Put archived to-dos back into their lists, recreating lists as needed.
+
+        Returns (bool, msg).
+        """
+        with self.lock:
+            try:
+                self._load()
+            except ArchiveError as e:
+                return False, str(e)
+            todos = [self.entries[i] for i in todo_ids if i in self.entries]
+        # a to-do back in the lists already, by an undo or from a peer
+        live = {t["id"] for lst in self.db.snapshot().lists.values() for t in lst}
+        todos = [(name, todo) for name, todo in todos if todo["id"] not in live]
+        if not todos:
+            return False, "No archived to-dos to restore"
+
+        try:
+            with self.db.transaction(origin="archive") as txn:
+                lists = set(self.db.todo_lists)
+                for list_name, todo in todos:
+                    if list_name not in lists:
+                        txn.add_list(list_name)
+                        lists.add(list_name)
+                    txn.add_todo(list_name, todo)
+        except TransactionError as e:
+            msg = f"Unable to restore to-dos: {e}"
+            logger.log.warning(msg)
+            return False, msg
+
+        with self.lock:
+            try:
+                self._append(
+                    {"time": time.time(), "restored": [t["id"] for _, t in todos]}
+                )
+            except OSError as e:
+                # restored twice at worst, the ids are the same
+                logger.log.exception("Unable to write the archive %s: %s", self.fn, e)
+
+        msg = f"Restored {len(todos)} to-dos"
+        logger.log.info(msg)
+        return True, msg
@@ -0,0 +1,389 @@
+"""History.py
+
+An audit log of every change to the to-do lists, with time travel.
+
+Each committed transaction, made here or merged from a peer, becomes one
+entry in an append-only RecordLog: its time, its origin ("local" or the
+peer it came from) and its operations. Now and then a checkpoint, a copy
+of every list, is written after an entry, so the lists as they were at
+any time are rebuilt from the last checkpoint before it and the entries
+following it, not from the start of the history.
+
+    ["L+", name]          list created
+    ["L-", name]          list deleted, with the to-dos still in it
+    ["+", list, to-do]    to-do added
+    ["~", list, to-do]    to-do changed or moved to list
+    ["-", list, id]       to-do deleted
+
+The history records what the lists hold, not their order. Entries are
+gathered while a transaction commits, under the write lock, and written
+once it is done, so commits never wait on the disk. Compaction keeps the
+history within history_days and history_max_size: everything before the
+cutoff is folded into one checkpoint and the rest is copied as it is.
+"""
+
+import bisect
+import threading
+import time
+
+from ..core import settings, timed
+from ..core.Logger import Logger
+from ..core.RecordLog import RecordLog, RecordLogError
+from ..core.Transaction import TransactionError
+
+
+logger = Logger(__name__)
+
+
+# record tags, an entry or a checkpoint
+ENTRY = b"e"
+CHECKPOINT = b"c"
+
+# default days of history to keep, 0 keeps everything
+HISTORY_DAYS = 90
+
+# default largest size of the history in MiB, 0 has no limit
+HISTORY_MAX_SIZE = 16
+
+# entries written between checkpoints, in bytes, at least
+CHECKPOINT_BYTES = 256 * 1024
+
+# entry times are kept strictly increasing by at least this much
+TICK = 1e-6
+
+
+class HistoryError(RecordLogError):
+    """The history can not answer a query."""
+
+
+class History:
+    """Append-only history of the to-do lists, indexed on first use."""
+
+    def __init__(self, db, fn=settings.history_fn):
+        """Keep the history of db in fn, nothing is read yet."""
+        self.db = db
+        self.log = RecordLog(fn, db)
+        self.lock = threading.Lock()
+        # (time, tag, offset) of every record, None until the file is scanned
+        self.index = None
+        # (time, origin, ops, snapshot) gathered by apply and not yet written
+        self.pending = []
+        self.last_time = 0.0
+        # bytes of entries since the last checkpoint, and its size
+        self.since_checkpoint = 0
+        self.checkpoint_size = 0
+
+    # recording
+
+    def apply(self, change):
+        """Gather the operations of a committed Transaction.Change.
+
+        Called under the database write lock, the entry is written by the
+        next flush.
+        """
+        ops = [["L+", name] for name in sorted(change.lists_added)]
+        ops += [["-", name, todo_id] for todo_id, name in change.removed.items()]
+        ops += [["+", name, todo] for name, todo in change.added.values()]
+        ops += [["~", name, todo] for name, todo in change.updated.values()]
+        ops += [["L-", name] for name in sorted(change.lists_removed)]
+        if not ops:
+            return
+        with self.lock:
+            t = max(time.time(), self.last_time + TICK)
+            self.last_time = t
+            self.pending.append((t, change.origin, ops, self.db.snapshot()))
+
+    @timed("history.flush")
+    def flush(self):
+        """Write the entries gathered since the last flush."""
+        with self.lock:
+            pending, self.pending = self.pending, []
+            if not pending:
+                return
+            if self.db.file_cipher is None and settings.options.get("encrypt"):
+                logger.log.warning("Not writing history, the database is locked")
+                return
+            try:
+                self._load()
+                for t, origin, ops, snapshot in pending:
+                    self._write(t, origin, ops, snapshot)
+            except (OSError, RecordLogError) as e:
+                logger.log.exception("Unable to write history %s: %s", self.log.fn, e)
+
+    def _write(self, t, origin, ops, snapshot):
+        """Append one entry, and a checkpoint when one is due."""
+        if not self.index:
+            # the history starts with the lists as they are
+            self._checkpoint(t, snapshot)
+            return
+        if origin == "disk":
+            # the lists read back at start up, already in the history
+            return
+        offset = self.log.append(ENTRY, t, {"origin": origin, "ops": ops})
+        self.index.append((t, ENTRY, offset))
+        self.since_checkpoint += self.log.size() - offset
+        if self.since_checkpoint >= max(CHECKPOINT_BYTES, self.checkpoint_size):
+            self._checkpoint(t, snapshot)
+
+    def _checkpoint(self, t, snapshot):
+        """Append a copy of every list of snapshot, taken at time t."""
+        offset = self.log.append(CHECKPOINT, t, snapshot.to_dict())
+        self.index.append((t, CHECKPOINT, offset))
+        self.since_checkpoint = 0
+        self.checkpoint_size = self.log.size() - offset
+
+    # reading
+
+    def _load(self):
+        """Scan the record headers once, self.lock must be held."""
+        if self.index is not None:
+            return
+        self.index = [(t, tag, offset) for offset, tag, t in self.log.scan()]
+        if self.index:
+            self.last_time = max(self.last_time, self.index[-1][0])
+        self._count_since_checkpoint()
+
+    def _count_since_checkpoint(self):
+        """Measure the last checkpoint and the entries after it."""
+        self.since_checkpoint = self.checkpoint_size = 0
+        for i in range(len(self.index) - 1, -1, -1):
+            if self.index[i][1] == CHECKPOINT:
+                end = self.index[i + 1][2] if i + 1 < len(self.index) else None
+                end = self.log.size() if end is None else end
+                self.checkpoint_size = end - self.index[i][2]
+                self.since_checkpoint = self.log.size() - end
+                break
+
+    def _start(self):
+        """Flush, then return the index, self.lock must not be held."""
+        self.flush()
+        with self.lock:
+            self._load()
+            if not self.index:
+                raise HistoryError("There is no history yet")
+            return list(self.index)
+
+    def _replay(self, index, times):
+        """Yield the lists as they were at each of the sorted times.
+
+        Replays from the last checkpoint before the first time, lists
+        are dictionaries of to-do id to to-do.
+        """
+        keys = [t for t, _, _ in index]
+        first = bisect.bisect_right(keys, times[0])
+        start = None
+        for i in range(first - 1, -1, -1):
+            if index[i][1] == CHECKPOINT:
+                start = i
+                break
+        if start is None:
+            raise HistoryError(f"There is no history before {time.ctime(index[0][0])}")
+
+        state, where = {}, {}
+        _, _, doc = self.log.read(index[start][2])
+        for name, todos in doc.items():
+            state[name] = {todo["id"]: todo for todo in todos}
+            where.update((todo["id"], name) for todo in todos)
+
+        position = start + 1
+        for t in times:
+            end = bisect.bisect_right(keys, t)
+            for _, tag, offset in index[position:end]:
+                if tag == ENTRY:
+                    _, _, entry = self.log.read(offset)
+                    replay_ops(state, where, entry["ops"])
+            position = max(position, end)
+            yield {name: dict(todos) for name, todos in state.items()}
+
+    @timed("history.as_of")
+    def as_of(self, t):
+        """Return the lists as they were at time t, name -> list of to-dos.
+
+        Raises HistoryError when the history does not reach back to t.
+        """
+        index = self._start()
+        (state,) = self._replay(index, [t])
+        return {name: list(todos.values()) for name, todos in state.items()}
+
+    @timed("history.diff")
+    def diff(self, t1, t2):
+        """Compare the lists at time t1 with the lists at the later time t2.
+
+        Returns a dictionary of lists_added and lists_removed, list names,
+        added and removed, (list name, to-do) pairs, and changed, (list
+        name, to-do at t1, to-do at t2) triples.
+        """
+        if t2 < t1:
+            t1, t2 = t2, t1
+        index = self._start()
+        before, after = self._replay(index, [t1, t2])
+
+        old = {
+            i: (name, todo)
+            for name, todos in before.items()
+            for i, todo in todos.items()
+        }
+        new = {
+            i: (name, todo)
+            for name, todos in after.items()
+            for i, todo in todos.items()
+        }
+        result = {
+            "lists_added": sorted(after.keys() - before.keys()),
+            "lists_removed": sorted(before.keys() - after.keys()),
+            "added": [new[i] for i in new.keys() - old.keys()],
+            "removed": [old[i] for i in old.keys() - new.keys()],
+            "changed": [],
+        }
+        for i in new.keys() & old.keys():
+            if new[i] != old[i]:
+                result["changed"].append((new[i][0], old[i][1], new[i][1]))
+        return result
+
+    def entries(self, since=None, until=None, limit=None):
+        """Return the newest entries, (time, origin, ops), newest first."""
+        index = self._start()
+        found = []
+        for t, tag, offset in reversed(index):
+            if until is not None and t > until:
+                continue
+            if since is not None and t < since:
+                break
+            if limit is not None and len(found) >= limit:
+                break
+            if tag == ENTRY:
+                _, _, entry = self.log.read(offset)
+                found.append((t, entry["origin"], entry["ops"]))
+        return found
+
+    def deleted_lists(self):
+        """Return (list name, time deleted) of lists deleted and not recreated."""
+        index = self._start()
+        deleted = {}
+        for t, tag, offset in index:
+            if tag != ENTRY:
+                continue
+            _, _, entry = self.log.read(offset)
+            for op in entry["ops"]:
+                if op[0] == "L-":
+                    deleted[op[1]] = t
+                elif op[0] == "L+":
+                    deleted.pop(op[1], None)
+        live = self.db.snapshot().lists
+        return sorted(
+            ((name, t) for name, t in deleted.items() if name not in live),
+            key=lambda item: item[1],
+            reverse=True,
+        )
+
+    # restoring
+
+    def restore_list(self, list_name, t):
+        """Put list_name back as it was at time t, in one transaction.
+
+        A to-do still in some list is left where it is. Returns (bool, msg).
+        """
+        try:
+            todos = self.as_of(t).get(list_name)
+        except HistoryError as e:
+            return False, str(e)
+        if todos is None:
+            return False, f"There was no list {list_name} at {time.ctime(t)}"
+
+        live = {todo["id"] for lst in self.db.snapshot().lists.values() for todo in lst}
+        todos = [todo for todo in todos if todo["id"] not in live]
+        try:
+            with self.db.transaction() as txn:
+                if list_name not in self.db.todo_lists:
+                    txn.add_list(list_name)
+                for todo in todos:
+                    txn.add_todo(list_name, todo)
+        except TransactionError as e:
+            msg = f"Unable to restore {list_name}: {e}"
+            logger.log.warning(msg)
+            return False, msg
+
+        msg = f"Restored {list_name} with {len(todos)} to-dos"
+        logger.log.info(msg)
+        return True, msg
+
+    # compaction
+
+    @timed("history.compact")
+    def compact(self, days, max_size, now=None):
+        """Fold history older than days into one checkpoint.
+
+        When the history is larger than max_size MiB, only the newest
+        half of that is kept. Returns (bool, msg).
+        """
+        if self.db.file_cipher is None and settings.options.get("encrypt"):
+            return False, "Not compacting history, the database is locked"
+        try:
+            index = self._start()
+        except HistoryError as e:
+            return True, str(e)
+
+        cutoff = None
+        if days > 0:
+            cutoff = (time.time() if now is None else now) - days * 24 * 3600
+        size = self.log.size()
+        if max_size > 0 and size > max_size * 2**20:
+            # keep the newest half of the allowed size
+            offsets = [offset for _, _, offset in index]
+            i = bisect.bisect_left(offsets, size - max_size * 2**19)
+            t = index[min(i, len(index) - 1)][0]
+            cutoff = t if cutoff is None else max(cutoff, t)
+        if cutoff is None:
+            return True, "History compaction is turned off"
+
+        keys = [t for t, _, _ in index]
+        keep = bisect.bisect_right(keys, cutoff)
+        if keep == 0 or keep == 1 and index[0][1] == CHECKPOINT:
+            return True, "Nothing in the history to compact"
+
+        try:
+            (state,) = self._replay(index, [keys[keep - 1]])
+            base = {name: list(todos.values()) for name, todos in state.items()}
+            with self.lock:
+                # entries flushed meanwhile are kept too
+                index = self.index
+                start = index[keep][2] if keep < len(index) else self.log.size()
+                _, kept = self.log.rewrite(
+                    [(CHECKPOINT, keys[keep - 1], base)], keep_from=start
+                )
+                self.index = [(keys[keep - 1], CHECKPOINT, 0)] + [
+                    (t, tag, offset + kept - start) for t, tag, offset in index[keep:]
+                ]
+                self._count_since_checkpoint()
+        except (OSError, RecordLogError) as e:
+            msg = f"Unable to compact history {self.log.fn}: {e}"
+            logger.log.exception(msg)
+            with self.lock:
+                self.index = None
+            return False, msg
+
+        msg = f"Compacted history from {size} to {self.log.size()} bytes"
+        logger.log.info(msg)
+        return True, msg
+
+
+def replay_ops(state, where, ops):
+    """Apply the operations of one entry to state, see the module docstring."""
+    for op in ops:
+        kind = op[0]
+        if kind == "L+":
+            state.setdefault(op[1], {})
+        elif kind == "L-":
+            for todo_id in state.pop(op[1], {}):
+                where.pop(todo_id, None)
+        elif kind == "-":
+            name = where.pop(op[2], None)
+            if name is not None:
+                state[name].pop(op[2], None)
+        else:
+            name, todo = op[1], op[2]
+            old = where.get(todo["id"])
+            if old is not None and old != name:
+                state[old].pop(todo["id"], None)
+            state.setdefault(name, {})[todo["id"]] = todo
+            where[todo["id"]] = name
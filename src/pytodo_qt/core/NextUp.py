@@ -0,0 +1,105 @@
+"""NextUp.py
+
+What to do next, across every list.
+
+Each list keeps the sort keys of its open to-dos in order, by priority,
+then due time, to-dos without one last, then reminder. The most urgent
+to-dos of all lists are read with a lazy k-way merge of those orders, so
+showing the first n of k lists costs O(n log k) whatever the lists hold,
+and nothing is concatenated or sorted to draw the view.
+
+The orders are kept current from the Change of every committed
+transaction: a changed to-do is bisected out of its list's order and put
+back where its new key belongs, a list loaded or rewritten wholesale is
+sorted once instead.
+"""
+
+import bisect
+import heapq
+import itertools
+import math
+import threading
+
+
+def order_key(todo):
+    """Sort key of an open to-do: priority, due time, reminder, id."""
+    due = todo.get("due")
+    return (
+        todo["priority"],
+        math.inf if due is None else due,
+        todo["reminder"].casefold(),
+        todo["id"],
+    )
+
+
+class NextUp:
+    """Per-list sorted orders of open to-dos, merged lazily on demand."""
+
+    def __init__(self):
+        """Create empty orders."""
+        self.lock = threading.Lock()
+        # list name -> sort keys of its open to-dos, in order
+        self.orders = {}
+        # id -> (list name, sort key) of every open to-do
+        self.keys = {}
+        # id -> open to-do
+        self.todos = {}
+
+    def __len__(self):
+        """Return the number of open to-dos across all lists."""
+        with self.lock:
+            return len(self.keys)
+
+    def apply(self, change):
+        """Bring the orders in step with a committed Transaction.Change."""
+        with self.lock:
+            drops = {}
+            adds = {}
+            for todo_id in change.removed:
+                self._forget(todo_id, drops)
+            for entries in (change.added, change.updated):
+                for todo_id, (name, todo) in entries.items():
+                    self._forget(todo_id, drops)
+                    if todo["complete"]:
+                        continue
+                    key = order_key(todo)
+                    self.keys[todo_id] = (name, key)
+                    self.todos[todo_id] = todo
+                    adds.setdefault(name, []).append(key)
+
+            for name in drops.keys() | adds.keys():
+                order = self.orders.get(name, [])
+                drop = drops.get(name, ())
+                add = adds.get(name, ())
+                if len(drop) + len(add) > len(order) // 2:
+                    # loading or rewriting most of a list, sort it once
+                    order = [key for key in order if key not in drop]
+                    order.extend(add)
+                    order.sort()
+                else:
+                    for key in drop:
+                        del order[bisect.bisect_left(order, key)]
+                    for key in add:
+                        bisect.insort(order, key)
+                if order:
+                    self.orders[name] = order
+                else:
+                    self.orders.pop(name, None)
+
+    def top(self, limit):
+        """Return (list name, to-do) of the limit most urgent open to-dos."""
+        with self.lock:
+            merged = heapq.merge(*self.orders.values())
+            return [
+                (self.keys[key[-1]][0], self.todos[key[-1]])
+                for key in itertools.islice(merged, limit)
+            ]
+
+    def _forget(self, todo_id, drops):
+        """Take a to-do out, noting its key under its list in drops."""
+        entry = self.keys.pop(todo_id, None)
+        if entry is None:
+            return
+        del self.todos[todo_id]
+        name, key = entry
+        drops.setdefault(name, set()).add(key)
@@ -0,0 +1,100 @@
+"""ReadWriteLock.py
+
+A writer preferring reader/writer lock for the to-do database.
+"""
+
+import threading
+
+from contextlib import contextmanager
+
+
+class ReadWriteLock:
+    """Allow many concurrent readers or a single writer.
+
+    Waiting writers block new readers so a steady stream of reads from the
+    GUI or server threads cannot starve a sync merge. The writer may take
+    the lock again, or take a read lock, without deadlocking itself.
+    """
+
+    def __init__(self):
+        """Create an unlocked lock."""
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer = None
+        self._writer_depth = 0
+        self._writers_waiting = 0
+        self._local = threading.local()
+
+    def _read_depth(self):
+        """Return how many read locks the calling thread holds."""
+        return getattr(self._local, "depth", 0)
+
+    def acquire_read(self):
+        """Acquire a shared lock."""
+        me = threading.get_ident()
+        with self._cond:
+            depth = self._read_depth()
+            if self._writer == me or depth > 0:
+                # re-entrant read, or a read nested in our own write
+                self._local.depth = depth + 1
+                if self._writer != me:
+                    self._readers += 1
+                return
+            while self._writer is not None or self._writers_waiting:
+                self._cond.wait()
+            self._readers += 1
+            self._local.depth = 1
+
+    def release_read(self):
+        """Release a shared lock."""
+        me = threading.get_ident()
+        with self._cond:
+            self._local.depth = self._read_depth() - 1
+            if self._writer != me:
+                self._readers -= 1
+                if self._readers == 0:
+                    self._cond.notify_all()
+
+    def acquire_write(self):
+        """Acquire an exclusive lock."""
+        me = threading.get_ident()
+        with self._cond:
+            if self._writer == me:
+                self._writer_depth += 1
+                return
+            if self._read_depth() > 0:
+                raise RuntimeError("Cannot upgrade a read lock to a write lock")
+            self._writers_waiting += 1
+            try:
+                while self._writer is not None or self._readers:
+                    self._cond.wait()
+            finally:
+                self._writers_waiting -= 1
+            self._writer = me
+            self._writer_depth = 1
+
+    def release_write(self):
+        """Release an exclusive lock."""
+        with self._cond:
+            self._writer_depth -= 1
+            if self._writer_depth == 0:
+                self._writer = None
+                self._cond.notify_all()
+
+    @contextmanager
+    def read_locked(self):
+        """Hold a shared lock for the duration of a with block."""
+        self.acquire_read()
+        try:
+            yield
+        finally:
+            self.release_read()
+
+    @contextmanager
+    def write_locked(self):
+        """Hold an exclusive lock for the duration of a with block."""
+        self.acquire_write()
+        try:
+            yield
+        finally:
+            self.release_write()
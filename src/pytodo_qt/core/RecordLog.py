@@ -0,0 +1,174 @@
+"""RecordLog.py
+
+An append-only file of compressed JSON records.
+
+Each record is a header, holding the length of the rest of the record,
+how its payload is stored, a tag chosen by the user of the log and a time
+stamp, followed by the payload: a zlib compressed JSON document,
+encrypted like the database files when those are. Headers can be walked
+without reading any payload, so a log is indexed by tag and time cheaply.
+A record cut short by a crash is ignored when reading and cut off before
+the next append.
+"""
+
+import io
+import json
+import os
+import struct
+import zlib
+
+from pathlib import Path
+
+from ..core.Logger import Logger
+from ..crypto.FileCipher import DecryptionError
+
+
+logger = Logger(__name__)
+
+
+# length of the rest of the record, payload kind, tag and time stamp
+HEADER = struct.Struct(">Iccd")
+
+# payload kinds, compressed or compressed and then encrypted
+PLAIN = b"z"
+ENCRYPTED = b"e"
+
+
+class RecordLogError(ValueError):
+    """A record can not be read."""
+
+
+class RecordLog:
+    """Append and read the records of one file, not thread safe."""
+
+    def __init__(self, fn, db):
+        """Use fn, with db's file cipher, nothing is read yet."""
+        self.fn = Path(fn)
+        self.db = db
+        # offset just past the last complete record, None until known
+        self.end = None
+
+    def size(self):
+        """Return the size of the complete records, in bytes."""
+        if self.end is None:
+            self.scan()
+        return self.end
+
+    # reading
+
+    def scan(self):
+        """Return (offset, tag, time) of every complete record.
+
+        Only the headers are read.
+        """
+        found = []
+        if not Path.exists(self.fn):
+            self.end = 0
+            return found
+        with open(self.fn, "rb") as f:
+            total = f.seek(0, os.SEEK_END)
+            pos = 0
+            while pos + HEADER.size <= total:
+                f.seek(pos)
+                size, _, tag, t = HEADER.unpack(f.read(HEADER.size))
+                if pos + HEADER.size + size > total:
+                    break
+                found.append((pos, tag, t))
+                pos += HEADER.size + size
+        if pos < total:
+            logger.log.warning("Ignoring a torn record at the end of %s", self.fn)
+        self.end = pos
+        return found
+
+    def read(self, offset):
+        """Return the tag, time and document of the record at offset."""
+        with open(self.fn, "rb") as f:
+            f.seek(offset)
+            header = f.read(HEADER.size)
+            if len(header) < HEADER.size:
+                raise RecordLogError(f"No record at {offset} of {self.fn}")
+            size, kind, tag, t = HEADER.unpack(header)
+            return tag, t, self.decode(kind, f.read(size))
+
+    def records(self, start=0):
+        """Yield (offset, tag, time, document) of every record from start."""
+        if not Path.exists(self.fn):
+            return
+        with open(self.fn, "rb") as f:
+            f.seek(start)
+            data = f.read()
+        pos = 0
+        while pos + HEADER.size <= len(data):
+            size, kind, tag, t = HEADER.unpack_from(data, pos)
+            body = pos + HEADER.size
+            if body + size > len(data):
+                break
+            yield start + pos, tag, t, self.decode(kind, data[body : body + size])
+            pos = body + size
+
+    def decode(self, kind, payload):
+        """Return the document held by a payload."""
+        try:
+            if kind == ENCRYPTED:
+                if self.db.file_cipher is None:
+                    raise RecordLogError(f"{self.fn} is encrypted and locked")
+                payload = self.db.file_cipher.decrypt_from(io.BytesIO(payload))
+            elif kind != PLAIN:
+                raise RecordLogError(f"Unknown record kind {kind!r} in {self.fn}")
+            return json.loads(zlib.decompress(payload))
+        except (DecryptionError, zlib.error, ValueError) as e:
+            raise RecordLogError(f"Unable to read {self.fn}: {e}") from e
+
+    # writing
+
+    def encode(self, tag, t, doc):
+        """Return the bytes of a record."""
+        payload = zlib.compress(json.dumps(doc, separators=(",", ":")).encode("utf-8"))
+        kind = PLAIN
+        if self.db.file_cipher is not None:
+            f = io.BytesIO()
+            self.db.file_cipher.encrypt_to(f, payload)
+            payload = f.getvalue()
+            kind = ENCRYPTED
+        return HEADER.pack(len(payload), kind, tag, t) + payload
+
+    def append(self, tag, t, doc, sync=False):
+        """Append a record, return its offset.
+
+        With sync the record is on disk before this returns.
+        """
+        record = self.encode(tag, t, doc)
+        offset = self.size()
+        with open(self.fn, "ab") as f:
+            # drop a record torn by a crash, it would hide the ones after it
+            f.truncate(offset)
+            f.write(record)
+            f.flush()
+            if sync:
+                os.fsync(f.fileno())
+        self.end = offset + len(record)
+        return offset
+
+    def rewrite(self, records, keep_from=None):
+        """Atomically replace the file with (tag, time, document) records.
+
+        The records from offset keep_from on are copied after them as they
+        are. Returns the offset of every record written and the offset the
+        kept records now start at.
+        """
+        offsets = []
+        tmp = Path(f"{self.fn}.tmp")
+        with open(tmp, "wb") as f:
+            for tag, t, doc in records:
+                offsets.append(f.tell())
+                f.write(self.encode(tag, t, doc))
+            kept = f.tell()
+            if keep_from is not None and Path.exists(self.fn):
+                with open(self.fn, "rb") as old:
+                    old.seek(keep_from)
+                    f.write(old.read(self.size() - keep_from))
+            self.end = f.tell()
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.fn)
+        return offsets, kept
@@ -0,0 +1,162 @@
+"""ReminderScheduler.py
+
+Fire reminders when to-dos fall due.
+
+Every open to-do with a due time, across all lists, is kept in a min-heap
+ordered by due time, and a single timer is armed for the earliest one, so
+nothing is polled and an idle scheduler costs nothing however many to-dos
+it holds. Adding, editing or completing a to-do is O(log n): a changed due
+time is pushed as a new entry and the old one is left in the heap, marked
+stale by the id -> due time map, and dropped when it reaches the top. The
+heap is rebuilt when stale entries outnumber live ones.
+
+The heap is fed from committed changes, on whichever thread committed
+them, the timer lives on the GUI thread and is re-armed through a queued
+signal when the earliest due time moves.
+"""
+
+import heapq
+import threading
+import time
+
+from PyQt6.QtCore import QObject, Qt, QTimer, pyqtSignal, pyqtSlot
+
+from ..core.Logger import Logger
+
+
+logger = Logger(__name__)
+
+
+# longest single wait in milliseconds, QTimer takes a 32 bit interval
+MAX_INTERVAL = 24 * 3600 * 1000
+
+# stale heap entries tolerated beyond the live ones before a rebuild
+COMPACT_SLACK = 1024
+
+
+class ReminderScheduler(QObject):
+    """Min-heap of due times across all lists behind one timer."""
+
+    # the earliest due time may have moved, re-arm the timer
+    rescheduled = pyqtSignal()
+
+    # (list name, to-do) pairs that just fell due, earliest first
+    fired = pyqtSignal(list)
+
+    def __init__(self, db):
+        """Create an empty scheduler for db, its timer is not armed yet."""
+        super().__init__()
+        self.db = db
+        self.lock = threading.Lock()
+        # (due time, id), including stale entries
+        self.heap = []
+        # id -> (due time, list name, to-do) of every scheduled to-do
+        self.entries = {}
+        # id -> due time of to-dos already fired, so edits do not repeat them
+        self.fired_at = {}
+        # the due time the timer is armed for
+        self.armed = None
+
+        self.timer = QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.setTimerType(Qt.TimerType.PreciseTimer)
+        self.timer.timeout.connect(self.fire)
+        self.rescheduled.connect(self.arm, Qt.ConnectionType.QueuedConnection)
+
+    def __len__(self):
+        """Return the number of scheduled to-dos."""
+        with self.lock:
+            return len(self.entries)
+
+    def apply(self, change):
+        """Bring the heap in step with a committed Transaction.Change."""
+        with self.lock:
+            before = self._peek()
+            for todo_id in change.removed:
+                self.entries.pop(todo_id, None)
+                self.fired_at.pop(todo_id, None)
+            pushes = []
+            for entries in (change.added, change.updated):
+                for todo_id, (name, todo) in entries.items():
+                    due = todo.get("due")
+                    if due is None or todo["complete"]:
+                        self.entries.pop(todo_id, None)
+                        self.fired_at.pop(todo_id, None)
+                        continue
+                    if self.fired_at.get(todo_id) == due:
+                        continue
+                    self.fired_at.pop(todo_id, None)
+                    old = self.entries.get(todo_id)
+                    self.entries[todo_id] = (due, name, todo)
+                    if old is None or old[0] != due:
+                        pushes.append((due, todo_id))
+
+            if len(pushes) > len(self.heap):
+                # loading many at once, heapify is linear
+                self.heap.extend(pushes)
+                heapq.heapify(self.heap)
+            else:
+                for entry in pushes:
+                    heapq.heappush(self.heap, entry)
+            if len(self.heap) > 2 * len(self.entries) + COMPACT_SLACK:
+                self._rebuild()
+            after = self._peek()
+
+        if after != before or after != self.armed:
+            self.rescheduled.emit()
+
+    def next_due(self):
+        """Return the earliest due time, or None."""
+        with self.lock:
+            return self._peek()
+
+    def upcoming(self, limit=None):
+        """Return (due time, list name, to-do) of scheduled to-dos by due time."""
+        with self.lock:
+            entries = list(self.entries.values())
+        if limit is None:
+            return sorted(entries, key=lambda entry: entry[0])
+        return heapq.nsmallest(limit, entries, key=lambda entry: entry[0])
+
+    def _peek(self):
+        """Drop stale entries off the top, return the earliest due time."""
+        heap = self.heap
+        while heap:
+            due, todo_id = heap[0]
+            entry = self.entries.get(todo_id)
+            if entry is not None and entry[0] == due:
+                return due
+            heapq.heappop(heap)
+        return None
+
+    def _rebuild(self):
+        """Drop every stale entry, self.lock must be held."""
+        self.heap = [(entry[0], todo_id) for todo_id, entry in self.entries.items()]
+        heapq.heapify(self.heap)
+
+    @pyqtSlot()
+    def arm(self):
+        """Arm the timer for the earliest due time, on the GUI thread."""
+        due = self.next_due()
+        self.armed = due
+        if due is None:
+            self.timer.stop()
+            return
+        wait = max(0.0, due - time.time()) * 1000
+        self.timer.start(int(min(wait, MAX_INTERVAL)))
+
+    @pyqtSlot()
+    def fire(self):
+        """Pop every to-do now due, announce them and re-arm."""
+        now = time.time()
+        due = []
+        with self.lock:
+            while self._peek() is not None and self.heap[0][0] <= now:
+                _, todo_id = heapq.heappop(self.heap)
+                when, name, todo = self.entries.pop(todo_id)
+                self.fired_at[todo_id] = when
+                due.append((name, todo))
+        if due:
+            logger.log.info("%d to-dos fell due", len(due))
+            self.fired.emit(due)
+        self.arm()
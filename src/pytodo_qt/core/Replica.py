@@ -0,0 +1,547 @@
+"""Replica.py
+
+Conflict free replicated state of the to-do lists.
+
+Every peer keeps a Replica beside its lists. Each to-do is a set of last
+writer wins registers, one per field plus "list" and "position", stamped
+with a Lamport time stamp (counter, replica id) that orders the writes of
+all peers the same way everywhere. To-dos form an observed-remove set: the
+stamp of the latest write to "list" is the add tag, a removal records the
+tags it observed, so a concurrent move or re-add survives it. Manual order
+is a sequence of dense fractional position keys, ties broken by id. Lists
+themselves are last writer wins flags, a list also shows while it holds
+live to-dos.
+
+Peers exchange state deltas: every register and removal newer than the
+receiver's version vector. Merging keeps the newest write of every
+register and the union of removals, which is commutative, associative and
+idempotent, so peers converge in any order without a coordinator.
+"""
+
+import bisect
+import json
+import string
+import threading
+import uuid
+
+from pathlib import Path
+
+from ..core.Logger import Logger
+from ..core.Transaction import TransactionError, validate_fields
+from ..crypto.FileCipher import read_file
+
+
+logger = Logger(__name__)
+
+
+# position key digits, in ascending order
+DIGITS = string.digits + string.ascii_uppercase + string.ascii_lowercase
+DIGIT_VALUES = {d: i for i, d in enumerate(DIGITS)}
+
+# registers holding to-do fields, in the order they appear in a to-do
+FIELDS = ("complete", "reminder", "priority", "due", "modified")
+REQUIRED = ("complete", "reminder", "priority")
+OPTIONAL = ("due", "modified")
+
+
+def midpoint(a, b):
+    """Return a position key between a and b.
+
+    a may be "" for the start and b None for the end, otherwise a < b.
+    Keys never end with the lowest digit, so there is always room.
+    """
+    if b is not None:
+        n = 0
+        while n < len(b) and (a[n] if n < len(a) else DIGITS[0]) == b[n]:
+            n += 1
+        if n > 0:
+            return b[:n] + midpoint(a[n:], b[n:])
+
+    lo = DIGIT_VALUES[a[0]] if a else 0
+    hi = DIGIT_VALUES[b[0]] if b is not None else len(DIGITS)
+    if hi - lo > 1:
+        return DIGITS[(lo + hi) // 2]
+    if b is not None and len(b) > 1:
+        return b[0]
+    return DIGITS[lo] + midpoint(a[1:], None)
+
+
+def keys_between(a, b, n):
+    """Return n increasing position keys between a and b.
+
+    The range is bisected recursively, so keys grow with log n.
+    """
+    if n == 0:
+        return []
+    mid = midpoint(a, b)
+    left = (n - 1) // 2
+    return keys_between(a, mid, left) + [mid] + keys_between(mid, b, n - 1 - left)
+
+
+def increasing(keys):
+    """Return the indexes of a longest strictly increasing run of keys.
+
+    None keys are never part of the run.
+    """
+    tails = []
+    tail_index = []
+    previous = [None] * len(keys)
+    for i, key in enumerate(keys):
+        if key is None:
+            continue
+        j = bisect.bisect_left(tails, key)
+        if j == len(tails):
+            tails.append(key)
+            tail_index.append(i)
+        else:
+            tails[j] = key
+            tail_index[j] = i
+        previous[i] = tail_index[j - 1] if j > 0 else None
+
+    run = set()
+    i = tail_index[-1] if tail_index else None
+    while i is not None:
+        run.add(i)
+        i = previous[i]
+    return run
+
+
+def parse_stamp(value):
+    """Return a (counter, replica) stamp from JSON, or raise TransactionError."""
+    if (
+        not isinstance(value, list)
+        or len(value) != 2
+        or not isinstance(value[0], int)
+        or isinstance(value[0], bool)
+        or value[0] < 1
+        or not isinstance(value[1], str)
+    ):
+        raise TransactionError(f"Invalid replica time stamp {value!r}")
+    return value[0], value[1]
+
+
+def parse_register(field, value):
+    """Return a (counter, replica, value) register from JSON."""
+    if not isinstance(value, list) or len(value) != 3:
+        raise TransactionError(f"Invalid {field!r} register {value!r}")
+    stamp = parse_stamp(value[:2])
+    if field == "list":
+        if not isinstance(value[2], str) or not value[2]:
+            raise TransactionError(f"Invalid list name {value[2]!r}")
+    elif field == "position":
+        key = value[2]
+        if (
+            not isinstance(key, str)
+            or not key
+            or key.endswith(DIGITS[0])
+            or not set(key) <= DIGIT_VALUES.keys()
+        ):
+            raise TransactionError(f"Invalid position key {value[2]!r}")
+    elif field in FIELDS:
+        validate_fields({field: value[2]})
+    else:
+        raise TransactionError(f"Unknown register {field!r}")
+    return stamp + (value[2],)
+
+
+def parse_delta(data):
+    """Convert a JSON state delta to registers and stamps.
+
+    Raises TransactionError if data is malformed, before anything is
+    merged.
+    """
+    if not isinstance(data, dict):
+        raise TransactionError("Replica state must be a JSON object")
+    try:
+        items = {
+            todo_id: {f: parse_register(f, reg) for f, reg in regs.items()}
+            for todo_id, regs in data.get("items", {}).items()
+        }
+        removed = {
+            todo_id: {
+                parse_stamp(entry[:2]): parse_stamp(entry[2:]) for entry in entries
+            }
+            for todo_id, entries in data.get("removed", {}).items()
+        }
+        lists = {}
+        for name, reg in data.get("lists", {}).items():
+            if not isinstance(reg, list) or len(reg) != 3:
+                raise TransactionError(f"Invalid list register {reg!r}")
+            lists[name] = parse_stamp(reg[:2]) + (bool(reg[2]),)
+    except (AttributeError, TypeError) as e:
+        raise TransactionError(f"Malformed replica state: {e}") from e
+    return {"items": items, "removed": removed, "lists": lists}
+
+
+def stamps_of(delta):
+    """Yield every stamp in a parsed delta."""
+    for regs in delta["items"].values():
+        for reg in regs.values():
+            yield reg[:2]
+    for tags in delta["removed"].values():
+        yield from tags.values()
+    for reg in delta["lists"].values():
+        yield reg[:2]
+
+
+def join_deltas(deltas):
+    """Join JSON state deltas into one, as if each was merged in turn.
+
+    The join keeps the newest version of every register, so the result
+    does not depend on the order of deltas. Raises TransactionError if any
+    of them is malformed.
+    """
+    items = {}
+    removed = {}
+    lists = {}
+    for data in deltas:
+        delta = parse_delta(data)
+        for todo_id, regs in delta["items"].items():
+            joined = items.setdefault(todo_id, {})
+            for f, reg in regs.items():
+                if f not in joined or reg[:2] > joined[f][:2]:
+                    joined[f] = reg
+        for todo_id, tags in delta["removed"].items():
+            joined = removed.setdefault(todo_id, {})
+            for tag, stamp in tags.items():
+                if tag not in joined or stamp > joined[tag]:
+                    joined[tag] = stamp
+        for name, reg in delta["lists"].items():
+            if name not in lists or reg[:2] > lists[name][:2]:
+                lists[name] = reg
+
+    return {
+        "items": {
+            todo_id: {f: list(reg) for f, reg in regs.items()}
+            for todo_id, regs in items.items()
+        },
+        "removed": {
+            todo_id: [list(tag + stamp) for tag, stamp in tags.items()]
+            for todo_id, tags in removed.items()
+        },
+        "lists": {name: list(reg) for name, reg in lists.items()},
+    }
+
+
+class Replica:
+    """Replicated registers of every to-do, kept in step with the lists."""
+
+    def __init__(self, db):
+        """Create an empty replica of db with a new replica id."""
+        self.db = db
+        self.lock = threading.Lock()
+        self.replica_id = uuid.uuid4().hex[:12]
+        self.clock = 0
+        # id -> {register name: (counter, replica, value)}
+        self.items = {}
+        # id -> {observed add tag: removal stamp}
+        self.removed = {}
+        # list name -> (counter, replica, alive)
+        self.lists = {}
+        # list name -> ids of its live to-dos
+        self.members = {}
+        # replica id -> highest counter seen from it
+        self.vv = {}
+
+    def tick(self):
+        """Return a new local time stamp."""
+        self.clock += 1
+        self.vv[self.replica_id] = self.clock
+        return self.clock, self.replica_id
+
+    def observe(self, stamp):
+        """Advance the clock and version vector past a received stamp."""
+        counter, replica = stamp
+        if counter > self.clock:
+            self.clock = counter
+        if counter > self.vv.get(replica, 0):
+            self.vv[replica] = counter
+
+    @staticmethod
+    def alive(regs, tags):
+        """Return True if a to-do with regs and removal tags is live."""
+        return (
+            regs is not None
+            and "list" in regs
+            and all(f in regs for f in REQUIRED)
+            and regs["list"][:2] not in tags
+        )
+
+    @staticmethod
+    def materialize(todo_id, regs):
+        """Return the to-do held by regs."""
+        todo = {f: regs[f][2] for f in REQUIRED}
+        todo["id"] = todo_id
+        for f in OPTIONAL:
+            if f in regs:
+                todo[f] = regs[f][2]
+        return todo
+
+    def position(self, todo_id, regs):
+        """Sort key of a to-do within its list."""
+        reg = regs.get("position")
+        return (reg[2] if reg is not None else ""), todo_id
+
+    def version_vector(self):
+        """Return a copy of the version vector, to ask peers for a delta."""
+        with self.lock:
+            return dict(self.vv)
+
+    def covered_by(self, since):
+        """Return True if a peer with version vector since has seen everything."""
+        with self.lock:
+            return all(since.get(r, 0) >= c for r, c in self.vv.items())
+
+    # exchanging state
+
+    def delta(self, since=None):
+        """Return every register and removal newer than version vector since.
+
+        The result is JSON serializable, pass None for the whole state.
+        """
+        since = since or {}
+
+        def newer(stamp):
+            return stamp[0] > since.get(stamp[1], 0)
+
+        with self.lock:
+            items = {}
+            for todo_id, regs in self.items.items():
+                fresh = {f: list(reg) for f, reg in regs.items() if newer(reg)}
+                if fresh:
+                    items[todo_id] = fresh
+            removed = {}
+            for todo_id, tags in self.removed.items():
+                fresh = [list(tag + s) for tag, s in tags.items() if newer(s)]
+                if fresh:
+                    removed[todo_id] = fresh
+            lists = {n: list(reg) for n, reg in self.lists.items() if newer(reg)}
+            return {
+                "replica": self.replica_id,
+                "items": items,
+                "removed": removed,
+                "lists": lists,
+            }
+
+    def preview(self, data):
+        """Merge a JSON delta from a peer into copies of what it touches.
+
+        Returns the merged registers, installed by apply() when the
+        transaction commits, and the new contents of every list they
+        change, None for lists that disappear. Nothing is modified, so a
+        failed transaction leaves the replica as it was.
+        """
+        delta = parse_delta(data)
+
+        with self.lock:
+            items = {}
+            for todo_id, regs in delta["items"].items():
+                current = self.items.get(todo_id, {})
+                merged = dict(current)
+                for f, reg in regs.items():
+                    if f not in merged or reg[:2] > merged[f][:2]:
+                        merged[f] = reg
+                if merged != current:
+                    items[todo_id] = merged
+
+            removed = {}
+            for todo_id, tags in delta["removed"].items():
+                current = self.removed.get(todo_id, {})
+                if not tags.keys() <= current.keys():
+                    removed[todo_id] = {**tags, **current}
+
+            lists = {}
+            for name, reg in delta["lists"].items():
+                current = self.lists.get(name)
+                if current is None or reg[:2] > current[:2]:
+                    lists[name] = reg
+
+            pending = {
+                "items": items,
+                "removed": removed,
+                "lists": lists,
+                "stamps": list(stamps_of(delta)),
+            }
+
+            # where each touched to-do lives now and after the merge
+            joins = {}
+            leaves = {}
+            for todo_id in items.keys() | removed.keys():
+                before = self.items.get(todo_id)
+                if self.alive(before, self.removed.get(todo_id, {})):
+                    leaves.setdefault(before["list"][2], set()).add(todo_id)
+                after = items.get(todo_id, before)
+                if self.alive(after, removed.get(todo_id, self.removed.get(todo_id, {}))):
+                    joins.setdefault(after["list"][2], set()).add(todo_id)
+
+            todo_lists = {}
+            for name in lists.keys() | joins.keys() | leaves.keys():
+                ids = self.members.get(name, set()) - leaves.get(name, set())
+                ids |= joins.get(name, set())
+                reg = lists.get(name, self.lists.get(name))
+                if not ids and not (reg is not None and reg[2]):
+                    todo_lists[name] = None
+                    continue
+
+                regs_of = {i: items.get(i) or self.items[i] for i in ids}
+                ordered = sorted(ids, key=lambda i: self.position(i, regs_of[i]))
+                todo_lists[name] = [self.materialize(i, regs_of[i]) for i in ordered]
+
+        return pending, todo_lists
+
+    def _install(self, pending):
+        """Install registers merged by preview()."""
+        for todo_id in pending["items"].keys() | pending["removed"].keys():
+            before = self.items.get(todo_id)
+            if self.alive(before, self.removed.get(todo_id, {})):
+                self.members.get(before["list"][2], set()).discard(todo_id)
+
+            if todo_id in pending["items"]:
+                self.items[todo_id] = pending["items"][todo_id]
+            if todo_id in pending["removed"]:
+                self.removed[todo_id] = pending["removed"][todo_id]
+
+            after = self.items.get(todo_id)
+            if self.alive(after, self.removed.get(todo_id, {})):
+                self.members.setdefault(after["list"][2], set()).add(todo_id)
+
+        self.lists.update(pending["lists"])
+        for stamp in pending["stamps"]:
+            self.observe(stamp)
+
+    # recording local changes
+
+    def apply(self, change):
+        """Bring the replica in step with a committed Transaction.Change.
+
+        Registers merged from a peer are installed first, then every
+        to-do the change touched is compared with its registers and only
+        real differences are stamped as local writes, so applying merged
+        state never echoes it back as new writes.
+        """
+        with self.lock:
+            delta = getattr(change, "delta", None)
+            if delta is not None:
+                self._install(delta)
+            else:
+                for name in change.lists_removed:
+                    if name not in self.db.todo_lists:
+                        self.lists[name] = self.tick() + (False,)
+                # a list edited here is alive here, even if a peer deleted
+                # it while it still held to-dos
+                for name in change.lists_changed & self.db.todo_lists.keys():
+                    reg = self.lists.get(name)
+                    if reg is None or not reg[2]:
+                        self.lists[name] = self.tick() + (True,)
+
+            for todo_id in change.removed:
+                self._remove(todo_id)
+            for entries in (change.added, change.updated):
+                for todo_id, (list_name, todo) in entries.items():
+                    self._record(list_name, todo)
+            for name in change.lists_changed:
+                if name in self.db.todo_lists:
+                    self._order(self.db.todo_lists[name])
+
+    def _remove(self, todo_id):
+        regs = self.items.get(todo_id)
+        tags = self.removed.get(todo_id, {})
+        if not self.alive(regs, tags):
+            return
+        self.removed[todo_id] = {**tags, regs["list"][:2]: self.tick()}
+        self.members.get(regs["list"][2], set()).discard(todo_id)
+
+    def _record(self, list_name, todo):
+        todo_id = todo["id"]
+        regs = self.items.setdefault(todo_id, {})
+        was_alive = self.alive(regs, self.removed.get(todo_id, {}))
+        for f in FIELDS:
+            if f in todo and (f not in regs or regs[f][2] != todo[f]):
+                regs[f] = self.tick() + (todo[f],)
+
+        if was_alive and regs["list"][2] == list_name:
+            return
+        if was_alive:
+            self.members.get(regs["list"][2], set()).discard(todo_id)
+        # a new add tag, which also revives a removed to-do
+        regs["list"] = self.tick() + (list_name,)
+        self.members.setdefault(list_name, set()).add(todo_id)
+
+    def _order(self, todos):
+        """Stamp new position keys for to-dos that are out of order.
+
+        Keys of a longest increasing run are kept, so moving one to-do
+        rewrites one register.
+        """
+        keys = []
+        for todo in todos:
+            reg = self.items[todo["id"]].get("position")
+            keys.append(reg[2] if reg is not None else None)
+        if None not in keys and all(a < b for a, b in zip(keys, keys[1:])):
+            return
+
+        keep = increasing(keys)
+        run = []
+        low = ""
+        for i, todo in enumerate(todos):
+            if i not in keep:
+                run.append(todo)
+                continue
+            self._place(run, low, keys[i])
+            run = []
+            low = keys[i]
+        self._place(run, low, None)
+
+    def _place(self, todos, low, high):
+        for todo, key in zip(todos, keys_between(low, high, len(todos))):
+            self.items[todo["id"]]["position"] = self.tick() + (key,)
+
+    # persistence
+
+    def serialize(self):
+        """Return the whole replica as JSON."""
+        state = self.delta()
+        with self.lock:
+            state["clock"] = self.clock
+            state["vv"] = self.vv
+        return json.dumps(state)
+
+    def load(self, fn):
+        """Replace the replica with the state saved in fn, if it exists.
+
+        Returns (bool, msg) like the other readers.
+        """
+        if not Path.exists(fn):
+            msg = f"Replica file {fn} does not exist, starting a new replica"
+            logger.log.info(msg)
+            return False, msg
+
+        try:
+            data = json.loads(read_file(fn, self.db.file_cipher))
+            delta = parse_delta(data)
+            replica_id = data["replica"]
+            clock = data["clock"]
+            vv = {r: c for r, c in data.get("vv", {}).items() if isinstance(c, int)}
+        except (IOError, ValueError, KeyError, AttributeError, TransactionError) as e:
+            msg = f"Error reading replica file {fn}: {e}"
+            logger.log.exception(msg)
+            return False, msg
+
+        with self.lock:
+            self.replica_id = replica_id
+            self.clock = 0
+            self.items = delta["items"]
+            self.removed = delta["removed"]
+            self.lists = delta["lists"]
+            self.members = {}
+            self.vv = vv
+            for todo_id, regs in self.items.items():
+                if self.alive(regs, self.removed.get(todo_id, {})):
+                    self.members.setdefault(regs["list"][2], set()).add(todo_id)
+            for stamp in stamps_of(delta):
+                self.observe(stamp)
+            self.clock = max(self.clock, clock)
+
+        msg = f"Loaded replica {replica_id} from {fn}"
+        logger.log.info(msg)
+        return True, msg
@@ -0,0 +1,165 @@
+"""SearchIndex.py
+
+An inverted index over the reminders of every to-do list.
+
+The index maps each token to the identifiers of the to-dos containing it
+and keeps the distinct tokens sorted, so a prefix lookup is a bisection
+instead of a scan. It is updated incrementally from the Change of every
+committed transaction.
+"""
+
+import bisect
+import heapq
+import re
+import threading
+
+
+TOKEN_RE = re.compile(r"\w+")
+
+
+def tokenize(text):
+    """Split text into lower case word tokens, in order."""
+    return [t.casefold() for t in TOKEN_RE.findall(text)]
+
+
+def result_order(result):
+    """Sort key for search results: priority, list name, reminder."""
+    return result[3], result[1], result[2]
+
+
+class SearchIndex:
+    """Full-text index of reminders with priority and completion filters."""
+
+    def __init__(self):
+        """Create an empty index."""
+        self.lock = threading.Lock()
+        self.postings = {}
+        self.tokens = []
+        self.docs = {}
+        self.by_priority = {1: set(), 2: set(), 3: set()}
+        self.completed = set()
+
+    def __len__(self):
+        return len(self.docs)
+
+    def add(self, list_name, todo):
+        """Index a to-do of list_name, replacing any previous entry."""
+        with self.lock:
+            self._discard(todo["id"])
+            self._add(list_name, todo)
+
+    def discard(self, todo_id):
+        """Remove a to-do from the index if present."""
+        with self.lock:
+            self._discard(todo_id)
+
+    def apply(self, change):
+        """Update the index with a committed Transaction.Change."""
+        with self.lock:
+            for todo_id in change.removed:
+                self._discard(todo_id)
+            for entries in (change.added, change.updated):
+                for todo_id, (list_name, todo) in entries.items():
+                    self._discard(todo_id)
+                    self._add(list_name, todo)
+
+    def rebuild(self, todo_lists):
+        """Index every to-do of todo_lists from scratch."""
+        with self.lock:
+            self.postings.clear()
+            self.tokens.clear()
+            self.docs.clear()
+            for ids in self.by_priority.values():
+                ids.clear()
+            self.completed.clear()
+            for list_name, todos in todo_lists.items():
+                for todo in todos:
+                    self._add(list_name, todo)
+
+    def _add(self, list_name, todo):
+        todo_id = todo["id"]
+        tokens = set(tokenize(todo["reminder"]))
+        self.docs[todo_id] = (
+            list_name,
+            todo["reminder"],
+            todo["priority"],
+            todo["complete"],
+            tokens,
+        )
+        for token in tokens:
+            ids = self.postings.get(token)
+            if ids is None:
+                ids = self.postings[token] = set()
+                bisect.insort(self.tokens, token)
+            ids.add(todo_id)
+        self.by_priority.setdefault(todo["priority"], set()).add(todo_id)
+        if todo["complete"]:
+            self.completed.add(todo_id)
+
+    def _discard(self, todo_id):
+        doc = self.docs.pop(todo_id, None)
+        if doc is None:
+            return
+        _, _, priority, complete, tokens = doc
+        for token in tokens:
+            ids = self.postings[token]
+            ids.discard(todo_id)
+            if not ids:
+                del self.postings[token]
+                del self.tokens[bisect.bisect_left(self.tokens, token)]
+        self.by_priority[priority].discard(todo_id)
+        if complete:
+            self.completed.discard(todo_id)
+
+    def _prefix(self, prefix):
+        """Return the union of the postings of every token with prefix."""
+        ids = set()
+        i = bisect.bisect_left(self.tokens, prefix)
+        while i < len(self.tokens) and self.tokens[i].startswith(prefix):
+            ids |= self.postings[self.tokens[i]]
+            i += 1
+        return ids
+
+    def search(self, text="", priority=None, complete=None, limit=None):
+        """Return the match count and up to limit matching to-dos.
+
+        Matches are (id, list name, reminder, priority, complete) tuples.
+        Every word of text must match, the last word as a prefix unless
+        text ends with whitespace. priority and complete further restrict
+        the results when they are not None. Results are ordered by
+        priority, then list, then reminder.
+        """
+        words = tokenize(text)
+        prefix_last = bool(words) and not text[-1:].isspace()
+
+        with self.lock:
+            candidates = []
+            for i, word in enumerate(words):
+                if prefix_last and i == len(words) - 1:
+                    candidates.append(self._prefix(word))
+                else:
+                    candidates.append(self.postings.get(word, set()))
+            if priority is not None:
+                candidates.append(self.by_priority.get(priority, set()))
+
+            if candidates:
+                candidates.sort(key=len)
+                ids = set(candidates[0])
+                for other in candidates[1:]:
+                    if not ids:
+                        break
+                    ids &= other
+            else:
+                ids = set(self.docs)
+
+            if complete is True:
+                ids &= self.completed
+            elif complete is False:
+                ids -= self.completed
+
+            results = [(todo_id,) + self.docs[todo_id][:4] for todo_id in ids]
+
+        if limit is not None and limit < len(results):
+            return len(results), heapq.nsmallest(limit, results, key=result_order)
+        results.sort(key=result_order)
+        return len(results), results
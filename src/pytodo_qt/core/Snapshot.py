@@ -0,0 +1,114 @@
+"""Snapshot.py
+
+Immutable, versioned views of the to-do database.
+
+A snapshot maps list names to frozen lists. Publishing a new version only
+freezes the lists that changed, every other list is shared with the
+previous version, so readers never copy the whole database and never wait
+for writers.
+"""
+
+import hashlib
+import json
+
+from types import MappingProxyType
+
+
+class FrozenTodoList:
+    """An immutable to-do list with cached JSON encodings."""
+
+    __slots__ = ("items", "_json")
+
+    def __init__(self, todos):
+        """Freeze a copy of todos."""
+        self.items = tuple(MappingProxyType(dict(todo)) for todo in todos)
+        self._json = {}
+
+    def __len__(self):
+        return len(self.items)
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def to_list(self):
+        """Return a mutable deep copy of the list."""
+        return [dict(todo) for todo in self.items]
+
+    def to_json(self, indent=None):
+        """Return the list encoded as JSON, nested one level for indent."""
+        text = self._json.get(indent)
+        if text is None:
+            text = json.dumps(self.to_list(), indent=indent)
+            if indent is not None:
+                text = text.replace("\n", "\n" + " " * indent)
+            self._json[indent] = text
+        return text
+
+
+class Snapshot:
+    """A consistent, read-only version of every to-do list."""
+
+    __slots__ = ("version", "lists", "_json", "_hash")
+
+    def __init__(self, version=0, lists=None):
+        """Create a snapshot from a mapping of names to FrozenTodoLists."""
+        self.version = version
+        self.lists = MappingProxyType(dict(lists or {}))
+        self._json = {}
+        self._hash = None
+
+    def derive(self, todo_lists, changed=None):
+        """Return the next version, re-freezing only the changed lists.
+
+        todo_lists is the live database, changed is an iterable of list
+        names that were modified, or None to re-freeze everything.
+        """
+        if changed is None:
+            lists = {k: FrozenTodoList(v) for k, v in todo_lists.items()}
+        else:
+            lists = {}
+            changed = set(changed)
+            for k, v in todo_lists.items():
+                if k in changed or k not in self.lists:
+                    lists[k] = FrozenTodoList(v)
+                else:
+                    lists[k] = self.lists[k]
+        return Snapshot(self.version + 1, lists)
+
+    def todo_total(self):
+        """Return the number of to-dos in all lists."""
+        return sum(len(v) for v in self.lists.values())
+
+    def to_dict(self):
+        """Return a mutable deep copy of all lists."""
+        return {k: v.to_list() for k, v in self.lists.items()}
+
+    def serialize(self, indent=None):
+        """Encode the snapshot as JSON, reusing each list's cached encoding.
+
+        The output is identical to json.dumps(self.to_dict(), indent=indent).
+        """
+        text = self._json.get(indent)
+        if text is not None:
+            return text
+
+        if not self.lists:
+            text = "{}"
+        elif indent is None:
+            entries = (f"{json.dumps(k)}: {v.to_json()}" for k, v in self.lists.items())
+            text = "{" + ", ".join(entries) + "}"
+        else:
+            pad = " " * indent
+            entries = (
+                f"{pad}{json.dumps(k)}: {v.to_json(indent)}"
+                for k, v in self.lists.items()
+            )
+            text = "{\n" + ",\n".join(entries) + "\n}"
+        self._json[indent] = text
+        return text
+
+    def content_hash(self):
+        """Return a SHA-1 digest of the lists, identical content hashes equal."""
+        if self._hash is None:
+            self._hash = hashlib.sha1(self.serialize().encode("utf-8")).hexdigest()
+        return self._hash
@@ -4,23 +4,58 @@ This module implements the to-do database.
 """
 
 import configparser
+import socket
 import sys
 import threading
 
+from contextlib import contextmanager
+
 from pathlib import Path
 
-from PyQt6.QtCore import QObject
+from PyQt6.QtCore import QObject, pyqtSignal
 
-from ..core import settings
+from ..core import json_helpers, metrics, settings, timed
+from ..core.Archive import ARCHIVE_AFTER, Archive
+from ..core.History import HISTORY_DAYS, HISTORY_MAX_SIZE, History
 from ..core.Logger import Logger
+from ..core.NextUp import NextUp
+from ..core.ReadWriteLock import ReadWriteLock
+from ..core.ReminderScheduler import ReminderScheduler
+from ..core.Replica import Replica
+from ..core.SearchIndex import SearchIndex
+from ..core.Snapshot import Snapshot
+from ..core.Transaction import Transaction
+from ..core.TrigramIndex import TrigramIndex
+from ..core.UndoStack import UndoStack
+from ..crypto.FileCipher import is_encrypted
 from ..net import tcp_server_lib, tcp_client_lib
+from ..net.Admission import SERVER_LIMITS
+from ..net.Session import ChangeStream
+from ..net.SyncScheduler import SyncScheduler, format_peers, parse_peers
 
 
 logger = Logger(__name__)
 
 
 class TodoDatabase(QObject):
-    """Maintains a database of to-do lists."""
+    """Maintains a database of to-do lists.
+
+    The database is shared between the GUI thread and the network server
+    threads. Edits go through transaction(), which applies a batch of
+    operations atomically, writes the file once and emits changed once.
+    Lower level mutations go through mutating(), which holds the write
+    lock. Both publish a new immutable Snapshot when done.
+    Readers use snapshot() or read_snapshot() and never take a lock, they
+    see either the version before or the version after an edit. Worker
+    threads never touch widgets, they emit notify and the GUI shows the
+    message through a queued connection.
+    """
+
+    # title, message for the user, always delivered on the GUI thread
+    notify = pyqtSignal(str, str)
+
+    # a Transaction.Change, emitted once per committed transaction
+    changed = pyqtSignal(object)
 
     def __init__(self):
         """Create a working database."""
@@ -29,6 +64,44 @@ class TodoDatabase(QObject):
         self.initialized = False
         self.server_up = False
 
+        # guards todo_lists and the statistics below
+        self.lock = ReadWriteLock()
+
+        # serializes writes to the JSON file
+        self.file_lock = threading.Lock()
+
+        # encrypts the files at rest once unlocked, see crypto.FileCipher
+        self.file_cipher = None
+
+        # the current published version, and versions pinned by readers
+        self._snapshot = Snapshot()
+        self._pinned = {}
+        self._pinned_lock = threading.Lock()
+
+        # the transaction open on each thread, nested blocks join it
+        self._txn_local = threading.local()
+
+        # secondary indexes, kept current from each committed Change
+        self.search_index = SearchIndex()
+        self.trigram_index = TrigramIndex()
+        self.replica = Replica(self)
+        self.history = History(self)
+        self.undo_stack = UndoStack(self)
+        self.reminders = ReminderScheduler(self)
+        self.next_up = NextUp()
+        self.indexes = [
+            self.search_index,
+            self.trigram_index,
+            self.replica,
+            self.history,
+            self.undo_stack,
+            self.reminders,
+            self.next_up,
+        ]
+
+        # completed to-dos moved out of the lists, read on first use
+        self.archive = Archive(self)
+
         # dictionary of to-do lists, which are lists of dictionaries
         self.todo_lists = {}
         self.todo_total = 0
@@ -50,12 +123,20 @@ class TodoDatabase(QObject):
         # create a server, and start it in a new thread
         # the server will create a new thread for each connection established
         self.db_server = None
+        self.local_server = None
         if settings.options["run"]:
             self.start_server()
 
         # create a client
         self.db_client = tcp_client_lib.DatabaseClient()
 
+        # stream changes to and from subscribed peers as they are committed
+        self.change_stream = ChangeStream(self)
+
+        # sync with the saved peers in the background
+        self.sync_scheduler = SyncScheduler(self)
+        self.sync_scheduler.start()
+
     def write_default_config(self):
         """Write the default configuration for To-Do."""
         logger.log.info("Writing default configuration to %s", settings.ini_fn)
@@ -63,6 +144,10 @@ class TodoDatabase(QObject):
         self.config["database"]["active_list"] = ""
         self.config["database"]["sort_key"] = "priority"
         self.config["database"]["reverse_sort"] = "no"
+        self.config["database"]["encrypt"] = "no"
+        self.config["database"]["archive_after"] = str(ARCHIVE_AFTER)
+        self.config["database"]["history_days"] = str(HISTORY_DAYS)
+        self.config["database"]["history_max_size"] = str(HISTORY_MAX_SIZE)
         self.config["server"] = {}
         self.config["server"]["key"] = "BewareTheBlackGuardian"
         self.config["server"]["run"] = "yes"
@@ -70,6 +155,17 @@ class TodoDatabase(QObject):
         self.config["server"]["port"] = "5364"
         self.config["server"]["pull"] = "yes"
         self.config["server"]["push"] = "yes"
+        self.config["server"]["local_socket"] = "yes"
+        for k, v in SERVER_LIMITS.items():
+            self.config["server"][k] = str(v)
+        self.config["metrics"] = {}
+        self.config["metrics"]["collect"] = "no"
+        self.config["metrics"]["dump_at_exit"] = "no"
+        self.config["sync"] = {}
+        self.config["sync"]["peers"] = ""
+        self.config["sync"]["sync_interval"] = "300"
+        self.config["sync"]["sync_on_change"] = "yes"
+        self.config["sync"]["live_updates"] = "yes"
 
         try:
             with open(settings.ini_fn, "w", encoding="utf-8") as f:
@@ -87,6 +183,15 @@ class TodoDatabase(QObject):
             self.config["database"]["reverse_sort"] = "yes"
         else:
             self.config["database"]["reverse_sort"] = "no"
+        if settings.options["encrypt"]:
+            self.config["database"]["encrypt"] = "yes"
+        else:
+            self.config["database"]["encrypt"] = "no"
+        self.config["database"]["archive_after"] = str(
+            settings.options["archive_after"]
+        )
+        for k in ("history_days", "history_max_size"):
+            self.config["database"][k] = str(settings.options[k])
         self.config["server"]["key"] = settings.options["key"]
         if settings.options["run"]:
             self.config["server"]["run"] = "yes"
@@ -94,8 +199,26 @@ class TodoDatabase(QObject):
             self.config["server"]["run"] = "no"
         self.config["server"]["address"] = settings.options["address"]
         self.config["server"]["port"] = str(settings.options["port"])
-        self.config["server"]["pull"] = settings.options["pull"]
-        self.config["server"]["push"] = settings.options["push"]
+        for k in ("pull", "push"):
+            self.config["server"][k] = "yes" if settings.options[k] else "no"
+        if settings.options["local_socket"]:
+            self.config["server"]["local_socket"] = "yes"
+        else:
+            self.config["server"]["local_socket"] = "no"
+        for k in SERVER_LIMITS:
+            self.config["server"][k] = str(settings.options[k])
+        for k in ("collect", "dump_at_exit"):
+            if settings.options[k]:
+                self.config["metrics"][k] = "yes"
+            else:
+                self.config["metrics"][k] = "no"
+        self.config["sync"]["peers"] = format_peers(settings.options["peers"])
+        self.config["sync"]["sync_interval"] = str(settings.options["sync_interval"])
+        for k in ("sync_on_change", "live_updates"):
+            if settings.options[k]:
+                self.config["sync"][k] = "yes"
+            else:
+                self.config["sync"][k] = "no"
 
         try:
             with open(settings.ini_fn, "w", encoding="utf-8") as f:
@@ -126,6 +249,28 @@ class TodoDatabase(QObject):
                 logger.log.info("%r = %r", k, v)
                 settings.options[k] = v
 
+        # sections added after the first release may be missing from old files
+        if not self.config.has_section("metrics"):
+            self.config["metrics"] = {"collect": "no", "dump_at_exit": "no"}
+
+        for k, v in self.config["metrics"].items():
+            if k not in settings.options:
+                logger.log.info("%r = %r", k, v)
+                settings.options[k] = v
+
+        if not self.config.has_section("sync"):
+            self.config["sync"] = {
+                "peers": "",
+                "sync_interval": "300",
+                "sync_on_change": "yes",
+                "live_updates": "yes",
+            }
+
+        for k, v in self.config["sync"].items():
+            if k not in settings.options:
+                logger.log.info("%r = %r", k, v)
+                settings.options[k] = v
+
         # fix some option types
         if settings.options["reverse_sort"] == "yes":
             settings.options["reverse_sort"] = True
@@ -134,14 +279,22 @@ class TodoDatabase(QObject):
         else:
             logger.log.warning("Reverse sort option invalid, defaulting to no")
             settings.options["reverse_sort"] = False
+        # an encrypted database stays encrypted until the user turns it off
+        settings.options["encrypt"] = self.parse_bool_option(
+            "encrypt", False
+        ) or is_encrypted(settings.db_fn)
+        settings.options["archive_after"] = self.parse_int_option(
+            "archive_after", ARCHIVE_AFTER
+        )
+        settings.options["history_days"] = self.parse_int_option(
+            "history_days", HISTORY_DAYS
+        )
+        settings.options["history_max_size"] = self.parse_int_option(
+            "history_max_size", HISTORY_MAX_SIZE
+        )
 
-        if settings.options["run"] == "yes":
-            settings.options["run"] = True
-        elif settings.options["run"] == "no":
-            settings.options["run"] = False
-        else:
-            logger.log.warning("Run network server option invalid, defaulting to yes")
-            settings.options["run"] = True
+        for k in ("run", "pull", "push"):
+            settings.options[k] = self.parse_bool_option(k, True)
 
         try:
             settings.options["port"] = int(settings.options["port"])
@@ -149,6 +302,162 @@ class TodoDatabase(QObject):
             logger.log.exception("Port must be a number: %s", e)
             settings.options["port"] = 5364
 
+        for k, v in SERVER_LIMITS.items():
+            settings.options[k] = self.parse_int_option(k, v)
+        settings.options["local_socket"] = self.parse_bool_option("local_socket", True)
+
+        for k in ("collect", "dump_at_exit"):
+            settings.options[k] = self.parse_bool_option(k, False)
+        metrics.enable(settings.options["collect"])
+
+        if isinstance(settings.options["peers"], str):
+            settings.options["peers"] = parse_peers(
+                settings.options["peers"], settings.options["port"]
+            )
+        try:
+            settings.options["sync_interval"] = int(settings.options["sync_interval"])
+        except ValueError as e:
+            logger.log.exception("Sync interval must be a number: %s", e)
+            settings.options["sync_interval"] = 300
+        for k in ("sync_on_change", "live_updates"):
+            settings.options[k] = self.parse_bool_option(k, True)
+
+    @staticmethod
+    def parse_bool_option(key, default):
+        """Convert a yes/no option to a bool, falling back to default."""
+        value = settings.options.get(key, default)
+        if isinstance(value, bool):
+            return value
+        if value == "yes":
+            return True
+        if value == "no":
+            return False
+
+        logger.log.warning("%s option invalid, defaulting to %s", key, default)
+        return default
+
+    @staticmethod
+    def parse_int_option(key, default):
+        """Convert a non-negative number option to an int, falling back to default."""
+        value = settings.options.get(key, default)
+        try:
+            value = int(value)
+        except (TypeError, ValueError):
+            value = -1
+        if value >= 0:
+            return value
+
+        logger.log.warning("%s option invalid, defaulting to %s", key, default)
+        return default
+
+    @contextmanager
+    def transaction(self, persist=True, origin="local"):
+        """Group operations into one atomic, persisted, announced change.
+
+            with settings.DB.transaction() as txn:
+                txn.delete_todo(list_name, todo_id)
+                ...
+
+        Nothing is applied if the block raises, and a TransactionError is
+        raised without changing anything if an operation is invalid. A
+        transaction opened inside another on the same thread joins it.
+        """
+        txn = getattr(self._txn_local, "txn", None)
+        if txn is not None:
+            yield txn
+            return
+
+        txn = Transaction(self, persist, origin)
+        self._txn_local.txn = txn
+        try:
+            yield txn
+        finally:
+            self._txn_local.txn = None
+
+        change = txn.commit()
+        if not change:
+            return
+        self.history.flush()
+        if txn.persist:
+            json_helpers.write_json_data()
+        self.changed.emit(change)
+
+    @contextmanager
+    def mutating(self, *list_names):
+        """Hold the write lock, then publish a snapshot of the changes.
+
+        list_names are the lists that will be modified, pass none to
+        republish every list.
+        """
+        with self.lock.write_locked():
+            try:
+                yield
+            finally:
+                self.publish(list_names or None)
+
+    def publish(self, changed=None):
+        """Publish a new snapshot, sharing every list not in changed."""
+        with self.lock.write_locked():
+            self._snapshot = self._snapshot.derive(self.todo_lists, changed)
+            self.todo_total = self._snapshot.todo_total()
+            self.list_count = len(self._snapshot.lists)
+
+    def undo(self):
+        """Take back the last committed change, see UndoStack.undo."""
+        return self.undo_stack.undo()
+
+    def redo(self):
+        """Apply the last undone change again, see UndoStack.redo."""
+        return self.undo_stack.redo()
+
+    def next_todos(self, limit):
+        """Return the most urgent open to-dos of all lists, see NextUp.top."""
+        return self.next_up.top(limit)
+
+    def search(self, text="", priority=None, complete=None, limit=None):
+        """Search reminders across all lists, see SearchIndex.search."""
+        return self.search_index.search(text, priority, complete, limit)
+
+    def similar_todos(self, text, limit=5, exclude=None):
+        """Return reminders similar to text, see TrigramIndex.similar."""
+        return self.trigram_index.similar(text, limit=limit, exclude=exclude)
+
+    def find_duplicates(self):
+        """Group near duplicate reminders, see TrigramIndex.duplicates."""
+        return self.trigram_index.duplicates()
+
+    def snapshot(self):
+        """Return the current snapshot, without locking."""
+        return self._snapshot
+
+    @contextmanager
+    def read_snapshot(self):
+        """Pin the current snapshot for the duration of a with block.
+
+        A version is dropped from the pinned table once its last reader
+        finishes, so only the current and in use versions are kept alive.
+        """
+        snapshot = self._snapshot
+        with self._pinned_lock:
+            entry = self._pinned.setdefault(snapshot.version, [snapshot, 0])
+            entry[1] += 1
+        try:
+            yield snapshot
+        finally:
+            with self._pinned_lock:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self._pinned[snapshot.version]
+
+    def pinned_versions(self):
+        """Return the versions currently held by readers."""
+        with self._pinned_lock:
+            return sorted(self._pinned)
+
+    def serialize(self, indent=None):
+        """Return a consistent JSON snapshot of all to-do lists."""
+        return self._snapshot.serialize(indent)
+
     def write_text_file(self, fn=None):
         """Write active list to plain text file."""
         if self.todo_count == 0:
@@ -159,9 +468,10 @@ class TodoDatabase(QObject):
 
         logger.log.info("Writing pytodo-qt list to file %s", fn)
         try:
+            todos = self.sorted_list(self.active_list)
             with open(fn, "w", encoding="utf-8") as f:
                 f.write(f"{self.active_list:*^60}\n\n")
-                for todo in self.todo_lists[self.active_list]:
+                for todo in todos:
                     f.write(f'{todo["reminder"]}\n')
         except IOError as e:
             logger.log.exception("Unable to write pytodo-qt list to %s: %s", fn, e)
@@ -173,13 +483,13 @@ class TodoDatabase(QObject):
 
         return False
 
-    def start_server(self):
-        """Create and start the server."""
+    def start_server(self, server_class=tcp_server_lib.DatabaseServer):
+        """Create and start the server, a DatabaseServer unless told otherwise."""
         if self.server_running():
             return
 
         logger.log.info("Starting the server")
-        self.db_server = tcp_server_lib.DatabaseServer(
+        self.db_server = server_class(
             (settings.options["address"], settings.options["port"]),
             tcp_server_lib.TCPRequestHandler,
         )
@@ -194,12 +504,37 @@ class TodoDatabase(QObject):
             "Server up at %s:%d", settings.options["address"], settings.options["port"]
         )
 
+        if settings.options["local_socket"]:
+            self.start_local_server()
+
+    def start_local_server(self):
+        """Also serve processes on this machine over a Unix domain socket."""
+        if not hasattr(socket, "AF_UNIX"):
+            return
+        try:
+            self.local_server = tcp_server_lib.LocalDatabaseServer(
+                settings.socket_fn, tcp_server_lib.TCPRequestHandler
+            )
+        except OSError as e:
+            logger.log.warning("Not serving on %s: %s", settings.socket_fn, e)
+            return
+
+        st = threading.Thread(target=self.local_server.serve_forever)
+        st.daemon = True
+        st.start()
+        logger.log.info("Server up at %s", settings.socket_fn)
+
     def stop_server(self):
         """Stop and destroy the server."""
         if self.db_server is not None and self.server_running():
             logger.log.info("Shutting down the server")
-            self.db_server.shutdown()
+            for server in (self.db_server, self.local_server):
+                if server is not None:
+                    server.shutdown()
+                    server.close_sessions()
+                    server.server_close()
             self.db_server = None
+            self.local_server = None
             self.server_up = False
             logger.log.info("Server shut down")
         else:
@@ -224,20 +559,22 @@ class TodoDatabase(QObject):
         """Perform a client push."""
         return self.db_client.sync_push(host)
 
-    def sort_active_list(self):
-        """Sort the active to-do list."""
-        logger.log.info("Sorting list %s", self.active_list)
-        self.todo_lists[self.active_list].sort(
-            key=lambda todo_list: todo_list[settings.options["sort_key"]],
-            reverse=settings.options["reverse_sort"],
-        )
+    def sync_pull_many(self, hosts):
+        """Pull from several hosts at once, see DatabaseClient.sync_pull_many."""
+        return self.db_client.sync_pull_many(hosts)
+
+    def sync_push_many(self, hosts):
+        """Push to several hosts at once, see DatabaseClient.sync_push_many."""
+        return self.db_client.sync_push_many(hosts)
 
-    def todo_index(self, reminder):
-        """Return the index location of the to-do matching reminder."""
-        i = 0
-        for todo in self.todo_lists[self.active_list]:
-            if todo["reminder"] == reminder:
-                return i
-            i += 1
+    @timed("db.sort")
+    def sorted_list(self, list_name):
+        """Return a sorted copy of a list's to-dos, for display.
 
-        return None
+        The list itself is left in the order it is stored and synced in.
+        """
+        return sorted(
+            self.snapshot().lists.get(list_name, ()),
+            key=lambda todo: todo[settings.options["sort_key"]],
+            reverse=settings.options["reverse_sort"],
+        )
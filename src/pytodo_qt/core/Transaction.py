@@ -0,0 +1,426 @@
+"""Transaction.py
+
+Batch mutations of the to-do database.
+
+Operations are queued on a Transaction and applied together when the
+with block exits: they are validated against copy-on-write staged lists,
+swapped in under the write lock, published as one snapshot, written to
+disk once and announced with a single change notification.
+"""
+
+import time
+import uuid
+
+from ..core import merge
+from ..core.Logger import Logger
+
+
+logger = Logger(__name__)
+
+
+# fields a to-do may carry, and the values they accept
+TODO_FIELDS = {
+    "complete": lambda v: isinstance(v, bool),
+    "reminder": lambda v: isinstance(v, str) and v != "",
+    "priority": lambda v: v in (1, 2, 3),
+    "modified": lambda v: isinstance(v, (int, float)) and not isinstance(v, bool),
+    # seconds since the epoch, None for no due time
+    "due": lambda v: v is None or TODO_FIELDS["modified"](v),
+}
+
+# fields every to-do must carry
+REQUIRED_FIELDS = ("complete", "reminder", "priority")
+
+
+# origins of changes made on this machine, rather than merged from a peer
+LOCAL_ORIGINS = ("local", "archive")
+
+
+class TransactionError(Exception):
+    """A queued operation could not be applied, nothing was changed."""
+
+
+def new_todo_id():
+    """Return a new stable to-do identifier."""
+    return uuid.uuid4().hex
+
+
+def validate_fields(fields):
+    """Raise TransactionError if any to-do field is unknown or invalid."""
+    for k, v in fields.items():
+        check = TODO_FIELDS.get(k)
+        if check is None:
+            raise TransactionError(f"Unknown to-do field {k!r}")
+        if not check(v):
+            raise TransactionError(f"Invalid value {v!r} for to-do field {k!r}")
+
+
+def validate_todo(todo):
+    """Raise TransactionError unless todo is a whole, valid to-do."""
+    if not isinstance(todo, dict):
+        raise TransactionError(f"A to-do must be an object, not {todo!r}")
+    missing = [k for k in REQUIRED_FIELDS if k not in todo]
+    if missing:
+        raise TransactionError(f"To-do is missing {', '.join(missing)}")
+    validate_fields({k: v for k, v in todo.items() if k != "id"})
+
+
+class Change:
+    """A summary of what one committed transaction changed."""
+
+    def __init__(self, origin="local"):
+        """Create an empty change."""
+        self.origin = origin
+        self.lists_added = set()
+        self.lists_removed = set()
+        self.lists_changed = set()
+        # id -> (list name, to-do) for added and updated, id -> list name
+        # for removed, a moved to-do is updated with its new list name
+        self.added = {}
+        self.updated = {}
+        self.removed = {}
+        # id -> (list name, to-do, position) before the change, for updated
+        # and removed to-dos
+        self.previous = {}
+        # replica registers merged from a peer, see Replica.preview
+        self.delta = None
+
+    def __bool__(self):
+        return bool(self.lists_changed)
+
+    def __repr__(self):
+        return (
+            f"Change(origin={self.origin!r}, lists={sorted(self.lists_changed)}, "
+            f"added={len(self.added)}, updated={len(self.updated)}, "
+            f"removed={len(self.removed)})"
+        )
+
+
+class StagedList:
+    """A copy-on-write working copy of one to-do list."""
+
+    def __init__(self, todos):
+        """Shallow copy todos, items are copied only when updated."""
+        self.todos = list(todos)
+        self._index = None
+
+    def index_of(self, todo_id):
+        """Return the position of todo_id, or raise TransactionError."""
+        if self._index is None:
+            self.compact()
+            self._index = {t["id"]: i for i, t in enumerate(self.todos)}
+        i = self._index.get(todo_id)
+        if i is None:
+            raise TransactionError(f"No to-do with id {todo_id}")
+        return i
+
+    def compact(self):
+        """Drop the holes left by deletions."""
+        if None in self.todos:
+            self.todos = [t for t in self.todos if t is not None]
+            self._index = None
+
+    def append(self, todo, index=None):
+        """Add todo at index, or at the end."""
+        if index is None:
+            self.todos.append(todo)
+            if self._index is not None:
+                self._index[todo["id"]] = len(self.todos) - 1
+        else:
+            self.compact()
+            self.todos.insert(index, todo)
+            self._index = None
+
+    def pop(self, todo_id):
+        """Remove and return the to-do with todo_id."""
+        i = self.index_of(todo_id)
+        todo = self.todos[i]
+        self.todos[i] = None
+        del self._index[todo_id]
+        return todo
+
+    def replace(self, todo_id, todo):
+        """Swap the to-do with todo_id for todo."""
+        self.todos[self.index_of(todo_id)] = todo
+
+    def insert_many(self, entries):
+        """Insert (position, to-do) pairs in one pass.
+
+        Each to-do ends up at its position when the positions are those
+        the to-dos had before they were taken out of the list.
+        """
+        self.compact()
+        todos = []
+        rest = iter(self.todos)
+        for index, todo in sorted(entries, key=lambda entry: entry[0]):
+            while len(todos) < index:
+                kept = next(rest, None)
+                if kept is None:
+                    break
+                todos.append(kept)
+            todos.append(todo)
+        todos.extend(rest)
+        self.todos = todos
+        self._index = None
+
+
+class Transaction:
+    """Queue add/delete/update/move operations and apply them atomically."""
+
+    def __init__(self, db, persist=True, origin="local"):
+        """Create an empty transaction on db."""
+        self.db = db
+        self.persist = persist
+        self.origin = origin
+        self.ops = []
+        self.report = None
+        self.delta = None
+        self.change = None
+
+    # queued operations
+
+    def add_list(self, list_name):
+        """Create an empty list."""
+        self.ops.append(("add_list", list_name))
+
+    def delete_list(self, list_name):
+        """Delete a list and its to-dos."""
+        self.ops.append(("delete_list", list_name))
+
+    def rename_list(self, old_name, new_name):
+        """Rename a list."""
+        self.ops.append(("rename_list", old_name, new_name))
+
+    def add_todo(self, list_name, todo, index=None):
+        """Add a copy of todo to list_name, return its identifier."""
+        todo = dict(todo)
+        todo.setdefault("id", new_todo_id())
+        todo["modified"] = time.time()
+        self.ops.append(("add_todo", list_name, todo, index))
+        return todo["id"]
+
+    def delete_todo(self, list_name, todo_id):
+        """Delete a to-do."""
+        self.ops.append(("delete_todo", list_name, todo_id))
+
+    def update_todo(self, list_name, todo_id, **fields):
+        """Change some fields of a to-do."""
+        self.ops.append(("update_todo", list_name, todo_id, fields))
+
+    def move_todo(self, list_name, todo_id, dest_list, index=None):
+        """Move a to-do to index of dest_list, which may be the same list."""
+        self.ops.append(("move_todo", list_name, todo_id, dest_list, index))
+
+    def restore_todos(self, list_name, entries):
+        """Put (position, to-do) pairs back into list_name, keeping their ids."""
+        entries = [(index, dict(todo, modified=time.time())) for index, todo in entries]
+        self.ops.append(("restore_todos", list_name, entries))
+
+    def merge_lists(self, todo_lists):
+        """Merge lists received from a sync or a file, item by item.
+
+        What the merge did is left in self.report after the commit.
+        """
+        self.ops.append(("merge_lists", todo_lists))
+
+    def merge_replica(self, delta):
+        """Merge a replica state delta received from a peer.
+
+        The merged lists are computed from the replica, so this must be
+        the only operation of its transaction.
+        """
+        self.ops.append(("merge_replica", delta))
+
+    # applying
+
+    def stage(self, live):
+        """Apply the queued operations to staged copies of the live lists.
+
+        Returns a dictionary of list names to their new contents, None for
+        deleted lists, plus the names of the lists in their new order.
+        Raises TransactionError without touching live if any op is invalid.
+        """
+        staged = {}
+        order = list(live.keys())
+
+        def get(name):
+            if name in staged:
+                if staged[name] is None:
+                    raise TransactionError(f"List {name!r} does not exist")
+                return staged[name]
+            if name not in live:
+                raise TransactionError(f"List {name!r} does not exist")
+            staged[name] = StagedList(live[name])
+            return staged[name]
+
+        def exists(name):
+            if name in staged:
+                return staged[name] is not None
+            return name in live
+
+        for op, *args in self.ops:
+            if op == "add_list":
+                (name,) = args
+                if not name:
+                    raise TransactionError("List name cannot be empty")
+                if exists(name):
+                    raise TransactionError(f'A list named "{name}" already exists.')
+                staged[name] = StagedList([])
+                order.append(name)
+            elif op == "delete_list":
+                (name,) = args
+                get(name)
+                staged[name] = None
+                order.remove(name)
+            elif op == "rename_list":
+                old, new = args
+                if not new:
+                    raise TransactionError("List name cannot be empty")
+                if exists(new):
+                    raise TransactionError(f'A list named "{new}" already exists.')
+                staged[new] = get(old)
+                staged[old] = None
+                order[order.index(old)] = new
+            elif op == "add_todo":
+                name, todo, index = args
+                validate_todo(todo)
+                get(name).append(todo, index)
+            elif op == "restore_todos":
+                name, entries = args
+                for _, todo in entries:
+                    validate_todo(todo)
+                get(name).insert_many(entries)
+            elif op == "delete_todo":
+                name, todo_id = args
+                get(name).pop(todo_id)
+            elif op == "update_todo":
+                name, todo_id, fields = args
+                validate_fields(fields)
+                todos = get(name)
+                todo = todos.todos[todos.index_of(todo_id)]
+                todos.replace(todo_id, dict(todo, **fields, modified=time.time()))
+            elif op == "move_todo":
+                name, todo_id, dest, index = args
+                todo = get(name).pop(todo_id)
+                if dest != name:
+                    todo = dict(todo, modified=time.time())
+                get(dest).append(todo, index)
+            elif op == "merge_lists":
+                (todo_lists,) = args
+                if not isinstance(todo_lists, dict):
+                    raise TransactionError("To-do lists must be an object")
+                for todos in todo_lists.values():
+                    if not isinstance(todos, list):
+                        raise TransactionError("A to-do list must be an array")
+                    for todo in todos:
+                        validate_todo(todo)
+                current = {}
+                for name in order:
+                    if name in staged:
+                        staged[name].compact()
+                        current[name] = staged[name].todos
+                    else:
+                        current[name] = live[name]
+                merged, report = merge.merge_todo_lists(
+                    current, todo_lists, new_todo_id
+                )
+                for name, todos in merged.items():
+                    if name not in current:
+                        order.append(name)
+                    if todos is not current.get(name):
+                        staged[name] = StagedList(todos)
+                if self.report is None:
+                    self.report = report
+                else:
+                    self.report.update(report)
+            elif op == "merge_replica":
+                if len(self.ops) > 1:
+                    raise TransactionError("A replica merge must be applied alone")
+                (delta,) = args
+                self.delta, todo_lists = self.db.replica.preview(delta)
+                for name, todos in todo_lists.items():
+                    if todos is None:
+                        if exists(name):
+                            staged[name] = None
+                            order.remove(name)
+                    else:
+                        if not exists(name):
+                            order.append(name)
+                        staged[name] = StagedList(todos)
+            else:
+                raise TransactionError(f"Unknown operation {op!r}")
+
+        for todos in staged.values():
+            if todos is not None:
+                todos.compact()
+
+        return staged, order
+
+    def diff(self, live, staged):
+        """Describe the difference between live and the staged lists."""
+        change = Change(self.origin)
+        before = {}
+        for name, todos in staged.items():
+            if name in live:
+                for i, todo in enumerate(live[name]):
+                    before[todo["id"]] = (name, todo, i)
+            if todos is None:
+                if name in live:
+                    change.lists_removed.add(name)
+            elif name not in live:
+                change.lists_added.add(name)
+            change.lists_changed.add(name)
+
+        after = {}
+        for name, todos in staged.items():
+            if todos is not None:
+                for todo in todos.todos:
+                    after[todo["id"]] = (name, todo)
+
+        for todo_id, (name, todo) in after.items():
+            old = before.get(todo_id)
+            if old is None:
+                change.added[todo_id] = (name, todo)
+            elif old[0] != name or old[1] != todo:
+                change.updated[todo_id] = (name, todo)
+                change.previous[todo_id] = old
+        for todo_id, old in before.items():
+            if todo_id not in after:
+                change.removed[todo_id] = old[0]
+                change.previous[todo_id] = old
+
+        return change
+
+    def commit(self):
+        """Apply all queued operations, or none of them."""
+        if not self.ops:
+            return Change(self.origin)
+
+        with self.db.lock.write_locked():
+            live = self.db.todo_lists
+            staged, order = self.stage(live)
+            change = self.diff(live, staged)
+            change.delta = self.delta
+
+            new_lists = {}
+            for name in order:
+                if name in staged:
+                    new_lists[name] = staged[name].todos
+                else:
+                    new_lists[name] = live[name]
+            self.db.todo_lists = new_lists
+            self.db.publish(change.lists_changed)
+            # the lists are swapped in by now, one failing index must not
+            # keep the others from seeing the change
+            for index in self.db.indexes:
+                try:
+                    index.apply(change)
+                except Exception as e:
+                    logger.log.exception(
+                        "%s failed to apply %s: %s", type(index).__name__, change, e
+                    )
+
+        logger.log.info("Committed %d operations: %s", len(self.ops), change)
+        self.change = change
+        return change
+
@@ -0,0 +1,191 @@
+"""TrigramIndex.py
+
+A trigram index for fuzzy matching of reminders.
+
+Similarity is the Jaccard coefficient of the trigram sets of two
+normalized reminders. Lookups use prefix filtering: if two sets have a
+similarity of at least t, then any |q| - ceil(t * |q|) + 1 trigrams of the
+query must include one shared with the match. Only the postings of the
+query's rarest trigrams are read to find candidates, which are then
+verified exactly. Duplicate detection is a self join that indexes only
+those prefixes, so neither a lookup nor a duplicate search compares every
+pair of reminders.
+"""
+
+import math
+import re
+import threading
+
+
+NORMALIZE_RE = re.compile(r"[^\w]+")
+
+# default similarity thresholds
+SIMILAR_THRESHOLD = 0.5
+DUPLICATE_THRESHOLD = 0.6
+
+
+def normalize(text):
+    """Lower case text and collapse punctuation and whitespace."""
+    return NORMALIZE_RE.sub(" ", text.casefold()).strip()
+
+
+def trigrams(text):
+    """Return the set of trigrams of normalized text, padded at the ends."""
+    padded = f"  {normalize(text)} "
+    return {padded[i : i + 3] for i in range(len(padded) - 2)}
+
+
+def jaccard(a, b):
+    """Return the Jaccard similarity of two sets."""
+    if not a or not b:
+        return 0.0
+    shared = len(a & b)
+    return shared / (len(a) + len(b) - shared)
+
+
+class TrigramIndex:
+    """Fuzzy lookup of reminders across every list."""
+
+    def __init__(self):
+        """Create an empty index."""
+        self.lock = threading.Lock()
+        self.postings = {}
+        self.docs = {}
+
+    def __len__(self):
+        return len(self.docs)
+
+    def add(self, list_name, todo):
+        """Index a to-do of list_name, replacing any previous entry."""
+        with self.lock:
+            self._discard(todo["id"])
+            self._add(list_name, todo)
+
+    def discard(self, todo_id):
+        """Remove a to-do from the index if present."""
+        with self.lock:
+            self._discard(todo_id)
+
+    def apply(self, change):
+        """Update the index with a committed Transaction.Change."""
+        with self.lock:
+            for todo_id in change.removed:
+                self._discard(todo_id)
+            for entries in (change.added, change.updated):
+                for todo_id, (list_name, todo) in entries.items():
+                    doc = self.docs.get(todo_id)
+                    if doc is not None and doc[1] == todo["reminder"]:
+                        # only the list or other fields changed
+                        self.docs[todo_id] = (list_name,) + doc[1:]
+                        continue
+                    self._discard(todo_id)
+                    self._add(list_name, todo)
+
+    def _add(self, list_name, todo):
+        todo_id = todo["id"]
+        grams = trigrams(todo["reminder"])
+        self.docs[todo_id] = (list_name, todo["reminder"], grams)
+        for gram in grams:
+            self.postings.setdefault(gram, set()).add(todo_id)
+
+    def _discard(self, todo_id):
+        doc = self.docs.pop(todo_id, None)
+        if doc is None:
+            return
+        for gram in doc[2]:
+            ids = self.postings[gram]
+            ids.discard(todo_id)
+            if not ids:
+                del self.postings[gram]
+
+    def _candidates(self, grams, threshold):
+        """Return ids sharing a trigram with the rarest prefix of grams."""
+        empty = set()
+        ordered = sorted(grams, key=lambda g: len(self.postings.get(g, empty)))
+        prefix = len(grams) - math.ceil(threshold * len(grams)) + 1
+        ids = set()
+        for gram in ordered[:prefix]:
+            ids |= self.postings.get(gram, empty)
+        return ids
+
+    def similar(self, text, threshold=SIMILAR_THRESHOLD, limit=5, exclude=None):
+        """Return up to limit (score, id, list name, reminder), best first."""
+        grams = trigrams(text)
+        if not grams:
+            return []
+
+        with self.lock:
+            results = []
+            for todo_id in self._candidates(grams, threshold):
+                if todo_id == exclude:
+                    continue
+                list_name, reminder, other = self.docs[todo_id]
+                score = jaccard(grams, other)
+                if score >= threshold:
+                    results.append((score, todo_id, list_name, reminder))
+
+        results.sort(key=lambda r: (-r[0], r[2], r[3]))
+        return results[:limit]
+
+    def duplicates(self, threshold=DUPLICATE_THRESHOLD):
+        """Group near duplicate reminders across all lists.
+
+        Returns a list of groups, each a list of (id, list name, reminder)
+        with at least two members.
+        """
+        with self.lock:
+            parent = {}
+
+            def find(x):
+                parent.setdefault(x, x)
+                while parent[x] != x:
+                    parent[x] = parent[parent[x]]
+                    x = parent[x]
+                return x
+
+            # a self join with prefix filtering: under one global order of
+            # trigrams, rarest first, two similar reminders must share a
+            # trigram in both of their prefixes, so only prefixes are
+            # indexed and probed
+            def rarity(gram):
+                return len(self.postings[gram]), gram
+
+            prefixes = {}
+            for todo_id, (_, _, grams) in self.docs.items():
+                size = len(grams) - math.ceil(threshold * len(grams)) + 1
+                for gram in sorted(grams, key=rarity)[:size]:
+                    prefixes.setdefault(gram, []).append(todo_id)
+
+            for todo_id, (_, _, grams) in self.docs.items():
+                size = len(grams) - math.ceil(threshold * len(grams)) + 1
+                seen = set()
+                for gram in sorted(grams, key=rarity)[:size]:
+                    for other_id in prefixes[gram]:
+                        if other_id <= todo_id or other_id in seen:
+                            continue
+                        seen.add(other_id)
+                        other = self.docs[other_id][2]
+                        # sizes too far apart cannot reach the threshold
+                        if threshold * len(grams) > len(other):
+                            continue
+                        if threshold * len(other) > len(grams):
+                            continue
+                        if jaccard(grams, other) >= threshold:
+                            a, b = find(todo_id), find(other_id)
+                            if a != b:
+                                parent[b] = a
+
+            groups = {}
+            for todo_id in list(parent):
+                groups.setdefault(find(todo_id), []).append(todo_id)
+
+            result = []
+            for members in groups.values():
+                if len(members) < 2:
+                    continue
+                group = [(i,) + self.docs[i][:2] for i in members]
+                group.sort(key=lambda r: (r[1], r[2]))
+                result.append(group)
+
+        result.sort(key=lambda g: (g[0][2], g[0][1]))
+        return result
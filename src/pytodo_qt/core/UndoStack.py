@@ -0,0 +1,224 @@
+"""UndoStack.py
+
+Undo and redo for the to-do database.
+
+Every committed transaction, edits made here as well as changes merged
+from peers, is turned into the few operations that take it back, built
+from its Transaction.Change: deleted to-dos are put back at their old
+positions with their ids, added ones are taken out, changed ones return
+to their old values and lists. No copy of the lists is ever kept, a step
+only holds the to-dos it touched, so deleting a thousand rows is one
+step of a thousand small operations.
+
+Undoing a step is itself a transaction, so it is persisted, synced and
+drawn like any other edit, and its own Change becomes the step that
+redoes it. A to-do changed again since a step was recorded, by a peer
+for instance, is left as it is.
+"""
+
+import threading
+
+from collections import deque
+
+from ..core.Logger import Logger
+from ..core.Transaction import LOCAL_ORIGINS, TransactionError
+
+
+logger = Logger(__name__)
+
+
+# most steps kept on the undo stack
+UNDO_LIMIT = 100
+
+
+def plural(count, noun):
+    """Return "1 to-do" or "2 to-dos"."""
+    return f"{count} {noun}" if count == 1 else f"{count} {noun}s"
+
+
+def describe(change):
+    """Return a short description of a change, for the Undo menu item."""
+    if change.origin not in LOCAL_ORIGINS:
+        return f"changes from {change.origin}"
+    if len(change.lists_added) == 1 and len(change.lists_removed) == 1:
+        (old,), (new,) = change.lists_removed, change.lists_added
+        return f"rename {old} to {new}"
+    parts = [f"add list {name}" for name in sorted(change.lists_added)]
+    parts += [f"delete list {name}" for name in sorted(change.lists_removed)]
+    if not parts:
+        for entries, verb in (
+            (change.added, "add"),
+            (change.updated, "edit"),
+            (change.removed, "delete"),
+        ):
+            if entries:
+                parts.append(f"{verb} {plural(len(entries), 'to-do')}")
+    return ", ".join(parts)
+
+
+def same_todo(a, b):
+    """Return True if two to-dos differ at most in their modified time.
+
+    Undo and redo stamp what they put back as modified now.
+    """
+    return {k: v for k, v in a.items() if k != "modified"} == {
+        k: v for k, v in b.items() if k != "modified"
+    }
+
+
+def inverse(change):
+    """Return the operations taking change back, in the order to apply them.
+
+        ("add_list", name)
+        ("remove", list name, to-do)         if it is still the same to-do
+        ("put", list name, position, to-do)  if no to-do has its id
+        ("delete_list", name)                if it is empty by then
+    """
+    ops = [("add_list", name) for name in sorted(change.lists_removed)]
+    for name, todo in change.added.values():
+        ops.append(("remove", name, todo))
+    for name, todo in change.updated.values():
+        ops.append(("remove", name, todo))
+    for name, todo, index in change.previous.values():
+        ops.append(("put", name, index, todo))
+    ops += [("delete_list", name) for name in sorted(change.lists_added)]
+    return ops
+
+
+class UndoStack:
+    """Undo and redo stacks of inverse operations, fed by committed changes."""
+
+    def __init__(self, db, limit=UNDO_LIMIT):
+        """Create empty stacks for db."""
+        self.db = db
+        self.lock = threading.Lock()
+        # (description, operations), the newest last
+        self.undo_steps = deque(maxlen=limit)
+        self.redo_steps = deque(maxlen=limit)
+        # the thread applying a step, and the step its change gives back
+        self.replaying = None
+        self.replayed = None
+
+    def can_undo(self):
+        """Return the description of the step undo would take back, or None."""
+        with self.lock:
+            return self.undo_steps[-1][0] if self.undo_steps else None
+
+    def can_redo(self):
+        """Return the description of the step redo would apply, or None."""
+        with self.lock:
+            return self.redo_steps[-1][0] if self.redo_steps else None
+
+    def clear(self):
+        """Forget every step."""
+        with self.lock:
+            self.undo_steps.clear()
+            self.redo_steps.clear()
+
+    def apply(self, change):
+        """Record the inverse of a committed Transaction.Change.
+
+        Called under the database write lock. The lists read back at
+        start up are not an edit, archiving has its own restore, and the
+        change made by undo or redo itself goes to the other stack.
+        """
+        if change.origin in ("disk", "archive") or not change:
+            return
+        ops = inverse(change)
+        if not ops:
+            return
+        with self.lock:
+            if self.replaying == threading.get_ident():
+                self.replayed = ops
+                return
+            self.undo_steps.append((describe(change), ops))
+            self.redo_steps.clear()
+
+    def undo(self):
+        """Take back the newest step. Returns (bool, msg)."""
+        return self._replay(self.undo_steps, self.redo_steps, "Undid")
+
+    def redo(self):
+        """Apply the step undone last again. Returns (bool, msg)."""
+        return self._replay(self.redo_steps, self.undo_steps, "Redid")
+
+    def _replay(self, source, target, verb):
+        """Apply the newest step of source, push its inverse on target."""
+        with self.lock:
+            if self.replaying is not None:
+                return False, "An undo is already in progress"
+            if not source:
+                return False, f"Nothing to {verb[:-1].lower()}"
+            label, ops = source.pop()
+            self.replaying = threading.get_ident()
+            self.replayed = None
+
+        try:
+            with self.db.transaction() as txn:
+                skipped = self._queue(txn, ops)
+        except TransactionError as e:
+            msg = f"Unable to undo {label}: {e}"
+            logger.log.warning(msg)
+            with self.lock:
+                self.replaying = None
+            return False, msg
+
+        with self.lock:
+            self.replaying = None
+            if self.replayed is not None:
+                target.append((label, self.replayed))
+
+        msg = f"{verb} {label}"
+        if skipped:
+            msg += f", {plural(skipped, 'to-do')} changed since left as they are"
+        logger.log.info(msg)
+        return True, msg
+
+    def _queue(self, txn, ops):
+        """Queue the operations of a step that still apply.
+
+        Returns the number of to-dos left alone because they changed since.
+        """
+        lists = self.db.snapshot().lists
+        current = {}
+        for name, todos in lists.items():
+            for todo in todos:
+                current[todo["id"]] = (name, todo)
+        existing = set(lists)
+
+        skipped = set()
+        taken = set()
+        puts = {}
+        deletes = []
+        for op in ops:
+            kind, name = op[0], op[1]
+            if kind == "add_list":
+                if name not in existing:
+                    txn.add_list(name)
+                    existing.add(name)
+            elif kind == "remove":
+                todo = op[2]
+                found = current.get(todo["id"])
+                if found is not None and found[0] == name and same_todo(found[1], todo):
+                    txn.delete_todo(name, todo["id"])
+                    taken.add(todo["id"])
+                else:
+                    skipped.add(todo["id"])
+            elif kind == "put":
+                _, _, index, todo = op
+                if name not in existing or todo["id"] in skipped:
+                    skipped.add(todo["id"])
+                elif todo["id"] in current and todo["id"] not in taken:
+                    # added again or changed since it was taken out
+                    skipped.add(todo["id"])
+                else:
+                    puts.setdefault(name, []).append((index, todo))
+            elif kind == "delete_list":
+                deletes.append(name)
+
+        for name, entries in puts.items():
+            txn.restore_todos(name, entries)
+        for name in deletes:
+            if name in lists and all(t["id"] in taken for t in lists[name]):
+                txn.delete_list(name)
+        return len(skipped)
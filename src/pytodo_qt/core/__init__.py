@@ -1,13 +1,17 @@
 """__init__.py
 
-pytodo-qt.core: A decorator to make security checks on the to-do database.
+pytodo-qt.core: Decorators to make security checks on the to-do database
+and to time hot paths.
 """
 
+import functools
 import sys
+import time
 
 from PyQt6.QtWidgets import QMessageBox
 
 from ..core import settings
+from ..core import metrics
 from ..core.Logger import Logger
 
 
@@ -33,3 +37,27 @@ def error_on_none_db(func):
             sys.exit(1)
 
     return wrapper
+
+
+def timed(name):
+    """Record how long func takes in the metrics histogram name.
+
+    When metrics collection is disabled the wrapper only costs a flag check.
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            """Wrap around func and time it if metrics are enabled."""
+            if not metrics.enabled:
+                return func(*args, **kwargs)
+
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                metrics.observe(name, (time.perf_counter() - start) * 1000.0)
+
+        return wrapper
+
+    return decorator
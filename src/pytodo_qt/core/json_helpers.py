@@ -3,24 +3,26 @@ import sys
 
 from pathlib import Path
 
-from ..core import error_on_none_db, settings
+from ..core import error_on_none_db, merge, metrics, settings, timed
 from ..core.Logger import Logger
+from ..core.Transaction import TransactionError, new_todo_id
+from ..crypto.FileCipher import read_file, write_file
 
 
 logger = Logger(__name__)
 
 
 def merge_todo_lists(*todo_lists):
-    """Merge to-do lists keeping only unique entries."""
+    """Merge to-do lists item by item, later versions of a to-do win."""
     logger.log.info("Merging to-do lists")
     new_lists = {}
     for list_entry in todo_lists:
-        for k in list_entry:
-            new_lists[k] = list_entry[k]
+        new_lists, _ = merge.merge_todo_lists(new_lists, list_entry, new_todo_id)
 
     return new_lists
 
 
+@timed("db.read")
 @error_on_none_db
 def read_json_data(fn=settings.db_fn):
     """Read in to-do lists from a JSON file."""
@@ -29,20 +31,55 @@ def read_json_data(fn=settings.db_fn):
         logger.log.warning(msg)
         return False, msg
 
+    # the replica must be in place before the lists, so loading them is
+    # not taken for new local writes
+    if fn == settings.db_fn:
+        settings.DB.replica.load(settings.replica_fn)
+
     logger.log.info("Reading JSON file %s", fn)
     try:
-        with open(fn, "r", encoding="utf-8") as f:
-            # Merge lists
-            if len(settings.DB.todo_lists) > 0:
-                todo_lists = json.load(f)
-                new_lists = merge_todo_lists(settings.DB.todo_lists, todo_lists)
-                settings.DB.todo_lists = new_lists
-            else:
-                settings.DB.todo_lists = json.load(f)
-    except IOError as e:
+        todo_lists = json.loads(read_file(fn, settings.DB.file_cipher))
+    except (IOError, ValueError) as e:
         logger.log.exception("Error reading JSON file %s: %s", fn, e)
         return False, e
 
+    # nothing new to write back to the file we just read, nor to record
+    # in the history
+    if fn == settings.db_fn:
+        result, msg = load_todo_lists(todo_lists, persist=False, origin="disk")
+    else:
+        result, msg = load_todo_lists(todo_lists)
+    if not result:
+        return False, msg
+
+    msg = f"Successfully read JSON file {fn}: {msg}"
+    logger.log.info(f"{msg}")
+    return True, msg
+
+
+@error_on_none_db
+def load_todo_lists(*todo_lists, persist=True, origin="local"):
+    """Merge one or more sets of to-do lists into the database, in order.
+
+    This may be called from a network thread, the merge is a single
+    transaction so readers keep using the previous snapshot until the
+    merged version is published. On success the message summarizes what
+    the merge changed.
+    """
+    if not all(isinstance(lists, dict) for lists in todo_lists):
+        msg = "To-do lists must be a JSON object"
+        logger.log.warning(msg)
+        return False, msg
+
+    try:
+        with settings.DB.transaction(persist=persist, origin=origin) as txn:
+            for lists in todo_lists:
+                txn.merge_lists(lists)
+    except TransactionError as e:
+        msg = f"Invalid to-do lists: {e}"
+        logger.log.warning(msg)
+        return False, msg
+
     # set active list
     if settings.options is not None and "active_list" in settings.options:
         if settings.options["active_list"]:
@@ -59,32 +96,82 @@ def read_json_data(fn=settings.db_fn):
         logger.log.exception("settings.options does not exist, exiting")
         sys.exit(1)
 
-    settings.DB.list_count = len(settings.DB.todo_lists.keys())
-    settings.DB.todo_total = 0
-    for list_entry in settings.DB.todo_lists.values():
-        settings.DB.todo_total += len(list_entry)
+    msg = f"Merged to-do lists: {txn.report}"
+    logger.log.info(msg)
+    return True, msg
 
-    msg = f"Successfully read JSON file {fn}"
-    logger.log.info(f"{msg}")
+
+@error_on_none_db
+def merge_replica_delta(delta, origin="local"):
+    """Merge replica state received from a peer into the database.
+
+    Like load_todo_lists this may run on a network thread.
+    """
+    try:
+        with settings.DB.transaction(origin=origin) as txn:
+            txn.merge_replica(delta)
+    except TransactionError as e:
+        msg = f"Invalid replica state: {e}"
+        logger.log.warning(msg)
+        return False, msg
+
+    if settings.DB.active_list not in settings.DB.todo_lists:
+        for list_entry in settings.DB.todo_lists:
+            settings.DB.active_list = list_entry
+            logger.log.info("%s set as active_list", list_entry)
+            break
+
+    change = txn.change
+    msg = (
+        f"Merged changes: {len(change.added)} to-dos added, "
+        f"{len(change.updated)} updated, {len(change.removed)} removed"
+    )
+    logger.log.info(msg)
     return True, msg
 
 
+@timed("db.write")
 @error_on_none_db
 def write_json_data(fn=settings.db_fn):
-    """Write to-do lists as a JSON file."""
+    """Write to-do lists as a JSON file.
+
+    The lists come from the current immutable snapshot. The database
+    file is saved together with the replica state matching it, both are
+    serialized under the read lock so no commit falls between them. Each
+    is written to a temporary file that atomically replaces it, so
+    concurrent writers can never leave a torn file behind, and encrypted
+    when the database has a file cipher.
+    """
     logger.log.info("Writing JSON file %s", fn)
+    if settings.DB.todo_lists is None:
+        logger.log.exception("settings.db.todo_lists does not exist, exiting")
+        sys.exit(1)
+
+    cipher = settings.DB.file_cipher
+    if cipher is None and settings.options.get("encrypt"):
+        # never replace an encrypted database with plain text
+        msg = f"Not writing JSON file {fn}, the database is encrypted and locked"
+        logger.log.warning(msg)
+        return False, msg
+
     try:
-        with open(fn, "w+", encoding="utf-8") as f:
-            if settings.DB.todo_lists is not None:
-                json.dump(settings.DB.todo_lists, f, indent=2)
-            else:
-                logger.log.exception("settings.db.todo_lists does not exist, exiting")
-                sys.exit(1)
+        with settings.DB.file_lock:
+            # snapshot inside the lock so a later writer never loses to an
+            # older version
+            files = []
+            with settings.DB.lock.read_locked():
+                files.append((fn, settings.DB.serialize(indent=2)))
+                if fn == settings.db_fn:
+                    replica = settings.DB.replica.serialize()
+                    files.append((settings.replica_fn, replica))
+            for path, data in files:
+                write_file(path, data, cipher)
     except IOError as e:
         msg = f"Error writing JSON file {fn}: {e}"
         logger.log.exception(msg)
         return False, msg
 
+    metrics.incr("db.writes")
     msg = f"Successfully wrote JSON file {fn}"
     logger.log.info(msg)
     return True, msg
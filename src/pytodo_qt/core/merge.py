@@ -0,0 +1,137 @@
+"""merge.py
+
+Item level merging of to-do lists received from a sync or an import.
+
+Incoming to-dos are matched to local ones by their stable identifier, or,
+for to-dos from older peers and files that have none, by a hash of their
+reminder within the same list. Matched pairs are resolved with last
+writer wins on the "modified" time stamp of the to-do, ties broken by
+comparing the list and fields themselves so every peer picks the same
+winner. Unmatched to-dos are
+added, nothing local is dropped. Matching uses hash maps, so a merge is
+linear in the number of to-dos.
+"""
+
+import hashlib
+import json
+
+
+# fields resolved by a merge, the list a to-do belongs to is resolved
+# along with them
+MERGED_FIELDS = ("reminder", "priority", "complete", "due")
+
+
+def content_hash(todo):
+    """Return a hash of the normalized reminder of todo."""
+    text = " ".join(str(todo.get("reminder", "")).casefold().split())
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+def version(list_name, todo):
+    """Order two versions of a to-do, later versions compare greater."""
+    fields = {k: todo.get(k) for k in MERGED_FIELDS}
+    return todo.get("modified", 0), list_name, json.dumps(fields, sort_keys=True)
+
+
+class MergeReport:
+    """Counts of what a merge changed."""
+
+    def __init__(self):
+        """Create an empty report."""
+        self.lists_added = 0
+        self.added = 0
+        self.updated = 0
+        self.moved = 0
+        self.kept = 0
+        self.unchanged = 0
+
+    def __bool__(self):
+        return bool(self.lists_added or self.added or self.updated or self.moved)
+
+    def __str__(self):
+        return (
+            f"{self.lists_added} lists added, {self.added} to-dos added, "
+            f"{self.updated} updated, {self.moved} moved, "
+            f"{self.kept} local versions kept, {self.unchanged} unchanged"
+        )
+
+    def update(self, other):
+        """Add the counts of other to this report, return self."""
+        for k, v in vars(other).items():
+            setattr(self, k, getattr(self, k) + v)
+        return self
+
+
+def merge_todo_lists(local, incoming, new_id):
+    """Merge incoming into local item by item.
+
+    local maps list names to sequences of to-dos and is not modified.
+    incoming maps list names to lists of to-dos. new_id is called to
+    identify incoming to-dos that have no identifier. Returns the merged
+    lists and a MergeReport, lists that did not change are returned as the
+    same objects found in local.
+    """
+    report = MergeReport()
+    merged = dict(local)
+    copied = set()
+
+    def touch(name):
+        if name not in copied:
+            merged[name] = list(merged.get(name, ()))
+            copied.add(name)
+        return merged[name]
+
+    # id -> (list name, position), (list name, content hash) -> id
+    by_id = {}
+    by_hash = {}
+    for name, todos in local.items():
+        for i, todo in enumerate(todos):
+            by_id[todo["id"]] = (name, i)
+            by_hash.setdefault((name, content_hash(todo)), todo["id"])
+
+    for name, todos in incoming.items():
+        if name not in merged:
+            touch(name)
+            report.lists_added += 1
+
+        for remote in todos:
+            todo_id = remote.get("id")
+            key = (name, content_hash(remote))
+            if todo_id is None:
+                todo_id = by_hash.get(key)
+
+            if todo_id not in by_id:
+                todo = dict(remote, id=todo_id or new_id())
+                touch(name).append(todo)
+                by_id[todo["id"]] = (name, len(merged[name]) - 1)
+                by_hash.setdefault(key, todo["id"])
+                report.added += 1
+                continue
+
+            local_name, i = by_id[todo_id]
+            current = merged[local_name][i]
+            stamps = remote.get("modified", 0), current.get("modified", 0)
+            if stamps[0] < stamps[1] or (
+                stamps[0] == stamps[1]
+                and version(name, remote) < version(local_name, current)
+            ):
+                report.kept += 1
+                continue
+
+            todo = dict(remote, id=todo_id)
+            if name != local_name:
+                touch(local_name)[i] = None
+                touch(name).append(todo)
+                by_id[todo_id] = (name, len(merged[name]) - 1)
+                report.moved += 1
+            elif todo != current:
+                touch(name)[i] = todo
+                report.updated += 1
+            else:
+                report.unchanged += 1
+
+    for name in copied:
+        if None in merged[name]:
+            merged[name] = [t for t in merged[name] if t is not None]
+
+    return merged, report
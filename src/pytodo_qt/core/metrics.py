@@ -0,0 +1,122 @@
+"""metrics.py
+
+Lightweight hot-path instrumentation: counters and latency histograms.
+
+Collection is off by default, every recording function checks the
+module level enabled flag first and returns immediately when it is unset.
+"""
+
+import json
+import threading
+
+from collections import deque
+
+from ..core import settings
+from ..core.Logger import Logger
+
+
+logger = Logger(__name__)
+
+
+# number of samples kept per histogram for percentile estimates
+HISTOGRAM_SIZE = 2048
+
+enabled = False
+_lock = threading.Lock()
+_counters = {}
+_histograms = {}
+
+
+class Histogram:
+    """Keep a bounded window of samples plus running totals."""
+
+    def __init__(self, size=HISTOGRAM_SIZE):
+        """Create an empty histogram."""
+        self.samples = deque(maxlen=size)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        """Record a sample."""
+        self.samples.append(value)
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, p):
+        """Return the p-th percentile of the retained samples."""
+        if not self.samples:
+            return 0.0
+        ordered = sorted(self.samples)
+        i = min(len(ordered) - 1, int(round(p / 100.0 * (len(ordered) - 1))))
+        return ordered[i]
+
+    def summary(self):
+        """Return a dictionary summary of the histogram."""
+        return {
+            "count": self.count,
+            "mean": self.total / self.count if self.count else 0.0,
+            "p50": self.percentile(50),
+            "p95": self.percentile(95),
+            "max": self.max,
+        }
+
+
+def enable(on=True):
+    """Turn metrics collection on or off."""
+    global enabled
+    enabled = bool(on)
+    logger.log.info("Metrics collection %s", "enabled" if enabled else "disabled")
+
+
+def incr(name, value=1):
+    """Increment counter name by value."""
+    if not enabled:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def observe(name, value):
+    """Add a sample to histogram name."""
+    if not enabled:
+        return
+    with _lock:
+        histogram = _histograms.get(name)
+        if histogram is None:
+            histogram = _histograms[name] = Histogram()
+        histogram.add(value)
+
+
+def reset():
+    """Forget all collected metrics."""
+    with _lock:
+        _counters.clear()
+        _histograms.clear()
+
+
+def snapshot():
+    """Return a copy of all counters and histogram summaries."""
+    with _lock:
+        return {
+            "counters": dict(_counters),
+            "histograms": {k: v.summary() for k, v in _histograms.items()},
+        }
+
+
+def dump_json(fn=settings.metrics_fn):
+    """Write collected metrics to a JSON file."""
+    logger.log.info("Writing metrics to %s", fn)
+    try:
+        with open(fn, "w", encoding="utf-8") as f:
+            json.dump(snapshot(), f, indent=2, sort_keys=True)
+    except IOError as e:
+        msg = f"Error writing metrics file {fn}: {e}"
+        logger.log.exception(msg)
+        return False, msg
+
+    msg = f"Successfully wrote metrics file {fn}"
+    logger.log.info(msg)
+    return True, msg
@@ -7,13 +7,13 @@ import sys
 
 from pathlib import Path
 
+from .. import __version__  # noqa: F401
 from ..core.Logger import Logger
 
 
 logger = Logger(__name__)
 
 
-__version__ = "0.2.8"
 options = {}
 DB = None
 
@@ -35,3 +35,8 @@ if not Path.exists(app_dir):
 # private files
 ini_fn = Path.joinpath(app_dir, "pytodo-qt.ini")
 db_fn = Path.joinpath(app_dir, "pytodo-qt-db.json")
+replica_fn = Path.joinpath(app_dir, "pytodo-qt-replica.json")
+archive_fn = Path.joinpath(app_dir, "pytodo-qt-archive.bin")
+history_fn = Path.joinpath(app_dir, "pytodo-qt-history.bin")
+metrics_fn = Path.joinpath(app_dir, "pytodo-qt-metrics.json")
+socket_fn = Path.joinpath(app_dir, "pytodo-qt.sock")
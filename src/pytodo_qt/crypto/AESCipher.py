@@ -1,21 +1,68 @@
 """AESCipher.py
 
 AES Cipher class for encrypting and decrypting string data.
+
+Data is encrypted with AES-CBC and base64 encoded, which every peer
+understands. Peers that agree on it in their session handshake use the
+chunked mode instead: AES-CTR, whose key stream blocks are independent,
+so a large payload is split into chunks that a thread pool encrypts on
+several cores at once, pycryptodomex releases the GIL while it works.
+Each chunk starts the counter where the previous one ended, so the
+result is exactly one CTR stream over the payload under a random nonce,
+decrypted the same way whatever the chunking or thread count on either
+side. CTR output is not authenticated by itself, sessions MAC every
+frame before it is decrypted.
 """
 
 import base64
 import hashlib
+import hmac
+import os
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
 
 from Cryptodome.Cipher import AES
 from Cryptodome.Random import get_random_bytes
 from Cryptodome.Util.Padding import pad, unpad
 
+from ..core import timed
 from ..core.Logger import Logger
 
 
 logger = Logger(__name__)
 
 
+# length of a MAC in bytes
+MAC_SIZE = 32
+
+# name of the chunked mode in session handshakes
+CHUNKED = "aes-ctr"
+
+# first byte of chunked data, base64 never starts with it, and the nonce
+# prefix length, the rest of each counter block counts blocks
+CHUNKED_MARK = b"\x00"
+NONCE_SIZE = 8
+
+# bytes per chunk, smaller payloads are not worth handing to the pool
+PARALLEL_CHUNK = 256 * 1024
+
+# threads of the pool shared by every cipher, one per core
+POOL_WORKERS = os.cpu_count() or 1
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def shared_pool():
+    """Return the thread pool of every cipher, created on first use."""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(POOL_WORKERS, thread_name_prefix="aes")
+        return _pool
+
+
 def catch_value_error_exception(func):
     """Catch ValueError exceptions."""
 
@@ -34,24 +81,95 @@ def catch_value_error_exception(func):
 class AESCipher:
     """Implement AES Cipher Block Chaining encryption and decryption."""
 
-    def __init__(self, key: str) -> None:
-        """Make a fixed sha256 bit length key."""
+    mac_size = MAC_SIZE
+
+    def __init__(self, key: str, workers=None) -> None:
+        """Make a fixed sha256 bit length key, and a separate key for MACs.
+
+        Chunked data is processed by up to workers threads of the shared
+        pool, by default all of them. Ciphers are made per connection, so
+        none has threads of its own.
+        """
         self.key = hashlib.sha256(key.encode("utf-8")).digest()
+        self.mac_key = hashlib.sha256(b"mac" + key.encode("utf-8")).digest()
+        self.workers = min(workers or POOL_WORKERS, POOL_WORKERS)
+
+    def mac(self, data: bytes) -> bytes:
+        """Return the HMAC-SHA256 of data, MAC_SIZE bytes long."""
+        return hmac.new(self.mac_key, data, hashlib.sha256).digest()
 
+    def verify(self, data: bytes, mac: bytes) -> bool:
+        """Check a MAC cheaply, before spending anything on decrypting data."""
+        return hmac.compare_digest(self.mac(data), mac)
+
+    @timed("crypto.encrypt")
     @catch_value_error_exception
-    def encrypt(self, raw_data: str) -> bytes:
-        """Encrypt raw data."""
+    def encrypt(self, raw_data: str, chunked=False) -> bytes:
+        """Encrypt raw data, with the chunked mode if the peer takes it."""
         logger.log.info("AESCipher: Encrypting data")
+        if chunked:
+            return self.encrypt_chunked(raw_data.encode("utf-8"))
         encoded_data = pad(raw_data.encode("utf-8"), AES.block_size)
         iv = get_random_bytes(AES.block_size)
         cipher = AES.new(self.key, AES.MODE_CBC, iv)
         return base64.b64encode(iv + cipher.encrypt(encoded_data))
 
+    @timed("crypto.decrypt")
     @catch_value_error_exception
     def decrypt(self, encrypted_data: bytes) -> bytes:
         """Decrypt encoded data."""
         logger.log.info("AESCipher: decrypting data")
+        if encrypted_data[:1] == CHUNKED_MARK:
+            return self.decrypt_chunked(encrypted_data)
         decoded_data = base64.b64decode(encrypted_data)
         iv = decoded_data[: AES.block_size]
         cipher = AES.new(self.key, AES.MODE_CBC, iv)
         return unpad(cipher.decrypt(decoded_data[AES.block_size :]), AES.block_size)
+
+    def encrypt_chunked(self, data: bytes) -> bytes:
+        """Encrypt data with AES-CTR under a new random nonce."""
+        nonce = os.urandom(NONCE_SIZE)
+        out = bytearray(1 + NONCE_SIZE + len(data))
+        out[: 1 + NONCE_SIZE] = CHUNKED_MARK + nonce
+        self.ctr(nonce, memoryview(data), memoryview(out)[1 + NONCE_SIZE :])
+        return bytes(out)
+
+    def decrypt_chunked(self, encrypted_data: bytes) -> bytes:
+        """Decrypt data from encrypt_chunked()."""
+        view = memoryview(encrypted_data)
+        nonce = bytes(view[1 : 1 + NONCE_SIZE])
+        if len(nonce) < NONCE_SIZE:
+            raise ValueError("Chunked data is truncated")
+        out = bytearray(len(view) - 1 - NONCE_SIZE)
+        self.ctr(nonce, view[1 + NONCE_SIZE :], memoryview(out))
+        return bytes(out)
+
+    def ctr(self, nonce, src, dst):
+        """Run the CTR key stream of nonce over src into dst, chunk by chunk.
+
+        A chunk starts at block index * PARALLEL_CHUNK / block size, so
+        chunks may run in any order and on any thread.
+        """
+
+        def run(start):
+            end = start + PARALLEL_CHUNK
+            cipher = AES.new(
+                self.key,
+                AES.MODE_CTR,
+                nonce=nonce,
+                initial_value=start // AES.block_size,
+            )
+            cipher.encrypt(src[start:end], output=dst[start:end])
+
+        def run_every(first):
+            for start in starts[first::workers]:
+                run(start)
+
+        starts = range(0, len(src), PARALLEL_CHUNK)
+        workers = min(len(starts), self.workers)
+        if workers < 2:
+            for start in starts:
+                run(start)
+            return
+        # list() waits for every chunk and raises the first error
+        list(shared_pool().map(run_every, range(workers)))
@@ -0,0 +1,255 @@
+"""FileCipher.py
+
+Encryption at rest for the database files.
+
+The key is derived from a passphrase with scrypt, or PBKDF2 where the
+Python build has no scrypt, once per session and cached. Files are
+encrypted in chunks with AES-GCM, so a file is written and read chunk by
+chunk without a second copy of the whole database in flight, and any
+change to a chunk, to their order or a truncated file is detected.
+
+An encrypted file is a header followed by chunks:
+
+    header  magic, KDF, KDF cost, salt, nonce prefix
+    chunk   length (high bit set on the last chunk), ciphertext, tag
+
+Each chunk's nonce is the file's random nonce prefix followed by the
+chunk's index, and the header and length word are authenticated with it.
+"""
+
+import hashlib
+import os
+import struct
+import threading
+
+from pathlib import Path
+
+from Cryptodome.Cipher import AES
+
+from ..core import timed
+from ..core.Logger import Logger
+
+
+logger = Logger(__name__)
+
+
+# environment variable holding the passphrase, instead of asking for it
+PASSPHRASE_ENV = "PYTODO_QT_PASSPHRASE"
+
+# magic, KDF, cost, salt, nonce prefix
+MAGIC = b"PYTODOE\x01"
+HEADER = struct.Struct(">8sBI16s8s")
+
+# ciphertext length of a chunk, the high bit marks the last one
+LENGTH = struct.Struct(">I")
+LAST = 0x80000000
+
+# plaintext bytes per chunk, and bytes of each chunk's GCM tag
+CHUNK_SIZE = 256 * 1024
+TAG_SIZE = 16
+
+# key derivation functions, and their cost: log2 of the scrypt work
+# factor, or PBKDF2 iterations
+KDF_SCRYPT = 1
+KDF_PBKDF2 = 2
+SCRYPT_COST = 17
+PBKDF2_COST = 600_000
+
+# scrypt uses 128 * r * 2 ** cost bytes of memory
+SCRYPT_R = 8
+SCRYPT_MAXMEM = 256 * 1024 * 1024
+
+
+class DecryptionError(ValueError):
+    """An encrypted file can not be read with the passphrase given."""
+
+
+def is_encrypted(fn):
+    """Return True if fn exists and is an encrypted file."""
+    try:
+        with open(fn, "rb") as f:
+            return f.read(len(MAGIC)) == MAGIC
+    except OSError:
+        return False
+
+
+def read_file(fn, cipher=None):
+    """Return the contents of fn as bytes, decrypting them if need be."""
+    with open(fn, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            f.seek(0)
+            return f.read()
+        if cipher is None:
+            raise DecryptionError(f"{fn} is encrypted and no passphrase was given")
+        f.seek(0)
+        return cipher.decrypt_from(f)
+
+
+def write_file(fn, data, cipher=None):
+    """Atomically replace fn with the text data, encrypted if cipher is given.
+
+    The data is written to a temporary file first, so a reader never sees
+    a torn file.
+    """
+    tmp = Path(f"{fn}.tmp")
+    with open(tmp, "wb") as f:
+        if cipher is None:
+            f.write(data.encode("utf-8"))
+        else:
+            cipher.encrypt_to(f, data.encode("utf-8"))
+    os.replace(tmp, fn)
+
+
+class FileCipher:
+    """Encrypt and decrypt files with a key derived from a passphrase."""
+
+    def __init__(self, passphrase: str, kdf=None) -> None:
+        """Keep the passphrase, no key is derived until one is needed."""
+        self.passphrase = passphrase.encode("utf-8")
+        if kdf is None:
+            kdf = KDF_SCRYPT if hasattr(hashlib, "scrypt") else KDF_PBKDF2
+        self.kdf = kdf
+        # (kdf, cost, salt) -> key, every salt seen this session
+        self.keys = {}
+        self.lock = threading.Lock()
+        # the KDF parameters new files are written with
+        self.params = None
+
+    def key(self, kdf, cost, salt):
+        """Return the key for the parameters of a file, deriving it only once."""
+        params = (kdf, cost, salt)
+        with self.lock:
+            if params not in self.keys:
+                self.keys[params] = self.derive(kdf, cost, salt)
+            return self.keys[params]
+
+    @timed("crypto.derive_key")
+    def derive(self, kdf, cost, salt):
+        """Derive a 256 bit key, this is slow on purpose."""
+        logger.log.info("FileCipher: deriving a key")
+        if kdf == KDF_SCRYPT:
+            if cost > 24:
+                raise DecryptionError(f"scrypt cost {cost} is too high")
+            return hashlib.scrypt(
+                self.passphrase,
+                salt=salt,
+                n=2**cost,
+                r=SCRYPT_R,
+                p=1,
+                maxmem=SCRYPT_MAXMEM,
+                dklen=32,
+            )
+        if kdf == KDF_PBKDF2:
+            return hashlib.pbkdf2_hmac("sha256", self.passphrase, salt, cost, 32)
+        raise DecryptionError(f"Unknown key derivation function {kdf}")
+
+    def write_params(self):
+        """Return the parameters to write with, the first file read sets them.
+
+        Reusing them keeps the number of key derivations to one per session.
+        """
+        with self.lock:
+            if self.params is None:
+                cost = SCRYPT_COST if self.kdf == KDF_SCRYPT else PBKDF2_COST
+                self.params = (self.kdf, cost, os.urandom(16))
+            return self.params
+
+    @timed("crypto.file_encrypt")
+    def encrypt_to(self, f, data: bytes):
+        """Write data encrypted to the binary file f, one chunk at a time."""
+        kdf, cost, salt = self.write_params()
+        key = self.key(kdf, cost, salt)
+        # a random prefix per file and the chunk index keep nonces unique
+        # for as long as the key is used
+        prefix = os.urandom(8)
+        header = HEADER.pack(MAGIC, kdf, cost, salt, prefix)
+        f.write(header)
+
+        view = memoryview(data)
+        out = memoryview(bytearray(min(len(view), CHUNK_SIZE)))
+        count = max(1, -(-len(view) // CHUNK_SIZE))
+        for index in range(count):
+            chunk = view[index * CHUNK_SIZE : (index + 1) * CHUNK_SIZE]
+            word = LENGTH.pack(len(chunk) | (LAST if index == count - 1 else 0))
+            cipher = AES.new(key, AES.MODE_GCM, nonce=prefix + LENGTH.pack(index))
+            cipher.update(header + word)
+            cipher.encrypt(chunk, output=out[: len(chunk)])
+            f.write(word)
+            f.write(out[: len(chunk)])
+            f.write(cipher.digest())
+
+    @timed("crypto.file_decrypt")
+    def decrypt_from(self, f, limit=None) -> bytearray:
+        """Read and decrypt the binary file f, or only its first limit chunks.
+
+        Every chunk is read straight into one buffer sized from the file
+        and decrypted in place, json.loads takes the bytearray as it is.
+        Raises DecryptionError as soon as a chunk fails to authenticate.
+        """
+        header = f.read(HEADER.size)
+        if len(header) < HEADER.size:
+            raise DecryptionError("Encrypted file header is truncated")
+        magic, kdf, cost, salt, prefix = HEADER.unpack(header)
+        if magic != MAGIC:
+            raise DecryptionError("Not an encrypted to-do file")
+        key = self.key(kdf, cost, salt)
+
+        # every chunk but the last holds CHUNK_SIZE bytes
+        overhead = LENGTH.size + TAG_SIZE
+        here = f.tell()
+        remaining = f.seek(0, os.SEEK_END) - here
+        f.seek(here)
+        count = max(1, -(-remaining // (CHUNK_SIZE + overhead)))
+        if limit is not None:
+            count = min(count, limit)
+        buf = bytearray(max(0, min(remaining - count * overhead, count * CHUNK_SIZE)))
+        view = memoryview(buf)
+
+        pos = 0
+        for index in range(count):
+            word = f.read(LENGTH.size)
+            if len(word) < LENGTH.size:
+                raise DecryptionError("Encrypted file is truncated")
+            (length,) = LENGTH.unpack(word)
+            last = bool(length & LAST)
+            length &= ~LAST
+            if length > len(buf) - pos or (last and index < count - 1):
+                raise DecryptionError("Encrypted file is damaged")
+            chunk = view[pos : pos + length]
+            if f.readinto(chunk) < length:
+                raise DecryptionError("Encrypted file is truncated")
+            tag = f.read(TAG_SIZE)
+
+            cipher = AES.new(key, AES.MODE_GCM, nonce=prefix + LENGTH.pack(index))
+            cipher.update(header + word)
+            cipher.decrypt(chunk, output=chunk)
+            try:
+                cipher.verify(tag)
+            except ValueError as e:
+                raise DecryptionError(
+                    "Wrong passphrase, or the encrypted file is damaged"
+                ) from e
+            if index == 0:
+                # the passphrase is right, write with the key just derived
+                with self.lock:
+                    if self.params is None:
+                        self.params = (kdf, cost, salt)
+            pos += length
+
+        if limit is None and (not last or pos != len(buf) or f.read(1)):
+            raise DecryptionError("Encrypted file is truncated or damaged")
+        return buf
+
+    def unlock(self, fn) -> bool:
+        """Check the passphrase against the first chunk of an encrypted file.
+
+        The key derived for it is kept, so reading the file costs no
+        second derivation.
+        """
+        try:
+            with open(fn, "rb") as f:
+                self.decrypt_from(f, limit=1)
+        except (OSError, DecryptionError) as e:
+            logger.log.warning("Unable to unlock %s: %s", fn, e)
+            return False
+        return True
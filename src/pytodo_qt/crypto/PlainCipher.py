@@ -0,0 +1,36 @@
+"""PlainCipher.py
+
+A cipher that leaves data as it is, for transports that need none.
+"""
+
+from ..core.Logger import Logger
+
+
+logger = Logger(__name__)
+
+
+class PlainCipher:
+    """Implement the AESCipher interface without encrypting anything.
+
+    Used on the local socket, where only processes of the same user can
+    connect, so data never leaves the machine and needs no protection.
+    """
+
+    # length of a MAC in bytes, there is none
+    mac_size = 0
+
+    def encrypt(self, raw_data: str, chunked=False) -> bytes:
+        """Encode raw data."""
+        return raw_data.encode("utf-8")
+
+    def decrypt(self, encrypted_data: bytes) -> bytes:
+        """Return data as received."""
+        return bytes(encrypted_data)
+
+    def mac(self, data: bytes) -> bytes:
+        """Return an empty MAC."""
+        return b""
+
+    def verify(self, data: bytes, mac: bytes) -> bool:
+        """Accept any data, the socket's permissions authenticate peers."""
+        return True
@@ -0,0 +1,220 @@
+"""benchmark.py
+
+Measure what encryption costs.
+
+    python -m pytodo_qt.crypto.benchmark --sizes 1000,10000,100000
+    python -m pytodo_qt.crypto.benchmark throughput --threads 1,2,4,8
+
+For every database size, generated to-do lists are saved and loaded the
+way the database does it, serialized and written with write_file, read
+with read_file and parsed, once as plain text and once encrypted, and
+the median times are compared. Key derivation is timed on its own, it
+happens once per session and not on every save. The benchmark runs in a
+scratch home directory, so the user's files and log are never touched.
+
+The throughput benchmark encrypts and decrypts one large payload the way
+sync sessions do, with AES-CBC and with the chunked AES-CTR mode spread
+over a growing number of threads, to show how it scales with cores.
+"""
+
+import argparse
+import json
+import logging
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+from pathlib import Path
+
+# to-dos per list in a generated database
+LIST_SIZE = 1000
+
+WORDS = "buy call fix write read plan clean send pay book check email".split()
+
+
+def parse_sizes(text):
+    """Parse "1000,10000" into database sizes."""
+    try:
+        return [int(size) for size in text.split(",")]
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(f"Invalid database sizes {text!r}") from e
+
+
+def parse_threads(text):
+    """Parse "1,2,4" into thread counts."""
+    try:
+        threads = [int(n) for n in text.split(",")]
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(f"Invalid thread counts {text!r}") from e
+    if min(threads) < 1:
+        raise argparse.ArgumentTypeError("Thread counts must be positive")
+    return threads
+
+
+def make_lists(size, seed=0):
+    """Return to-do lists holding size generated to-dos."""
+    rng = random.Random(seed)
+    lists = {}
+    for i in range(size):
+        todo = {
+            "id": f"{rng.getrandbits(64):016x}",
+            "complete": i % 7 == 0,
+            "reminder": " ".join(rng.choice(WORDS) for _ in range(4)) + f" {i}",
+            "priority": i % 3 + 1,
+        }
+        lists.setdefault(f"list {i // LIST_SIZE}", []).append(todo)
+    return lists
+
+
+def median_ms(func, repeat):
+    """Return the median time func takes, in milliseconds."""
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        samples.append((time.perf_counter() - start) * 1000.0)
+    return statistics.median(samples)
+
+
+def measure(size, cipher, path, repeat):
+    """Time saving and loading a database of size to-dos."""
+    from ..crypto.FileCipher import read_file, write_file
+
+    lists = make_lists(size)
+
+    def save(cipher):
+        write_file(path, json.dumps(lists, indent=2), cipher)
+
+    def load(cipher):
+        json.loads(read_file(path, cipher))
+
+    result = {"size": size}
+    for name, c in (("plain", None), ("encrypted", cipher)):
+        result[f"{name}_save"] = median_ms(lambda: save(c), repeat)
+        result[f"{name}_bytes"] = path.stat().st_size
+        result[f"{name}_load"] = median_ms(lambda: load(c), repeat)
+    return result
+
+
+def print_report(kdf_ms, results):
+    """Print one line per database size."""
+    print(f"key derivation, once per session: {kdf_ms:.0f} ms")
+    print(
+        f'{"to-dos":>8}{"MB":>8}{"save ms":>10}{"enc ms":>9}{"+%":>7}'
+        f'{"load ms":>10}{"enc ms":>9}{"+%":>7}'
+    )
+    for r in results:
+        print(
+            f'{r["size"]:>8}{r["plain_bytes"] / 2**20:>8.1f}'
+            f'{r["plain_save"]:>10.1f}{r["encrypted_save"]:>9.1f}'
+            f'{100 * (r["encrypted_save"] / r["plain_save"] - 1):>7.0f}'
+            f'{r["plain_load"]:>10.1f}{r["encrypted_load"]:>9.1f}'
+            f'{100 * (r["encrypted_load"] / r["plain_load"] - 1):>7.0f}'
+        )
+
+
+def throughput(args):
+    """Time AES-CBC, then chunked AES-CTR with every thread count."""
+    from ..crypto.AESCipher import AESCipher
+
+    rng = random.Random(0)
+    text = "".join(rng.choices(WORDS, k=args.megabytes * 2**20 // 5))
+    mb = len(text) / 2**20
+
+    def rate(cipher, chunked):
+        encrypted = cipher.encrypt(text, chunked=chunked)
+        enc_ms = median_ms(lambda: cipher.encrypt(text, chunked=chunked), args.repeat)
+        dec_ms = median_ms(lambda: cipher.decrypt(encrypted), args.repeat)
+        return {"encrypt": mb / enc_ms * 1000.0, "decrypt": mb / dec_ms * 1000.0}
+
+    results = [dict(mode="cbc", threads=1, **rate(AESCipher("benchmark"), False))]
+    for threads in args.threads:
+        cipher = AESCipher("benchmark", workers=threads)
+        results.append(dict(mode="ctr", threads=threads, **rate(cipher, True)))
+
+    print(f"{mb:.0f} MB payload, {os.cpu_count()} cores")
+    print(f'{"mode":<6}{"threads":>8}{"encrypt MB/s":>14}{"decrypt MB/s":>14}')
+    for r in results:
+        print(
+            f'{r["mode"]:<6}{r["threads"]:>8}'
+            f'{r["encrypt"]:>14.0f}{r["decrypt"]:>14.0f}'
+        )
+    return results
+
+
+def run(args, scratch):
+    """Derive a key, then time every database size."""
+    from ..crypto.FileCipher import FileCipher
+
+    cipher = FileCipher("benchmark passphrase")
+    start = time.perf_counter()
+    cipher.key(*cipher.write_params())
+    kdf_ms = (time.perf_counter() - start) * 1000.0
+
+    path = Path(scratch) / "pytodo-qt-db.json"
+    results = [measure(size, cipher, path, args.repeat) for size in args.sizes]
+    print_report(kdf_ms, results)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"kdf_ms": kdf_ms, "results": results}, f, indent=2)
+
+
+def main(argv=None):
+    """Parse the command line and run the benchmark."""
+    argv = sys.argv[1:] if argv is None else argv
+
+    if argv and argv[0] == "throughput":
+        parser = argparse.ArgumentParser(
+            prog="python -m pytodo_qt.crypto.benchmark throughput",
+            description="Compare AES-CBC and chunked AES-CTR throughput",
+        )
+        parser.add_argument(
+            "--threads",
+            type=parse_threads,
+            default=[1, 2, 4, 8],
+            help="comma separated thread counts (default 1,2,4,8)",
+        )
+        parser.add_argument(
+            "--megabytes", type=int, default=64, help="payload size (default 64)"
+        )
+        parser.add_argument(
+            "--repeat", type=int, default=5, help="runs per measurement (default 5)"
+        )
+        parser.add_argument("--json", help="also write the results to this file")
+        args = parser.parse_args(argv[1:])
+        with tempfile.TemporaryDirectory(prefix="pytodo-qt-bench-") as scratch:
+            os.environ["HOME"] = scratch
+            logging.disable(logging.INFO)
+            results = throughput(args)
+        if args.json:
+            with open(args.json, "w", encoding="utf-8") as f:
+                json.dump(results, f, indent=2)
+        return
+
+    parser = argparse.ArgumentParser(
+        prog="python -m pytodo_qt.crypto.benchmark",
+        description="Compare saving and loading plain and encrypted databases",
+    )
+    parser.add_argument(
+        "--sizes",
+        type=parse_sizes,
+        default=[1000, 10000, 100000],
+        help="comma separated database sizes in to-dos (default 1000,10000,100000)",
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=5, help="runs per measurement (default 5)"
+    )
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory(prefix="pytodo-qt-bench-") as scratch:
+        # the package opens its log and settings under the home directory
+        os.environ["HOME"] = scratch
+        run(args, scratch)
+
+
+if __name__ == "__main__":
+    main()
@@ -4,6 +4,7 @@ Simple dialog to create a to-do.
 """
 
 from PyQt6.QtWidgets import (
+    QCheckBox,
     QDialog,
     QLabel,
     QLineEdit,
@@ -15,6 +16,8 @@ from PyQt6.QtWidgets import (
 
 from ..core import error_on_none_db, settings
 from ..core.Logger import Logger
+from ..core.Transaction import TransactionError
+from ..gui.DueDateDialog import due_edit
 
 
 logger = Logger(__name__)
@@ -35,12 +38,24 @@ class AddTodoDialog(QDialog):
         # reminder
         reminder_label = QLabel("Reminder", self)
         self.reminder_field = QLineEdit(self)
+        self.reminder_field.textChanged.connect(self.check_similar)
+
+        # warning about a similar existing to-do
+        self.similar_label = QLabel(self)
+        self.similar_label.setWordWrap(True)
+        self.similar_label.hide()
 
         # priority
         priority_label = QLabel("Priority", self)
         self.priority_field = QComboBox(self)
         self.priority_field.addItems(["Low", "Normal", "High"])
 
+        # optional due date and time
+        self.due_check = QCheckBox("Due", self)
+        self.due_field = due_edit(self)
+        self.due_field.setEnabled(False)
+        self.due_check.toggled.connect(self.due_field.setEnabled)
+
         # add button
         self.add_button = QPushButton("Add to-do", self)
         self.add_button.clicked.connect(self.get_todo)
@@ -49,8 +64,11 @@ class AddTodoDialog(QDialog):
         v_box = QVBoxLayout()
         v_box.addWidget(reminder_label)
         v_box.addWidget(self.reminder_field)
+        v_box.addWidget(self.similar_label)
         v_box.addWidget(priority_label)
         v_box.addWidget(self.priority_field)
+        v_box.addWidget(self.due_check)
+        v_box.addWidget(self.due_field)
         v_box.addWidget(self.add_button)
 
         # set layout and window title
@@ -60,6 +78,20 @@ class AddTodoDialog(QDialog):
 
         logger.log.info("Add to-do dialog created")
 
+    @error_on_none_db
+    def check_similar(self, text, *args, **kwargs):
+        """Warn while typing if the reminder resembles an existing one."""
+        matches = settings.DB.similar_todos(text, limit=1) if text.strip() else []
+        if not matches:
+            self.similar_label.hide()
+            return
+
+        _, _, list_name, reminder = matches[0]
+        self.similar_label.setText(
+            f'Similar to existing item: "{reminder}" in {list_name}'
+        )
+        self.similar_label.show()
+
     @error_on_none_db
     def get_todo(self, *args, **kwargs):
         """Get to-do information and append it to the current list."""
@@ -77,12 +109,17 @@ class AddTodoDialog(QDialog):
             todo["priority"] = 2
         else:
             todo["priority"] = 3
+        if self.due_check.isChecked():
+            todo["due"] = float(self.due_field.dateTime().toSecsSinceEpoch())
 
         # update the database
         if settings.DB.todo_lists is not None and settings.DB.active_list is not None:
-            settings.DB.todo_lists[settings.DB.active_list].append(todo)
-            settings.DB.todo_count += 1
-            settings.DB.todo_total += 1
+            try:
+                with settings.DB.transaction() as txn:
+                    txn.add_todo(settings.DB.active_list, todo)
+            except TransactionError as e:
+                QMessageBox.warning(self, "Add To-Do", str(e))
+                return
         else:
             logger.log.exception(
                 "Error: settings.db.todo_list or setting.db.active list does not exist, exiting"
@@ -0,0 +1,132 @@
+"""ArchiveDialog.py
+
+Simple dialog to search the archive of completed to-dos and restore them.
+"""
+
+from PyQt6.QtWidgets import (
+    QAbstractItemView,
+    QDialog,
+    QHBoxLayout,
+    QLabel,
+    QLineEdit,
+    QPushButton,
+    QTableWidget,
+    QTableWidgetItem,
+    QVBoxLayout,
+    QMessageBox,
+)
+
+from ..core import error_on_none_db, settings
+from ..core.Archive import ArchiveError
+from ..core.Logger import Logger
+
+
+logger = Logger(__name__)
+
+# most archived to-dos shown at once
+RESULT_LIMIT = 500
+
+
+class ArchiveDialog(QDialog):
+    """Search archived to-dos and put the selected ones back in their lists."""
+
+    def __init__(self):
+        """Create a simple dialog.
+
+        Display one row per matching archived to-do.
+        """
+        logger.log.info("Creating an archive dialog")
+
+        super().__init__()
+
+        self.summary_label = QLabel(self)
+
+        self.search_field = QLineEdit(self)
+        self.search_field.setPlaceholderText("Search the archive")
+        self.search_field.textChanged.connect(self.refresh)
+
+        # archived to-dos table
+        self.table = QTableWidget(0, 3, self)
+        self.table.setHorizontalHeaderLabels(["List", "Priority", "Reminder"])
+        self.table.horizontalHeader().setStretchLastSection(True)
+        self.table.setSelectionBehavior(QAbstractItemView.SelectionBehavior.SelectRows)
+        self.table.setEditTriggers(QAbstractItemView.EditTrigger.NoEditTriggers)
+
+        # buttons
+        restore_button = QPushButton("Restore selected", self)
+        restore_button.clicked.connect(self.restore_selected)
+        archive_button = QPushButton("Archive now", self)
+        archive_button.clicked.connect(self.archive_now)
+        close_button = QPushButton("Close", self)
+        close_button.clicked.connect(self.accept)
+
+        h_box = QHBoxLayout()
+        h_box.addWidget(restore_button)
+        h_box.addWidget(archive_button)
+        h_box.addWidget(close_button)
+
+        # create a vertical box layout
+        v_box = QVBoxLayout()
+        v_box.addWidget(self.search_field)
+        v_box.addWidget(self.summary_label)
+        v_box.addWidget(self.table)
+        v_box.addLayout(h_box)
+
+        # set layout and window title
+        self.setLayout(v_box)
+        self.setWindowTitle("Archive")
+        self.setMinimumWidth(600)
+        self.setMinimumHeight(400)
+
+        self.rows = []
+        self.refresh()
+
+        logger.log.info("Archive dialog created")
+
+    @error_on_none_db
+    def refresh(self, *args, **kwargs):
+        """Search the archive and redraw the table."""
+        try:
+            count, self.rows = settings.DB.archive.search(
+                self.search_field.text(), limit=RESULT_LIMIT
+            )
+        except ArchiveError as e:
+            self.rows = []
+            self.table.setRowCount(0)
+            self.summary_label.setText(str(e))
+            return
+
+        self.table.setRowCount(len(self.rows))
+        for i, (_, list_name, reminder, priority, _) in enumerate(self.rows):
+            self.table.setItem(i, 0, QTableWidgetItem(list_name))
+            self.table.setItem(i, 1, QTableWidgetItem(str(priority)))
+            self.table.setItem(i, 2, QTableWidgetItem(reminder))
+
+        self.summary_label.setText(
+            f"{count} of {len(settings.DB.archive)} archived to-dos, "
+            f"{len(self.rows)} shown"
+        )
+
+    @error_on_none_db
+    def restore_selected(self, *args, **kwargs):
+        """Restore the selected to-dos in one transaction."""
+        selected = sorted({index.row() for index in self.table.selectedIndexes()})
+        if not selected:
+            return
+
+        result, msg = settings.DB.archive.restore([self.rows[i][0] for i in selected])
+        if not result:
+            QMessageBox.warning(self, "Restore To-Dos", msg)
+
+        self.refresh()
+
+    @error_on_none_db
+    def archive_now(self, *args, **kwargs):
+        """Archive old completed to-dos without waiting for the next run."""
+        result, msg = settings.DB.archive.archive(settings.options["archive_after"])
+        if result:
+            QMessageBox.information(self, "Archive", msg)
+        else:
+            QMessageBox.warning(self, "Archive", msg)
+
+        self.refresh()
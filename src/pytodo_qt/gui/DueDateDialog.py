@@ -0,0 +1,90 @@
+"""DueDateDialog.py
+
+Simple dialog to pick a due date and time, or none.
+"""
+
+import time
+
+from PyQt6.QtCore import QDateTime
+from PyQt6.QtWidgets import (
+    QDateTimeEdit,
+    QDialog,
+    QHBoxLayout,
+    QLabel,
+    QPushButton,
+    QVBoxLayout,
+)
+
+from ..core.Logger import Logger
+
+
+logger = Logger(__name__)
+
+# a new due time defaults to this many seconds from now
+DEFAULT_WAIT = 3600
+
+
+def due_edit(parent, due=None):
+    """Return a date and time editor showing due, or an hour from now."""
+    edit = QDateTimeEdit(parent)
+    edit.setCalendarPopup(True)
+    edit.setDisplayFormat("yyyy-MM-dd HH:mm")
+    if due is None:
+        due = time.time() + DEFAULT_WAIT
+    edit.setDateTime(QDateTime.fromSecsSinceEpoch(int(due)))
+    return edit
+
+
+def format_due(due):
+    """Return a due time as text for the table and notifications."""
+    return time.strftime("%Y-%m-%d %H:%M", time.localtime(due))
+
+
+class DueDateDialog(QDialog):
+    """Ask for a due date and time, self.due is None once cleared."""
+
+    def __init__(self, due=None):
+        """Create a simple dialog, starting from the current due time if any."""
+        logger.log.info("Creating a due date dialog")
+
+        super().__init__()
+
+        self.due = due
+
+        label = QLabel("Due", self)
+        self.due_field = due_edit(self, due)
+
+        # buttons
+        set_button = QPushButton("Set", self)
+        set_button.clicked.connect(self.set_due)
+        clear_button = QPushButton("No due date", self)
+        clear_button.clicked.connect(self.clear_due)
+        cancel_button = QPushButton("Cancel", self)
+        cancel_button.clicked.connect(self.reject)
+
+        h_box = QHBoxLayout()
+        h_box.addWidget(set_button)
+        h_box.addWidget(clear_button)
+        h_box.addWidget(cancel_button)
+
+        # create a vertical box layout
+        v_box = QVBoxLayout()
+        v_box.addWidget(label)
+        v_box.addWidget(self.due_field)
+        v_box.addLayout(h_box)
+
+        # set layout and window title
+        self.setLayout(v_box)
+        self.setWindowTitle("Due Date")
+
+        logger.log.info("Due date dialog created")
+
+    def set_due(self, *args, **kwargs):
+        """Keep the chosen date and time."""
+        self.due = float(self.due_field.dateTime().toSecsSinceEpoch())
+        self.accept()
+
+    def clear_due(self, *args, **kwargs):
+        """Remove the due date."""
+        self.due = None
+        self.accept()
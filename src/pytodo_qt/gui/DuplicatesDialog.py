@@ -0,0 +1,109 @@
+"""DuplicatesDialog.py
+
+Simple dialog to find and remove near duplicate to-dos across all lists.
+"""
+
+from PyQt6.QtWidgets import (
+    QAbstractItemView,
+    QDialog,
+    QHBoxLayout,
+    QLabel,
+    QPushButton,
+    QTableWidget,
+    QTableWidgetItem,
+    QVBoxLayout,
+    QMessageBox,
+)
+
+from ..core import error_on_none_db, settings
+from ..core.Logger import Logger
+from ..core.Transaction import TransactionError
+
+
+logger = Logger(__name__)
+
+
+class DuplicatesDialog(QDialog):
+    """Show groups of similar reminders and delete the unwanted ones."""
+
+    def __init__(self):
+        """Create a simple dialog.
+
+        Display one row per to-do, grouped by similarity.
+        """
+        logger.log.info("Creating a duplicates dialog")
+
+        super().__init__()
+
+        self.summary_label = QLabel(self)
+
+        # duplicates table
+        self.table = QTableWidget(0, 3, self)
+        self.table.setHorizontalHeaderLabels(["Group", "List", "Reminder"])
+        self.table.horizontalHeader().setStretchLastSection(True)
+        self.table.setSelectionBehavior(QAbstractItemView.SelectionBehavior.SelectRows)
+        self.table.setEditTriggers(QAbstractItemView.EditTrigger.NoEditTriggers)
+
+        # buttons
+        delete_button = QPushButton("Delete selected", self)
+        delete_button.clicked.connect(self.delete_selected)
+        close_button = QPushButton("Close", self)
+        close_button.clicked.connect(self.accept)
+
+        h_box = QHBoxLayout()
+        h_box.addWidget(delete_button)
+        h_box.addWidget(close_button)
+
+        # create a vertical box layout
+        v_box = QVBoxLayout()
+        v_box.addWidget(self.summary_label)
+        v_box.addWidget(self.table)
+        v_box.addLayout(h_box)
+
+        # set layout and window title
+        self.setLayout(v_box)
+        self.setWindowTitle("Find Duplicates")
+        self.setMinimumWidth(600)
+        self.setMinimumHeight(400)
+
+        self.rows = []
+        self.refresh()
+
+        logger.log.info("Duplicates dialog created")
+
+    @error_on_none_db
+    def refresh(self, *args, **kwargs):
+        """Search every list for near duplicates and redraw the table."""
+        groups = settings.DB.find_duplicates()
+
+        self.rows = []
+        for n, group in enumerate(groups, start=1):
+            for todo_id, list_name, reminder in group:
+                self.rows.append((n, todo_id, list_name, reminder))
+
+        self.table.setRowCount(len(self.rows))
+        for i, (n, _, list_name, reminder) in enumerate(self.rows):
+            self.table.setItem(i, 0, QTableWidgetItem(str(n)))
+            self.table.setItem(i, 1, QTableWidgetItem(list_name))
+            self.table.setItem(i, 2, QTableWidgetItem(reminder))
+
+        self.summary_label.setText(
+            f"{len(groups)} groups of similar to-dos, {len(self.rows)} to-dos in total"
+        )
+
+    @error_on_none_db
+    def delete_selected(self, *args, **kwargs):
+        """Delete the selected to-dos in one transaction."""
+        selected = sorted({index.row() for index in self.table.selectedIndexes()})
+        if not selected:
+            return
+
+        try:
+            with settings.DB.transaction() as txn:
+                for i in selected:
+                    _, todo_id, list_name, _ = self.rows[i]
+                    txn.delete_todo(list_name, todo_id)
+        except TransactionError as e:
+            QMessageBox.warning(self, "Delete To-Do", str(e))
+
+        self.refresh()
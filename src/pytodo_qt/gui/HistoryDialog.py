@@ -0,0 +1,189 @@
+"""HistoryDialog.py
+
+Simple dialog to browse the history of changes and restore deleted lists.
+"""
+
+import time
+
+from PyQt6.QtWidgets import (
+    QAbstractItemView,
+    QComboBox,
+    QDialog,
+    QHBoxLayout,
+    QLabel,
+    QPlainTextEdit,
+    QPushButton,
+    QTableWidget,
+    QTableWidgetItem,
+    QVBoxLayout,
+    QMessageBox,
+)
+
+from ..core import error_on_none_db, settings
+from ..core.History import TICK, HistoryError
+from ..core.Logger import Logger
+
+
+logger = Logger(__name__)
+
+# most history entries shown at once
+ENTRY_LIMIT = 500
+
+# words for the history operations
+OP_NAMES = {"L+": "created list", "L-": "deleted list", "+": "added", "~": "changed"}
+
+
+def describe_op(op):
+    """Return a line of text describing one history operation."""
+    kind = op[0]
+    if kind in ("L+", "L-"):
+        return f"{OP_NAMES[kind]} {op[1]}"
+    if kind == "-":
+        return f"deleted a to-do from {op[1]}"
+    return f'{OP_NAMES[kind]} "{op[2]["reminder"]}" in {op[1]}'
+
+
+def summarize_ops(ops):
+    """Return a one line summary of an entry's operations."""
+    counts = {}
+    for op in ops:
+        counts[op[0]] = counts.get(op[0], 0) + 1
+    parts = [f"{counts[k]} {name}" for k, name in OP_NAMES.items() if k in counts]
+    if "-" in counts:
+        parts.append(f'{counts["-"]} deleted')
+    lists = sorted({op[1] for op in ops})
+    return f'{", ".join(parts)} in {", ".join(lists)}'
+
+
+class HistoryDialog(QDialog):
+    """Show recent changes, what changed since one, and restore deleted lists."""
+
+    def __init__(self):
+        """Create a simple dialog.
+
+        Display one row per change, newest first.
+        """
+        logger.log.info("Creating a history dialog")
+
+        super().__init__()
+
+        self.summary_label = QLabel(self)
+
+        # history entries table
+        self.table = QTableWidget(0, 3, self)
+        self.table.setHorizontalHeaderLabels(["Time", "Origin", "Change"])
+        self.table.horizontalHeader().setStretchLastSection(True)
+        self.table.setSelectionBehavior(QAbstractItemView.SelectionBehavior.SelectRows)
+        self.table.setSelectionMode(QAbstractItemView.SelectionMode.SingleSelection)
+        self.table.setEditTriggers(QAbstractItemView.EditTrigger.NoEditTriggers)
+        self.table.itemSelectionChanged.connect(self.show_entry)
+
+        self.details = QPlainTextEdit(self)
+        self.details.setReadOnly(True)
+
+        # buttons
+        since_button = QPushButton("Changes since selected", self)
+        since_button.clicked.connect(self.show_changes_since)
+        self.deleted_lists = QComboBox(self)
+        restore_button = QPushButton("Restore list", self)
+        restore_button.clicked.connect(self.restore_list)
+        close_button = QPushButton("Close", self)
+        close_button.clicked.connect(self.accept)
+
+        h_box = QHBoxLayout()
+        h_box.addWidget(since_button)
+        h_box.addWidget(self.deleted_lists)
+        h_box.addWidget(restore_button)
+        h_box.addWidget(close_button)
+
+        # create a vertical box layout
+        v_box = QVBoxLayout()
+        v_box.addWidget(self.summary_label)
+        v_box.addWidget(self.table)
+        v_box.addWidget(self.details)
+        v_box.addLayout(h_box)
+
+        # set layout and window title
+        self.setLayout(v_box)
+        self.setWindowTitle("History")
+        self.setMinimumWidth(700)
+        self.setMinimumHeight(500)
+
+        self.rows = []
+        self.deleted = []
+        self.refresh()
+
+        logger.log.info("History dialog created")
+
+    @error_on_none_db
+    def refresh(self, *args, **kwargs):
+        """Read the newest entries and deleted lists and redraw."""
+        try:
+            self.rows = settings.DB.history.entries(limit=ENTRY_LIMIT)
+            self.deleted = settings.DB.history.deleted_lists()
+        except HistoryError as e:
+            self.rows, self.deleted = [], []
+            self.summary_label.setText(str(e))
+        else:
+            self.summary_label.setText(f"{len(self.rows)} most recent changes")
+
+        self.table.setRowCount(len(self.rows))
+        for i, (t, origin, ops) in enumerate(self.rows):
+            self.table.setItem(i, 0, QTableWidgetItem(time.ctime(t)))
+            self.table.setItem(i, 1, QTableWidgetItem(origin))
+            self.table.setItem(i, 2, QTableWidgetItem(summarize_ops(ops)))
+
+        self.deleted_lists.clear()
+        for name, t in self.deleted:
+            self.deleted_lists.addItem(f"{name}, deleted {time.ctime(t)}")
+
+    def selected_row(self):
+        """Return the selected entry, or None."""
+        rows = {index.row() for index in self.table.selectedIndexes()}
+        return self.rows[rows.pop()] if rows else None
+
+    def show_entry(self):
+        """Show every operation of the selected entry."""
+        entry = self.selected_row()
+        if entry is not None:
+            self.details.setPlainText("\n".join(describe_op(op) for op in entry[2]))
+
+    @error_on_none_db
+    def show_changes_since(self, *args, **kwargs):
+        """Show how the lists changed from the selected entry until now."""
+        entry = self.selected_row()
+        if entry is None:
+            return
+        try:
+            diff = settings.DB.history.diff(entry[0], time.time())
+        except HistoryError as e:
+            self.details.setPlainText(str(e))
+            return
+
+        lines = [f"Since {time.ctime(entry[0])}:"]
+        lines += [f"created list {name}" for name in diff["lists_added"]]
+        lines += [f"deleted list {name}" for name in diff["lists_removed"]]
+        for name, todo in diff["added"]:
+            lines.append(f'added "{todo["reminder"]}" in {name}')
+        for name, old, new in diff["changed"]:
+            lines.append(
+                f'changed "{old["reminder"]}" to "{new["reminder"]}" in {name}'
+            )
+        for name, todo in diff["removed"]:
+            lines.append(f'deleted "{todo["reminder"]}" from {name}')
+        self.details.setPlainText("\n".join(lines))
+
+    @error_on_none_db
+    def restore_list(self, *args, **kwargs):
+        """Put the chosen deleted list back as it was just before it was deleted."""
+        i = self.deleted_lists.currentIndex()
+        if i < 0:
+            return
+        name, t = self.deleted[i]
+        result, msg = settings.DB.history.restore_list(name, t - TICK / 2)
+        if result:
+            QMessageBox.information(self, "Restore List", msg)
+        else:
+            QMessageBox.warning(self, "Restore List", msg)
+
+        self.refresh()
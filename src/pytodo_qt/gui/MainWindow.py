@@ -3,12 +3,12 @@
 This module implements the GUI for To-Do.
 """
 
+import os
 import sys
 
 from pathlib import Path
 
 from PyQt6 import QtCore
-from PyQt6.QtCore import QPersistentModelIndex
 from PyQt6.QtGui import QAction, QIcon, QFont, QTextDocument
 from PyQt6.QtWidgets import (
     QMainWindow,
@@ -22,19 +22,43 @@ from PyQt6.QtWidgets import (
     QLineEdit,
     QSystemTrayIcon,
     QInputDialog,
+    QTableWidgetItem,
+    QWidget,
 )
 from PyQt6.QtPrintSupport import QPrinter, QPrintDialog
 
-from ..core import error_on_none_db, settings, json_helpers
+from ..core import error_on_none_db, json_helpers, metrics, settings, timed
 from ..core.Logger import Logger
+from ..core.Transaction import TransactionError
 from ..crypto.AESCipher import AESCipher
+from ..crypto.FileCipher import PASSPHRASE_ENV, FileCipher, is_encrypted
 from ..gui.AddTodoDialog import AddTodoDialog
+from ..gui.ArchiveDialog import ArchiveDialog
+from ..gui.DueDateDialog import DueDateDialog, format_due
+from ..gui.DuplicatesDialog import DuplicatesDialog
+from ..gui.HistoryDialog import HistoryDialog
+from ..gui.PeerStatusDialog import PeerStatusDialog
+from ..gui.PerformanceDialog import PerformanceDialog
 from ..gui.SyncDialog import SyncDialog
 from ..net.sync_operations import sync_operations
 
 
 logger = Logger(__name__)
 
+# most search matches drawn in the table at once
+SEARCH_LIMIT = 200
+
+# most to-dos drawn in the next up view, and its entry in the list switcher
+NEXT_UP_LIMIT = 100
+NEXT_UP = "All / Next up"
+
+# changes touching more to-dos than this redraw the whole table
+INCREMENTAL_LIMIT = 200
+
+# milliseconds between runs archiving old completed to-dos and compacting
+# the history
+ARCHIVE_INTERVAL = 3600 * 1000
+
 
 class MainWindow(QMainWindow):
     """This class implements the bulk of the gui functionality in To-Do.
@@ -66,6 +90,14 @@ class MainWindow(QMainWindow):
         self.normal_font.setStrikeOut(False)
 
         # create some actions
+        import_lists = QAction(QIcon(), "Import lists", self)
+        import_lists.triggered.connect(self.import_lists)
+
+        encrypt = QAction(QIcon(), "Encrypt database", self)
+        encrypt.setCheckable(True)
+        encrypt.setChecked(bool(settings.options.get("encrypt")))
+        encrypt.triggered.connect(self.db_encrypt)
+
         printer = QAction(QIcon(), "Print", self)
         printer.setShortcut("Ctrl+P")
         printer.triggered.connect(self.print_list)
@@ -74,6 +106,15 @@ class MainWindow(QMainWindow):
         _quit.setShortcut("Ctrl+Q")
         _quit.triggered.connect(self.close)
 
+        # undo and redo, their text names the step they take back or apply
+        self.undo_action = QAction(QIcon(), "Undo", self)
+        self.undo_action.setShortcut("Ctrl+Z")
+        self.undo_action.triggered.connect(self.undo)
+
+        self.redo_action = QAction(QIcon(), "Redo", self)
+        self.redo_action.setShortcut("Ctrl+Shift+Z")
+        self.redo_action.triggered.connect(self.redo)
+
         # to-do actions
         add = QAction(QIcon("gui/icons/plus.png"), "Add new to-do", self)
         add.setShortcut("+")
@@ -87,6 +128,10 @@ class MainWindow(QMainWindow):
         toggle.setShortcut("%")
         toggle.triggered.connect(self.toggle_todo)
 
+        due = QAction(QIcon(), "Set due date", self)
+        due.setShortcut("Ctrl+D")
+        due.triggered.connect(self.set_due)
+
         # list actions
         list_add = QAction(QIcon("gui/icons/plus.png"), "Add new list", self)
         list_add.setShortcut("Ctrl++")
@@ -105,10 +150,26 @@ class MainWindow(QMainWindow):
         list_switch.setShortcut("Ctrl+L")
         list_switch.triggered.connect(self.switch_list)
 
+        next_up = QAction(QIcon(), "Next up in all lists", self)
+        next_up.setShortcut("Ctrl+N")
+        next_up.triggered.connect(self.show_next_up_view)
+
+        find_duplicates = QAction(QIcon(), "Find duplicates", self)
+        find_duplicates.triggered.connect(self.find_duplicates)
+
+        archive = QAction(QIcon(), "Archive", self)
+        archive.triggered.connect(self.show_archive)
+
+        history = QAction(QIcon(), "History", self)
+        history.triggered.connect(self.show_history)
+
         sync_pull = QAction(QIcon(), "Get lists from a remote host", self)
         sync_pull.setShortcut("F6")
         sync_pull.triggered.connect(self.db_sync_pull)
 
+        sync_peers = QAction(QIcon(), "Peers and background sync", self)
+        sync_peers.triggered.connect(self.show_peers)
+
         sync_push = QAction(QIcon(), "Send lists to a remote host", self)
         sync_push.setShortcut("F7")
         sync_push.triggered.connect(self.db_sync_push)
@@ -136,11 +197,34 @@ class MainWindow(QMainWindow):
         about_qt = QAction(QIcon(), "About Qt", self)
         about_qt.triggered.connect(self.about_qt)
 
+        performance = QAction(QIcon(), "Performance", self)
+        performance.triggered.connect(self.show_performance)
+
+        # search all lists, filtering as the user types
+        self.search_field = QLineEdit(self)
+        self.search_field.setPlaceholderText("Search all lists")
+        self.search_field.setClearButtonEnabled(True)
+        self.search_field.textChanged.connect(self.search_changed)
+
+        self.priority_filter = QComboBox(self)
+        self.priority_filter.addItems(["Any priority", "High", "Normal", "Low"])
+        self.priority_filter.currentIndexChanged.connect(self.search_changed)
+
+        self.status_filter = QComboBox(self)
+        self.status_filter.addItems(["Any status", "Open", "Done"])
+        self.status_filter.currentIndexChanged.connect(self.search_changed)
+
+        find = QAction(QIcon(), "Search", self)
+        find.setShortcut("Ctrl+F")
+        find.triggered.connect(self.search_field.setFocus)
+
         # create a menu bar
         menu_bar = self.menuBar()
         if menu_bar is not None:
             main_menu = menu_bar.addMenu("&Menu")
             if main_menu is not None:
+                main_menu.addAction(import_lists)
+                main_menu.addAction(encrypt)
                 main_menu.addAction(printer)
                 main_menu.addAction(_quit)
             else:
@@ -150,9 +234,13 @@ class MainWindow(QMainWindow):
 
             todo_menu = menu_bar.addMenu("&To-Do")
             if todo_menu is not None:
+                todo_menu.addAction(self.undo_action)
+                todo_menu.addAction(self.redo_action)
                 todo_menu.addAction(add)
                 todo_menu.addAction(delete)
                 todo_menu.addAction(toggle)
+                todo_menu.addAction(due)
+                todo_menu.addAction(find)
             else:
                 msg = "Could not populate to-do menu, exiting"
                 QMessageBox.warning(self, "Creation Error", msg)
@@ -165,6 +253,10 @@ class MainWindow(QMainWindow):
                 list_menu.addAction(list_delete)
                 list_menu.addAction(list_rename)
                 list_menu.addAction(list_switch)
+                list_menu.addAction(next_up)
+                list_menu.addAction(find_duplicates)
+                list_menu.addAction(archive)
+                list_menu.addAction(history)
             else:
                 msg = "Could not populate list menu, exiting"
                 QMessageBox.warning(self, "Creation Error", msg)
@@ -175,6 +267,7 @@ class MainWindow(QMainWindow):
             if sync_menu is not None:
                 sync_menu.addAction(sync_pull)
                 sync_menu.addAction(sync_push)
+                sync_menu.addAction(sync_peers)
             else:
                 msg = "Could not populate sync menu, exiting"
                 QMessageBox.warning(self, "Creation Error", msg)
@@ -198,6 +291,7 @@ class MainWindow(QMainWindow):
             if help_menu is not None:
                 help_menu.addAction(about)
                 help_menu.addAction(about_qt)
+                help_menu.addAction(performance)
             else:
                 msg = "Could not populate help menu, exiting"
                 QMessageBox.warning(self, "Creation Error", msg)
@@ -211,6 +305,10 @@ class MainWindow(QMainWindow):
                 toolbar.addAction(delete)
                 toolbar.addAction(toggle)
                 toolbar.addAction(_quit)
+                toolbar.addSeparator()
+                toolbar.addWidget(self.search_field)
+                toolbar.addWidget(self.priority_filter)
+                toolbar.addWidget(self.status_filter)
             else:
                 msg = "Could not create toolbar, exiting"
                 QMessageBox.warning(self, "Creation Error", msg)
@@ -222,7 +320,11 @@ class MainWindow(QMainWindow):
             logger.log.exception(msg)
             sys.exit(1)
 
-        # create table, set it as central widget
+        # create table, set it as central widget, rows holds the
+        # (list name, to-do id, complete) of each table row, and whether
+        # the table shows the next up view instead of the active list
+        self.rows = []
+        self.next_up_shown = False
         self.table = QTableWidget(self)
         if self.table is not None:
             self.table.insertColumn(0)
@@ -279,14 +381,38 @@ class MainWindow(QMainWindow):
         # create a printer
         self.printer = QPrinter()
 
-        # Refresh after every sync
-        settings.DB.db_client.sync_occurred.connect(self.db_sync_occurred)
+        # Refresh after every sync, syncs and server notices can happen on
+        # network threads so always deliver them through the event loop
+        settings.DB.db_client.sync_occurred.connect(
+            self.db_sync_occurred, QtCore.Qt.ConnectionType.QueuedConnection
+        )
+        settings.DB.notify.connect(
+            self.db_notify, QtCore.Qt.ConnectionType.QueuedConnection
+        )
+        settings.DB.changed.connect(
+            self.db_changed, QtCore.Qt.ConnectionType.QueuedConnection
+        )
+        settings.DB.reminders.fired.connect(self.reminders_due)
 
         # show the window
         self.show()
 
-        # read in to-do data
+        # read in to-do data, asking for the passphrase first if need be
+        self.unlock_database()
         self.read_todo_data()
+        if settings.DB.file_cipher is not None and not is_encrypted(settings.db_fn):
+            self.write_todo_data()
+
+        self.update_undo_actions()
+
+        # move old completed to-dos to the archive now and then, and keep
+        # the history within its limits
+        self.archive_completed()
+        self.compact_history()
+        self.archive_timer = QtCore.QTimer(self)
+        self.archive_timer.timeout.connect(self.archive_completed)
+        self.archive_timer.timeout.connect(self.compact_history)
+        self.archive_timer.start(ARCHIVE_INTERVAL)
 
         logger.log.info("Main window created")
 
@@ -298,7 +424,192 @@ class MainWindow(QMainWindow):
             QIcon(),
             8000,
         )
-        self.refresh()
+
+    @QtCore.pyqtSlot(list)
+    def reminders_due(self, due):
+        """Show the to-dos that just fell due in a tray message."""
+        if len(due) == 1:
+            name, todo = due[0]
+            title, msg = "To-Do Due", f'{todo["reminder"]} ({name})'
+        else:
+            title = f"{len(due)} To-Dos Due"
+            msg = "\n".join(todo["reminder"] for _, todo in due[:5])
+            if len(due) > 5:
+                msg += f"\nand {len(due) - 5} more"
+        self.tray_icon.showMessage(title, msg, QIcon(), 8000)
+
+    @QtCore.pyqtSlot(object)
+    def db_changed(self, change):
+        """Bring the table up to date once for each committed transaction.
+
+        Only the rows of to-dos the change touched are redrawn, changes
+        to other lists just update the progress and status bars.
+        """
+        logger.log.info("Database changed: %s", change)
+        self.update_undo_actions()
+        if self.search_active():
+            self.refresh()
+        elif self.next_up_shown:
+            self.update_next_up(change)
+        elif settings.DB.active_list not in change.lists_changed:
+            self.update_progress_bar(0)
+            self.update_status_bar()
+        elif not self.update_rows(change):
+            self.refresh()
+
+    @timed("gui.update_rows")
+    def update_rows(self, change):
+        """Redraw only the rows of the active list that change touched.
+
+        Returns False if the table has to be redrawn instead.
+        """
+        name = settings.DB.active_list
+        touched = change.added.keys() | change.updated.keys() | change.removed.keys()
+        if (
+            len(touched) > INCREMENTAL_LIMIT
+            or name in change.lists_added | change.lists_removed
+            or self.table.columnCount() != 2
+        ):
+            return False
+
+        if name not in settings.DB.snapshot().lists:
+            return False
+        todos = settings.DB.sorted_list(name)
+
+        # drop the rows of every touched to-do, the others keep their order
+        for i in reversed(range(len(self.rows))):
+            if self.rows[i][1] in touched:
+                self.table.removeRow(i)
+                del self.rows[i]
+
+        # and draw the touched to-dos still in the list where they belong
+        for i, todo in enumerate(todos):
+            if todo["id"] in touched:
+                self.table.insertRow(i)
+                self.set_row(i, name, todo)
+
+        settings.DB.todo_count = len(todos)
+        self.update_progress_bar(0)
+        self.update_status_bar()
+        return [row[1] for row in self.rows] == [todo["id"] for todo in todos]
+
+    def update_next_up(self, change):
+        """Redraw the next up view only if change reaches what it shows."""
+        touched = change.added.keys() | change.updated.keys() | change.removed.keys()
+        shown = [row[1] for row in self.rows]
+        todos = settings.DB.next_todos(NEXT_UP_LIMIT)
+        if shown != [todo["id"] for _, todo in todos] or not touched.isdisjoint(shown):
+            self.refresh()
+        else:
+            self.update_progress_bar(0)
+            self.update_next_up_status(len(todos))
+
+    def update_undo_actions(self):
+        """Name the steps undo and redo would take, disable them if none."""
+        for action, verb, label in (
+            (self.undo_action, "Undo", settings.DB.undo_stack.can_undo()),
+            (self.redo_action, "Redo", settings.DB.undo_stack.can_redo()),
+        ):
+            action.setEnabled(label is not None)
+            action.setText(verb if label is None else f"{verb} {label}")
+
+    @error_on_none_db
+    def undo(self, *args, **kwargs):
+        """Take back the last change, the table follows through db_changed."""
+        result, msg = settings.DB.undo()
+        self.update_undo_actions()
+        if not result:
+            self.update_status_bar(msg)
+
+    @error_on_none_db
+    def redo(self, *args, **kwargs):
+        """Apply the last undone change again."""
+        result, msg = settings.DB.redo()
+        self.update_undo_actions()
+        if not result:
+            self.update_status_bar(msg)
+
+    @QtCore.pyqtSlot(str, str)
+    def db_notify(self, title, msg):
+        """Show a message sent by the database from any thread."""
+        QMessageBox.warning(self, title, msg)
+
+    def ask_passphrase(self, new=False):
+        """Ask for the database passphrase, twice for a new one.
+
+        Returns None if the user gives up.
+        """
+        while True:
+            passphrase, ok = QInputDialog.getText(
+                self,
+                "Database Passphrase",
+                "New passphrase:" if new else "Passphrase:",
+                QLineEdit.EchoMode.Password,
+            )
+            if not ok:
+                return None
+            if not passphrase:
+                continue
+            if not new:
+                return passphrase
+            again, ok = QInputDialog.getText(
+                self,
+                "Database Passphrase",
+                "Repeat the passphrase:",
+                QLineEdit.EchoMode.Password,
+            )
+            if not ok:
+                return None
+            if again == passphrase:
+                return passphrase
+            QMessageBox.warning(self, "Passphrase", "The passphrases do not match")
+
+    def unlock_database(self):
+        """Set up the file cipher of an encrypted database.
+
+        The passphrase comes from the environment or is asked for, and its
+        key is derived once for the whole session. To-Do can not run on a
+        database it can not read, so it exits if the user gives up.
+        """
+        encrypted = is_encrypted(settings.db_fn)
+        if not encrypted and not settings.options["encrypt"]:
+            return
+
+        passphrase = os.environ.get(PASSPHRASE_ENV)
+        while True:
+            if passphrase is None:
+                passphrase = self.ask_passphrase(new=not encrypted)
+            if passphrase is None:
+                logger.log.warning("No passphrase for the encrypted database, exiting")
+                sys.exit(1)
+            cipher = FileCipher(passphrase)
+            if not encrypted or cipher.unlock(settings.db_fn):
+                settings.DB.file_cipher = cipher
+                return
+            QMessageBox.warning(
+                self, "Wrong Passphrase", "Unable to decrypt the to-do database"
+            )
+            passphrase = None
+
+    @error_on_none_db
+    def db_encrypt(self, checked, *args, **kwargs):
+        """Turn encryption of the database files on or off."""
+        cipher = None
+        if checked:
+            passphrase = self.ask_passphrase(new=True)
+            if passphrase is None:
+                self.sender().setChecked(False)
+                return
+            cipher = FileCipher(passphrase)
+
+        self.update_status_bar("Deriving key" if checked else "Writing JSON data")
+        settings.DB.file_cipher = cipher
+        settings.options["encrypt"] = checked
+        settings.DB.write_config()
+        result, msg = json_helpers.write_json_data()
+        if not result:
+            QMessageBox.warning(self, "Write Error", msg)
+        self.update_status_bar()
 
     def read_todo_data(self):
         """Read lists of to-dos from database."""
@@ -344,6 +655,10 @@ class MainWindow(QMainWindow):
             8000,
         )
 
+    def show_peers(self):
+        """Display the saved peers and their background sync state."""
+        PeerStatusDialog(settings.DB.sync_scheduler).exec()
+
     def db_sync_push(self):
         """Push lists to another computer."""
         self.update_progress_bar(0)
@@ -359,6 +674,7 @@ class MainWindow(QMainWindow):
     @error_on_none_db
     def db_update_active_list(self, list_name, *args, **kwargs):
         """Update the active list, and save the configuration."""
+        self.next_up_shown = False
         settings.options["active_list"] = list_name
 
         settings.DB.active_list = list_name
@@ -463,6 +779,7 @@ class MainWindow(QMainWindow):
 
         settings.options["key"] = key
         settings.DB.db_client.aes_cipher = AESCipher(key)
+        settings.DB.db_client.close_sessions()
         settings.DB.db_server.aes_cipher = AESCipher(key)
         if settings.DB.server_running():
             reply = QMessageBox.question(
@@ -492,18 +809,18 @@ class MainWindow(QMainWindow):
                 self.update_status_bar()
                 return
 
-            if list_name not in settings.DB.todo_lists.keys():
-                settings.DB.todo_lists[list_name] = []
-                settings.options["active_list"] = list_name
-                settings.DB.active_list = list_name
-                settings.DB.write_config()
-                self.write_todo_data()
-            else:
-                QMessageBox.warning(
-                    self,
-                    "Duplicate List",
-                    f'A list named "{list_name}" already exists.',
-                )
+            try:
+                with settings.DB.transaction() as txn:
+                    txn.add_list(list_name)
+            except TransactionError as e:
+                QMessageBox.warning(self, "Duplicate List", str(e))
+                self.refresh()
+                return
+
+            settings.options["active_list"] = list_name
+            settings.DB.active_list = list_name
+            settings.DB.write_config()
+            return
 
         self.refresh()
 
@@ -524,8 +841,14 @@ class MainWindow(QMainWindow):
                 self.update_progress_bar()
                 return
 
-            settings.DB.todo_total -= len(settings.DB.todo_lists[list_entry])
-            del settings.DB.todo_lists[list_entry]
+            # a peer may have deleted it while the dialog was open
+            try:
+                with settings.DB.transaction() as txn:
+                    txn.delete_list(list_entry)
+            except TransactionError as e:
+                QMessageBox.warning(self, "Delete List", str(e))
+                self.refresh()
+                return
 
             # use list switcher if there is still more than one list
             if len(settings.DB.todo_lists) > 1:
@@ -533,7 +856,6 @@ class MainWindow(QMainWindow):
             else:
                 for list_entry in settings.DB.todo_lists.keys():
                     self.db_update_active_list(list_entry)
-                    self.write_todo_data()
                     break
         else:
             reply = QMessageBox.question(
@@ -548,9 +870,13 @@ class MainWindow(QMainWindow):
                 self.update_status_bar()
                 return
 
-            settings.DB.todo_total -= settings.DB.todo_count
-            del settings.DB.todo_lists[settings.DB.active_list]
-            settings.DB.list_count -= 1
+            try:
+                with settings.DB.transaction() as txn:
+                    txn.delete_list(settings.DB.active_list)
+            except TransactionError as e:
+                QMessageBox.warning(self, "Delete List", str(e))
+                self.refresh()
+                return
 
             # reset database
             settings.DB.active_list = ""
@@ -580,14 +906,14 @@ class MainWindow(QMainWindow):
             if reply == QMessageBox.StandardButton.No:
                 return
 
-            settings.DB.todo_lists[list_name] = settings.DB.todo_lists[
-                settings.DB.active_list
-            ]
-            del settings.DB.todo_lists[settings.DB.active_list]
-            settings.DB.active_list = list_name
-            settings.DB.write_config()
-            self.write_todo_data()
-            self.refresh()
+            try:
+                with settings.DB.transaction() as txn:
+                    txn.rename_list(settings.DB.active_list, list_name)
+            except TransactionError as e:
+                QMessageBox.warning(self, "Rename List", str(e))
+                return
+
+            self.db_update_active_list(list_name)
 
     @error_on_none_db
     def switch_list(self, *args, **kwargs):
@@ -602,14 +928,78 @@ class MainWindow(QMainWindow):
             return
 
         list_entry, ok = QInputDialog.getItem(
-            self, "Select List", "To-Do Lists: ", list(settings.DB.todo_lists.keys())
+            self,
+            "Select List",
+            "To-Do Lists: ",
+            [NEXT_UP] + list(settings.DB.todo_lists.keys()),
         )
-        if ok:
+        if ok and list_entry == NEXT_UP:
+            self.next_up_shown = True
+        elif ok:
             self.db_update_active_list(list_entry)
             settings.DB.write_config()
 
         self.refresh()
 
+    @error_on_none_db
+    def archive_completed(self, *args, **kwargs):
+        """Archive completed to-dos older than the archive_after option."""
+        result, msg = settings.DB.archive.archive(settings.options["archive_after"])
+        if not result:
+            logger.log.warning(msg)
+
+    @error_on_none_db
+    def show_archive(self, *args, **kwargs):
+        """Search and restore archived to-dos."""
+        ArchiveDialog().exec()
+
+    @error_on_none_db
+    def compact_history(self, *args, **kwargs):
+        """Drop history beyond the history_days and history_max_size options."""
+        result, msg = settings.DB.history.compact(
+            settings.options["history_days"], settings.options["history_max_size"]
+        )
+        if not result:
+            logger.log.warning(msg)
+
+    @error_on_none_db
+    def show_history(self, *args, **kwargs):
+        """Browse the history of changes and restore deleted lists."""
+        HistoryDialog().exec()
+
+    @error_on_none_db
+    def find_duplicates(self, *args, **kwargs):
+        """Find similar to-dos across all lists."""
+        DuplicatesDialog().exec()
+
+    @error_on_none_db
+    def import_lists(self, *args, **kwargs):
+        """Merge to-do lists from a JSON file into the database."""
+        self.update_status_bar("Waiting for input")
+        fn, ok = QInputDialog.getText(
+            self,
+            "Import lists from JSON file",
+            "Enter name of JSON file to import:",
+        )
+        if not ok or not fn:
+            logger.log.warning("Did not get filename to import")
+            self.update_status_bar()
+            return
+
+        fp = Path.home().joinpath(fn)
+
+        self.update_progress_bar(0)
+        self.update_status_bar(f"Importing JSON file {fp}")
+        result, msg = json_helpers.read_json_data(fp)
+        if result:
+            QMessageBox.information(self, "Import Lists", str(msg))
+        else:
+            QMessageBox.warning(self, "Import Error", str(msg))
+
+        self.update_progress_bar()
+        self.update_status_bar()
+        self.refresh()
+
     @error_on_none_db
     def export_list(self, fn=None, *args, **kwargs):
         """Export active list to text file."""
@@ -723,15 +1113,23 @@ class MainWindow(QMainWindow):
                 else:
                     return
 
-        # Get a new to-do from user
+        # Get a new to-do from user, the dialog commits it
         AddTodoDialog().exec()
-        self.write_todo_data()
-        settings.DB.sort_active_list()
-        self.refresh()
+
+    def selected_rows(self):
+        """Return the sorted, distinct rows that have a selected cell."""
+        return sorted({index.row() for index in self.table.selectedIndexes()})
+
+    def sender_row(self):
+        """Return the table row of the cell widget that emitted a signal."""
+        widget = self.sender()
+        if not isinstance(widget, QWidget):
+            return -1
+        return self.table.indexAt(widget.pos()).row()
 
     @error_on_none_db
     def delete_todo(self, *args, **kwargs):
-        """Delete the currently selected to-do."""
+        """Delete the currently selected to-dos in one transaction."""
         self.update_progress_bar(0)
 
         if self.table is None:
@@ -741,73 +1139,83 @@ class MainWindow(QMainWindow):
             sys.exit(1)
         else:
             if self.table.selectionModel().hasSelection():
-                indices = [
-                    QPersistentModelIndex(index)
-                    for index in self.table.selectionModel().selectedIndexes()
-                ]
-                for index in indices:
-                    item = self.table.cellWidget(index.row(), 1)
-                    text = item.text()
-                    todo = settings.DB.todo_index(text)
-                    del settings.DB.todo_lists[settings.DB.active_list][todo]
-                    settings.DB.todo_count -= 1
-                    settings.DB.todo_total -= 1
-                    self.write_todo_data()
-                    self.table.removeRow(index.row())
-                self.refresh()
+                with settings.DB.transaction() as txn:
+                    for row in self.selected_rows():
+                        list_name, todo_id, _ = self.rows[row]
+                        txn.delete_todo(list_name, todo_id)
             else:
                 QMessageBox.warning(self, "Delete To-Do", "No reminders selected.")
 
     @error_on_none_db
     def toggle_todo(self, *args, **kwargs):
-        """Toggle a to-do complete / incomplete."""
+        """Toggle the selected to-dos complete / incomplete."""
         self.update_progress_bar(0)
 
-        for index in self.table.selectedIndexes():
-            item = self.table.cellWidget(index.row(), 1)
-            text = item.text()
-            todo = settings.DB.todo_index(text)
-            if not settings.DB.todo_lists[settings.DB.active_list][todo]["complete"]:
-                settings.DB.todo_lists[settings.DB.active_list][todo]["complete"] = True
-            else:
-                settings.DB.todo_lists[settings.DB.active_list][todo][
-                    "complete"
-                ] = False
+        with settings.DB.transaction() as txn:
+            for row in self.selected_rows():
+                list_name, todo_id, complete = self.rows[row]
+                txn.update_todo(list_name, todo_id, complete=not complete)
 
-            self.write_todo_data()
-            self.refresh()
+    @error_on_none_db
+    def set_due(self, *args, **kwargs):
+        """Set or clear the due date of the selected to-dos."""
+        rows = self.selected_rows()
+        if not rows:
+            QMessageBox.warning(self, "Set Due Date", "No reminders selected.")
+            return
+
+        list_name, todo_id, _ = self.rows[rows[0]]
+        current = None
+        for todo in settings.DB.snapshot().lists.get(list_name, ()):
+            if todo["id"] == todo_id:
+                current = todo.get("due")
+                break
+        dialog = DueDateDialog(current)
+        if not dialog.exec():
+            return
+
+        try:
+            with settings.DB.transaction() as txn:
+                for row in rows:
+                    list_name, todo_id, _ = self.rows[row]
+                    txn.update_todo(list_name, todo_id, due=dialog.due)
+        except TransactionError as e:
+            QMessageBox.warning(self, "Set Due Date", str(e))
 
     @error_on_none_db
     def change_priority(self, *args, **kwargs):
         """Change a to-do's priority."""
-        for index in self.table.selectedIndexes():
-            item_p = self.table.cellWidget(index.row(), 0)
-            item_r = self.table.cellWidget(index.row(), 1)
-
-            text = item_p.currentText()
-            if text == "Low":
-                priority = 3
-            elif text == "Normal":
-                priority = 2
-            else:
-                priority = 1
+        row = self.sender_row()
+        if row < 0:
+            return
 
-            reminder = item_r.text()
-            todo = settings.DB.todo_index(reminder)
-            settings.DB.todo_lists[settings.DB.active_list][todo]["priority"] = priority
-            self.write_todo_data()
-            self.refresh()
+        text = self.table.cellWidget(row, 0).currentText()
+        if text == "Low":
+            priority = 3
+        elif text == "Normal":
+            priority = 2
+        else:
+            priority = 1
+
+        list_name, todo_id, _ = self.rows[row]
+        with settings.DB.transaction() as txn:
+            txn.update_todo(list_name, todo_id, priority=priority)
 
     @error_on_none_db
     def edit_reminder(self, *args, **kwargs):
         """Edit the reminder of a to-do."""
-        for index in self.table.selectedIndexes():
-            item = self.table.cellWidget(index.row(), 1)
-            new_text = item.text()
-            settings.DB.todo_lists[settings.DB.active_list][index.row()][
-                "reminder"
-            ] = new_text
-        self.write_todo_data()
+        row = self.sender_row()
+        if row < 0:
+            return
+
+        new_text = self.table.cellWidget(row, 1).text()
+        list_name, todo_id, _ = self.rows[row]
+        try:
+            with settings.DB.transaction() as txn:
+                txn.update_todo(list_name, todo_id, reminder=new_text)
+        except TransactionError as e:
+            QMessageBox.warning(self, "Edit To-Do", str(e))
+            self.refresh()
 
     def about_app(self):
         """Display a message box with Program/Author information."""
@@ -823,6 +1231,10 @@ class MainWindow(QMainWindow):
         """Display information about Qt."""
         QMessageBox.aboutQt(self, "About Qt")
 
+    def show_performance(self):
+        """Display collected performance metrics."""
+        PerformanceDialog().exec()
+
     def center(self):
         """Place the main window in the center of the screen."""
         qt_rectangle = self.frameGeometry()
@@ -844,15 +1256,16 @@ class MainWindow(QMainWindow):
 
         i = 0
 
-        for list_entry in settings.DB.todo_lists:
-            for todo in settings.DB.todo_lists[list_entry]:
+        snapshot = settings.DB.snapshot()
+        for list_entry in snapshot.lists.values():
+            for todo in list_entry:
                 if todo["complete"]:
                     i += 1
 
         value = i
 
         self.progressBar.reset()
-        self.progressBar.setMaximum(settings.DB.todo_total)
+        self.progressBar.setMaximum(snapshot.todo_total())
         self.progressBar.setValue(value)
 
     @error_on_none_db
@@ -870,6 +1283,7 @@ class MainWindow(QMainWindow):
 
         self.statusBarLabel.setText(text)
 
+    @timed("gui.refresh")
     @error_on_none_db
     @QtCore.pyqtSlot(int)
     def refresh(self, sync_occurred=0, *args, **kwargs):
@@ -881,60 +1295,139 @@ class MainWindow(QMainWindow):
 
         # clear the table
         self.table.setRowCount(0)
+        self.rows = []
+
+        # searches show matches from every list
+        if self.search_active():
+            self.show_search_results()
+            return
+
+        # the next up view shows the most urgent to-dos of every list
+        if self.next_up_shown:
+            self.show_next_up()
+            return
 
         # set the table headers
+        self.table.setColumnCount(2)
         self.table.setHorizontalHeaderLabels(["Priority", "Reminder"])
 
         # make sure we have a valid active list
-        if settings.DB.active_list not in settings.DB.todo_lists:
+        if settings.DB.active_list not in settings.DB.snapshot().lists:
             self.update_status_bar()
             return
 
-        # add each to-do in the list to the table, show a progress bar
-        i = 0
-        settings.DB.sort_active_list()
-
         # update the progress bar
         self.update_progress_bar(0)
 
-        for todo in settings.DB.todo_lists[settings.DB.active_list]:
-            # create priority table item
-            item_p = QComboBox(self)
-            item_p.addItems(["Low", "Normal", "High"])
-            item_p.currentIndexChanged.connect(self.change_priority)
-            if todo["priority"] == 1:
-                item_p.setCurrentIndex(2)
-            elif todo["priority"] == 2:
-                item_p.setCurrentIndex(1)
-            else:
-                item_p.setCurrentIndex(0)
+        # draw a sorted copy of an immutable snapshot, a sync merge may be
+        # running and drawing never reorders the list itself
+        todos = settings.DB.sorted_list(settings.DB.active_list)
+        settings.DB.todo_count = len(todos)
 
-            # create reminder table item
-            item_r = QLineEdit(todo["reminder"])
-            item_r.returnPressed.connect(self.edit_reminder)
-
-            # set the font
-            if todo["complete"] is True:
-                item_r.setFont(self.complete_font)
-            else:
-                item_r.setFont(self.normal_font)
-
-            # put the items in the table
-            row_count = self.table.rowCount()
-            assert row_count == i
-            self.table.insertRow(i)
-            self.table.setCellWidget(i, 0, item_p)
-            self.table.setCellWidget(i, 1, item_r)
-            i += 1
-
-        # update the database todo_count
-        settings.DB.todo_count = len(settings.DB.todo_lists[settings.DB.active_list])
-        settings.DB.list_count = len(settings.DB.todo_lists.keys())
+        # size the table once, inserting rows one at a time is quadratic
+        self.table.setRowCount(len(todos))
+        for i, todo in enumerate(todos):
+            self.set_row(i, settings.DB.active_list, todo)
 
         # update progress and status bars
         self.update_progress_bar()
         self.update_status_bar()
 
+    def set_row(self, i, list_name, todo, show_list=False):
+        """Draw a to-do of list_name in row i of the table."""
+        # create priority table item
+        item_p = QComboBox(self)
+        item_p.addItems(["Low", "Normal", "High"])
+        if todo["priority"] == 1:
+            item_p.setCurrentIndex(2)
+        elif todo["priority"] == 2:
+            item_p.setCurrentIndex(1)
+        else:
+            item_p.setCurrentIndex(0)
+        item_p.currentIndexChanged.connect(self.change_priority)
+
+        # create reminder table item
+        item_r = QLineEdit(todo["reminder"])
+        item_r.returnPressed.connect(self.edit_reminder)
+
+        # set the font
+        if todo["complete"] is True:
+            item_r.setFont(self.complete_font)
+        else:
+            item_r.setFont(self.normal_font)
+        if todo.get("due") is not None:
+            item_r.setToolTip(f'Due {format_due(todo["due"])}')
+
+        # put the items in the table
+        self.table.setCellWidget(i, 0, item_p)
+        self.table.setCellWidget(i, 1, item_r)
+        if show_list:
+            self.table.setItem(i, 2, QTableWidgetItem(list_name))
+        self.rows.insert(i, (list_name, todo["id"], todo["complete"]))
+
+    def search_changed(self, *args, **kwargs):
+        """Redraw the table when the search text or a filter changes."""
+        self.refresh()
+
+    def search_active(self):
+        """Return True if the search box or filters restrict the view."""
+        return bool(
+            self.search_field.text().strip()
+            or self.priority_filter.currentIndex()
+            or self.status_filter.currentIndex()
+        )
+
+    def show_search_results(self):
+        """Fill the table with matches from every list."""
+        self.table.setColumnCount(3)
+        self.table.setHorizontalHeaderLabels(["Priority", "Reminder", "List"])
+
+        priority = [None, 1, 2, 3][self.priority_filter.currentIndex()]
+        complete = [None, False, True][self.status_filter.currentIndex()]
+        count, results = settings.DB.search(
+            self.search_field.text(), priority, complete, SEARCH_LIMIT
+        )
+        self.table.setRowCount(len(results))
+        for i, (todo_id, list_name, reminder, priority, complete) in enumerate(results):
+            todo = {
+                "id": todo_id,
+                "reminder": reminder,
+                "priority": priority,
+                "complete": complete,
+            }
+            self.set_row(i, list_name, todo, show_list=True)
+
+        if count > len(results):
+            self.update_status_bar(f"Showing {len(results)} of {count} matches")
+        else:
+            self.update_status_bar(f"{count} matches")
+
+    def show_next_up_view(self, *args, **kwargs):
+        """Show the most urgent open to-dos of every list.
+
+        The active list and the configuration stay as they are.
+        """
+        self.next_up_shown = True
+        self.refresh()
+
+    def show_next_up(self):
+        """Fill the table with the most urgent open to-dos of every list."""
+        self.table.setColumnCount(4)
+        self.table.setHorizontalHeaderLabels(["Priority", "Reminder", "List", "Due"])
+
+        todos = settings.DB.next_todos(NEXT_UP_LIMIT)
+        self.table.setRowCount(len(todos))
+        for i, (list_name, todo) in enumerate(todos):
+            self.set_row(i, list_name, todo, show_list=True)
+            if todo.get("due") is not None:
+                self.table.setItem(i, 3, QTableWidgetItem(format_due(todo["due"])))
+
+        self.update_next_up_status(len(todos))
+
+    def update_next_up_status(self, shown):
+        """Show how many of the open to-dos the next up view holds."""
+        self.update_status_bar(f"Next up, {shown} of {len(settings.DB.next_up)} open")
+
     def tray_event(self, reason=QSystemTrayIcon.activated):
         """Hide the main window when the system tray icon is clicked."""
         if reason == QSystemTrayIcon.activated:
@@ -943,6 +1436,14 @@ class MainWindow(QMainWindow):
             else:
                 self.show()
 
+    def raise_window(self):
+        """Bring the window to the front, shown and restored if need be."""
+        state = self.windowState() & ~QtCore.Qt.WindowState.WindowMinimized
+        self.setWindowState(state | QtCore.Qt.WindowState.WindowActive)
+        self.show()
+        self.raise_()
+        self.activateWindow()
+
     @error_on_none_db
     def closeEvent(self, event, *args, **kwargs):
         """Take care of clean up details."""
@@ -956,9 +1457,15 @@ class MainWindow(QMainWindow):
         self.write_todo_data()
         settings.DB.write_config()
 
-        # shutdown database network server
+        # stop background syncs, then the database network server
+        settings.DB.sync_scheduler.stop()
+        settings.DB.db_client.close_sessions()
         if settings.DB.server_running():
-            settings.DB.db_server.shutdown()
+            settings.DB.stop_server()
+
+        # save performance metrics
+        if settings.options["dump_at_exit"]:
+            metrics.dump_json()
 
         # hide the tray icon
         self.tray_icon.hide()
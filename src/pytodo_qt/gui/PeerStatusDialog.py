@@ -0,0 +1,135 @@
+"""PeerStatusDialog.py
+
+Simple dialog to manage sync peers and show how their syncs are going.
+"""
+
+import time
+
+from PyQt6.QtWidgets import (
+    QAbstractItemView,
+    QDialog,
+    QHBoxLayout,
+    QInputDialog,
+    QPushButton,
+    QTableWidget,
+    QTableWidgetItem,
+    QVBoxLayout,
+)
+
+from ..core import settings
+from ..core.Logger import Logger
+from ..net.SyncScheduler import format_peer, parse_peers
+
+
+logger = Logger(__name__)
+
+
+class PeerStatusDialog(QDialog):
+    """Show the sync state of every saved peer."""
+
+    def __init__(self, scheduler):
+        """Create a simple dialog.
+
+        Display one row per peer, redrawn whenever a sync starts or ends.
+        """
+        logger.log.info("Creating a peer status dialog")
+
+        super().__init__()
+
+        self.scheduler = scheduler
+        self.hosts = []
+
+        # peer table
+        self.table = QTableWidget(0, 6, self)
+        self.table.setHorizontalHeaderLabels(
+            ["Peer", "Last sync", "Latency (ms)", "Bytes", "Failures", "Status"]
+        )
+        self.table.horizontalHeader().setStretchLastSection(True)
+        self.table.setSelectionBehavior(QAbstractItemView.SelectionBehavior.SelectRows)
+        self.table.setEditTriggers(QAbstractItemView.EditTrigger.NoEditTriggers)
+
+        # buttons
+        add_button = QPushButton("Add peer", self)
+        add_button.clicked.connect(self.add_peer)
+        remove_button = QPushButton("Remove peer", self)
+        remove_button.clicked.connect(self.remove_peer)
+        sync_button = QPushButton("Sync now", self)
+        sync_button.clicked.connect(self.sync_now)
+        close_button = QPushButton("Close", self)
+        close_button.clicked.connect(self.accept)
+
+        h_box = QHBoxLayout()
+        h_box.addWidget(add_button)
+        h_box.addWidget(remove_button)
+        h_box.addWidget(sync_button)
+        h_box.addWidget(close_button)
+
+        # create a vertical box layout
+        v_box = QVBoxLayout()
+        v_box.addWidget(self.table)
+        v_box.addLayout(h_box)
+
+        # set layout and window title
+        self.setLayout(v_box)
+        self.setWindowTitle("Sync Peers")
+        self.setMinimumWidth(750)
+        self.setMinimumHeight(300)
+
+        self.scheduler.status_changed.connect(self.refresh)
+        self.refresh()
+
+        logger.log.info("Peer status dialog created")
+
+    def done(self, result):
+        """Stop following the scheduler once closed."""
+        self.scheduler.status_changed.disconnect(self.refresh)
+        super().done(result)
+
+    def refresh(self, *args, **kwargs):
+        """Redraw the table from the scheduler's peer states."""
+        self.hosts = list(self.scheduler.peers)
+        self.table.setRowCount(len(self.hosts))
+        for i, host in enumerate(self.hosts):
+            status = self.scheduler.peers[host]
+            if status.last_sync is None:
+                last_sync = "Never"
+            else:
+                last_sync = time.strftime("%X", time.localtime(status.last_sync))
+            cells = [
+                format_peer(host),
+                last_sync,
+                "" if status.latency is None else f"{status.latency:.0f}",
+                "" if status.bytes is None else str(status.bytes),
+                str(status.failures),
+                status.message,
+            ]
+            for j, text in enumerate(cells):
+                self.table.setItem(i, j, QTableWidgetItem(text))
+
+    def selected_hosts(self):
+        """Return the peers with a selected row."""
+        rows = {index.row() for index in self.table.selectedIndexes()}
+        return [self.hosts[i] for i in sorted(rows)]
+
+    def add_peer(self, *args, **kwargs):
+        """Ask for a host[:port] and save it as a peer."""
+        text, ok = QInputDialog.getText(
+            self, "Add Peer", "Host address[:port], or unix:socket path:"
+        )
+        if not ok:
+            return
+        for host in parse_peers(text, settings.options["port"]):
+            self.scheduler.add_peer(host)
+
+    def remove_peer(self, *args, **kwargs):
+        """Forget the selected peers."""
+        for host in self.selected_hosts():
+            self.scheduler.remove_peer(host)
+
+    def sync_now(self, *args, **kwargs):
+        """Pull from the selected peers now, or from all of them."""
+        hosts = self.selected_hosts()
+        if not hosts:
+            self.scheduler.sync_now()
+        for host in hosts:
+            self.scheduler.sync_now(host)
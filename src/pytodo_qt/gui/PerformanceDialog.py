@@ -0,0 +1,127 @@
+"""PerformanceDialog.py
+
+Simple dialog to display collected performance metrics.
+"""
+
+from PyQt6.QtWidgets import (
+    QDialog,
+    QCheckBox,
+    QHBoxLayout,
+    QLabel,
+    QPushButton,
+    QTableWidget,
+    QTableWidgetItem,
+    QVBoxLayout,
+    QMessageBox,
+)
+
+from ..core import metrics, settings
+from ..core.Logger import Logger
+
+
+logger = Logger(__name__)
+
+
+class PerformanceDialog(QDialog):
+    """Show latency histograms and counters."""
+
+    def __init__(self):
+        """Create a simple dialog.
+
+        Display a table of timings and a table of counters.
+        """
+        logger.log.info("Creating a performance dialog")
+
+        super().__init__()
+
+        # collection toggle
+        self.collect_box = QCheckBox("Collect metrics", self)
+        self.collect_box.setChecked(metrics.enabled)
+        self.collect_box.toggled.connect(self.toggle_collection)
+
+        # latency table
+        timings_label = QLabel("Latencies (ms)", self)
+        self.timings_table = QTableWidget(0, 5, self)
+        self.timings_table.setHorizontalHeaderLabels(
+            ["Operation", "Count", "p50", "p95", "Max"]
+        )
+        self.timings_table.horizontalHeader().setStretchLastSection(True)
+
+        # counters table
+        counters_label = QLabel("Counters", self)
+        self.counters_table = QTableWidget(0, 2, self)
+        self.counters_table.setHorizontalHeaderLabels(["Counter", "Value"])
+        self.counters_table.horizontalHeader().setStretchLastSection(True)
+
+        # buttons
+        refresh_button = QPushButton("Refresh", self)
+        refresh_button.clicked.connect(self.refresh)
+        reset_button = QPushButton("Reset", self)
+        reset_button.clicked.connect(self.reset)
+        dump_button = QPushButton("Dump to JSON", self)
+        dump_button.clicked.connect(self.dump)
+        close_button = QPushButton("Close", self)
+        close_button.clicked.connect(self.accept)
+
+        h_box = QHBoxLayout()
+        h_box.addWidget(refresh_button)
+        h_box.addWidget(reset_button)
+        h_box.addWidget(dump_button)
+        h_box.addWidget(close_button)
+
+        # create a vertical box layout
+        v_box = QVBoxLayout()
+        v_box.addWidget(self.collect_box)
+        v_box.addWidget(timings_label)
+        v_box.addWidget(self.timings_table)
+        v_box.addWidget(counters_label)
+        v_box.addWidget(self.counters_table)
+        v_box.addLayout(h_box)
+
+        # set layout and window title
+        self.setLayout(v_box)
+        self.setWindowTitle("Performance")
+        self.setMinimumWidth(600)
+        self.setMinimumHeight(500)
+
+        self.refresh()
+
+        logger.log.info("Performance dialog created")
+
+    def toggle_collection(self, checked):
+        """Turn metrics collection on or off."""
+        settings.options["collect"] = checked
+        metrics.enable(checked)
+
+    def refresh(self, *args, **kwargs):
+        """Redraw both tables from a metrics snapshot."""
+        data = metrics.snapshot()
+
+        histograms = data["histograms"]
+        self.timings_table.setRowCount(len(histograms))
+        for i, name in enumerate(sorted(histograms)):
+            summary = histograms[name]
+            self.timings_table.setItem(i, 0, QTableWidgetItem(name))
+            self.timings_table.setItem(i, 1, QTableWidgetItem(str(summary["count"])))
+            for j, k in enumerate(("p50", "p95", "max"), start=2):
+                item = QTableWidgetItem(f"{summary[k]:.3f}")
+                self.timings_table.setItem(i, j, item)
+
+        counters = data["counters"]
+        self.counters_table.setRowCount(len(counters))
+        for i, name in enumerate(sorted(counters)):
+            self.counters_table.setItem(i, 0, QTableWidgetItem(name))
+            self.counters_table.setItem(i, 1, QTableWidgetItem(str(counters[name])))
+
+    def reset(self, *args, **kwargs):
+        """Clear collected metrics."""
+        metrics.reset()
+        self.refresh()
+
+    def dump(self, *args, **kwargs):
+        """Write collected metrics to the metrics JSON file."""
+        result, msg = metrics.dump_json()
+        if result:
+            QMessageBox.information(self, "Performance", msg)
+        else:
+            QMessageBox.warning(self, "Write Error", msg)
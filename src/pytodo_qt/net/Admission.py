@@ -0,0 +1,119 @@
+"""Admission.py
+
+Admission control for the sync server.
+
+Cheap checks that run before a request costs the server anything: a
+token bucket per peer address limits how often a peer may connect and
+send requests, a cap on open connections bounds the number of server
+threads, and a cap on concurrent transfers bounds the work spent
+serializing and merging to-do lists. Every refusal is counted.
+"""
+
+import threading
+import time
+
+from contextlib import contextmanager
+
+from ..core import metrics
+from ..core.Logger import Logger
+
+
+logger = Logger(__name__)
+
+
+# [server] options and their defaults: requests per second and burst
+# allowed per peer, open connections, transfers served at once, and the
+# largest request accepted, in bytes
+SERVER_LIMITS = {
+    "rate_limit": 5,
+    "rate_burst": 20,
+    "max_connections": 64,
+    "max_transfers": 4,
+    "max_request_size": 1024 * 1024,
+}
+
+# most peer addresses tracked at once, idle ones are forgotten first
+MAX_BUCKETS = 4096
+
+
+class Admission:
+    """Decide whether the server takes on a connection or a request."""
+
+    def __init__(self, rate, burst, max_connections, max_transfers):
+        """Admit rate requests per second per peer, bursts of up to burst.
+
+        A rate of 0 disables the per peer limit.
+        """
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.max_connections = max_connections
+        self.connections = 0
+        self.transfers = threading.BoundedSemaphore(max(max_transfers, 1))
+        self.lock = threading.Lock()
+        # peer address -> (tokens, time of last refill)
+        self.buckets = {}
+        # reason -> requests refused for it, counted even without metrics
+        self.rejected = {}
+
+    def reject(self, reason, peer):
+        """Count a refused connection or request."""
+        with self.lock:
+            self.rejected[reason] = self.rejected.get(reason, 0) + 1
+        metrics.incr(f"server.rejected.{reason}")
+        logger.log.warning("Rejected a request from %s: %s", peer, reason)
+
+    def allow(self, address):
+        """Take a token from the bucket of address, return False if it is empty."""
+        if self.rate <= 0:
+            return True
+
+        now = time.monotonic()
+        with self.lock:
+            tokens, last = self.buckets.get(address, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            if tokens < 1:
+                self.buckets[address] = (tokens, now)
+                return False
+            self.buckets[address] = (tokens - 1, now)
+            if len(self.buckets) > MAX_BUCKETS:
+                self.forget(now)
+        return True
+
+    def forget(self, now):
+        """Drop the buckets that have refilled, they hold no state."""
+        for address, (tokens, last) in list(self.buckets.items()):
+            if tokens + (now - last) * self.rate >= self.burst:
+                del self.buckets[address]
+
+    def connect(self, address):
+        """Admit a new connection from address, return False to refuse it."""
+        if not self.allow(address):
+            self.reject("rate", address)
+            return False
+        with self.lock:
+            if self.connections >= self.max_connections:
+                full = True
+            else:
+                full = False
+                self.connections += 1
+        if full:
+            self.reject("connections", address)
+            return False
+        return True
+
+    def disconnect(self):
+        """Release the connection slot of a finished connection."""
+        with self.lock:
+            self.connections -= 1
+
+    @contextmanager
+    def transfer(self, peer):
+        """Hold one of the transfer slots, yield False if all are busy."""
+        if not self.transfers.acquire(blocking=False):
+            self.reject("busy", peer)
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            self.transfers.release()
@@ -0,0 +1,654 @@
+"""Session.py
+
+Persistent, multiplexed sync sessions between two peers.
+
+A session starts like any other request, the client sends an encrypted
+SESSION request followed by its MAC, so an older server simply closes the
+connection and the client falls back to connecting once per operation.
+From then on both sides exchange length prefixed, encrypted JSON frames
+over the same connection, each carrying a MAC that is checked before it
+is decrypted, so a peer without the key costs a server little. Every
+request carries an id that its reply echoes, so several requests can be
+in flight at once and either side can send them.
+
+Requests are PULL_REQUEST, answered with a replica delta like a one off
+pull, PUSH_DATA, carrying our delta inline instead of asking the peer to
+connect back and pull, PING, which the client sends while idle to keep
+the connection, and any NAT mapping along its way, alive, and SUBSCRIBE.
+Once a subscription is accepted both ends stream their changes to each
+other as CHANGES messages, which expect no reply, see ChangeStream.
+Payloads too large for one frame are offered instead and fetched by the
+receiver with CHUNK requests, see Transfer.
+
+Peers that both offer it in the handshake encrypt their frames with the
+chunked mode of AESCipher, which spreads large frames over every core,
+others keep the mode every peer understands.
+
+Processes on the same machine can hold sessions over the server's local
+socket, a host given as a path instead of (address, port). The protocol
+is the same, only the frames are neither encrypted nor signed.
+"""
+
+import base64
+import contextlib
+import itertools
+import json
+import socket
+import struct
+import threading
+import time
+
+from PyQt6 import QtCore
+
+from ..core import json_helpers, metrics, settings
+from ..core.Logger import Logger
+from ..crypto.AESCipher import CHUNKED
+from ..net.Transfer import CHUNK_SIZE, Download, TransferError, offers
+from ..net.sync_operations import sync_operations
+
+
+logger = Logger(__name__)
+
+
+# seconds between keepalives from an idle client
+KEEPALIVE = 30
+
+# seconds a server waits on a silent client before closing its session
+IDLE_TIMEOUT = 3 * KEEPALIVE
+
+# seconds a client keeps an unused session open
+LINGER = 900
+
+# largest frame accepted, in bytes
+MAX_FRAME = 256 * 1024 * 1024
+
+# seconds to gather changes before streaming them to subscribers
+BATCH_DELAY = 0.005
+
+FRAME_HEADER = struct.Struct(">I")
+
+
+class SessionError(OSError):
+    """Raised when a session breaks or a peer does not speak the protocol."""
+
+
+class AuthError(SessionError):
+    """Raised when a frame fails authentication, the peer has another key."""
+
+
+class Refused(OSError):
+    """Raised when a server turns a session down, it is busy or limits us."""
+
+
+class Idle(Exception):
+    """Raised when nothing arrived on a session within its timeout."""
+
+
+def recv_exact(sock, size, idle_ok=False):
+    """Read exactly size bytes from sock.
+
+    If idle_ok is set and the socket times out before the first byte,
+    Idle is raised, any other timeout is raised as is.
+    """
+    data = bytearray()
+    while len(data) < size:
+        try:
+            chunk = sock.recv(min(size - len(data), 65536))
+        except socket.timeout:
+            if idle_ok and not data:
+                raise Idle
+            raise
+        if not chunk:
+            raise SessionError("Connection closed by peer")
+        data.extend(chunk)
+    return bytes(data)
+
+
+def sign(cipher, request):
+    """Encrypt a one off request and append its MAC."""
+    encrypted = cipher.encrypt(request)
+    return encrypted + b"." + base64.b64encode(cipher.mac(encrypted))
+
+
+def open_signed(cipher, data):
+    """Verify and decrypt a signed request, return None if either fails."""
+    encrypted, _, mac = data.rpartition(b".")
+    try:
+        mac = base64.b64decode(mac, validate=True)
+    except ValueError:
+        return None
+    if not cipher.verify(encrypted, mac):
+        return None
+    return cipher.decrypt(encrypted)
+
+
+def is_local(host):
+    """Return True if host is the path of a local socket, not (address, port)."""
+    return isinstance(host, str)
+
+
+def parse_pull_args(args):
+    """Return the version vector and content hash sent with a pull request."""
+    try:
+        since = {k: v for k, v in args["since"].items() if isinstance(v, int)}
+        return since, args.get("version")
+    except (KeyError, TypeError, AttributeError) as e:
+        logger.log.warning("Ignoring invalid PULL_REQUEST arguments: %s", e)
+        return None, None
+
+
+def join_vv(a, b):
+    """Return the join of two version vectors."""
+    joined = dict(a)
+    for replica, counter in b.items():
+        if isinstance(counter, int) and counter > joined.get(replica, 0):
+            joined[replica] = counter
+    return joined
+
+
+def pull_state(since, seen):
+    """Return what a peer that has seen since, or version seen, is missing.
+
+    Returns the current content hash, the replica's version vector and a
+    state delta, None if the peer is up to date.
+    """
+    with settings.DB.lock.read_locked():
+        version = settings.DB.snapshot().content_hash()
+        vv = settings.DB.replica.version_vector()
+        if seen == version or settings.DB.replica.covered_by(since):
+            return version, vv, None
+        return version, vv, settings.DB.replica.delta(since)
+
+
+def busy():
+    """Return the reply to a request refused while the server is busy."""
+    msg = "Too many transfers in progress, try again later"
+    return {"op": sync_operations["REJECT"].name, "msg": msg}
+
+
+class Session:
+    """One end of a sync session, used alike by clients and servers."""
+
+    def __init__(self, sock, peer, cipher, client=True, admission=None):
+        """Wrap a connected socket that has completed the handshake.
+
+        A server passes its admission control, which then bounds the size
+        of every frame, and the rate of the requests, from the peer.
+        """
+        self.sock = sock
+        self.peer = peer
+        self.cipher = cipher
+        self.client = client
+        self.admission = admission
+        if admission is None:
+            self.max_frame = MAX_FRAME
+        else:
+            self.max_frame = settings.options["max_request_size"]
+        self.ids = itertools.count(1)
+        self.send_lock = threading.Lock()
+        # request id -> [event, reply, bytes received]
+        self.waiting = {}
+        self.waiting_lock = threading.Lock()
+        self.closed = threading.Event()
+        # what the peer is known to have seen, a version vector
+        self.peer_vv = {}
+        self.vv_lock = threading.Lock()
+        self.subscribed = False
+        # both ends agreed on the chunked cipher mode
+        self.chunked = False
+        self.completed = 0
+        self.last_used = time.monotonic()
+
+    @classmethod
+    def connect(cls, host, cipher, timeout):
+        """Open a session with host.
+
+        Raises SessionError if host does not support sessions, or OSError
+        if it cannot be reached.
+        """
+        if is_local(host):
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(timeout)
+            try:
+                sock.connect(host)
+            except OSError:
+                sock.close()
+                raise
+        else:
+            sock = socket.create_connection(host, timeout=timeout)
+        try:
+            hello = {"replica": settings.DB.replica.replica_id, "ciphers": [CHUNKED]}
+            request = f'{sync_operations["SESSION"].name} {json.dumps(hello)}'
+            sock.sendall(sign(cipher, request))
+            session = cls(sock, host, cipher)
+            (size,) = FRAME_HEADER.unpack(recv_exact(sock, FRAME_HEADER.size))
+            if size > MAX_FRAME:
+                # not a frame, a refusal answered like a one off request
+                refusal = cipher.decrypt(FRAME_HEADER.pack(size) + sock.recv(4096))
+                raise Refused(f"{host} refused the connection: {refusal!r}")
+            reply, _ = session.read_frame(size)
+        except OSError:
+            sock.close()
+            raise
+        if reply.get("op") != sync_operations["ACCEPT"].name:
+            sock.close()
+            raise SessionError(f"{host} refused a session")
+
+        session.saw(reply.get("vv"))
+        session.chunked = reply.get("cipher") == CHUNKED
+        sock.settimeout(KEEPALIVE)
+        t = threading.Thread(target=session.serve, name=f"session {host}")
+        t.daemon = True
+        t.start()
+        logger.log.info("Opened a sync session with %s", host)
+        return session
+
+    # framing
+
+    def send(self, message):
+        """Encrypt, sign and send one message, return its size on the wire."""
+        encrypted = self.cipher.encrypt(json.dumps(message), chunked=self.chunked)
+        payload = self.cipher.mac(encrypted) + encrypted
+        with self.send_lock:
+            self.sock.sendall(FRAME_HEADER.pack(len(payload)) + payload)
+        return FRAME_HEADER.size + len(payload)
+
+    def receive(self, idle_ok=False):
+        """Receive and decrypt one message, return it and its size on the wire."""
+        (size,) = FRAME_HEADER.unpack(
+            recv_exact(self.sock, FRAME_HEADER.size, idle_ok)
+        )
+        return self.read_frame(size)
+
+    def read_frame(self, size):
+        """Receive the rest of a frame of size bytes, see receive()."""
+        if size > self.max_frame:
+            self.rejected("size")
+            raise SessionError(f"Frame of {size} bytes from {self.peer} is too large")
+        payload = recv_exact(self.sock, size)
+        mac_size = self.cipher.mac_size
+        if not self.cipher.verify(payload[mac_size:], payload[:mac_size]):
+            self.rejected("auth")
+            raise AuthError(f"Frame from {self.peer} failed authentication")
+        decrypted = self.cipher.decrypt(payload[mac_size:])
+        if decrypted is None:
+            raise AuthError(f"Unable to decrypt a frame from {self.peer}")
+        try:
+            message = json.loads(decrypted)
+        except ValueError as e:
+            raise SessionError(f"Invalid frame from {self.peer}: {e}") from e
+        if not isinstance(message, dict):
+            raise SessionError(f"Invalid frame from {self.peer}")
+        return message, FRAME_HEADER.size + size
+
+    # requests
+
+    def request(self, op, args=None, timeout=None):
+        """Send a request and wait for its reply.
+
+        Returns the reply and the bytes sent and received for it. Raises
+        SessionError if the session breaks or the reply takes longer
+        than timeout seconds.
+        """
+        if self.closed.is_set():
+            raise SessionError(f"Session with {self.peer} is closed")
+
+        request_id = next(self.ids)
+        waiter = [threading.Event(), None, 0]
+        with self.waiting_lock:
+            self.waiting[request_id] = waiter
+        try:
+            sent = self.send({"id": request_id, "op": op, "args": args or {}})
+            self.last_used = time.monotonic()
+            if not waiter[0].wait(timeout):
+                raise SessionError(f"{self.peer} did not answer {op} in time")
+        except OSError:
+            self.close()
+            raise
+        finally:
+            with self.waiting_lock:
+                self.waiting.pop(request_id, None)
+
+        reply = waiter[1]
+        if reply is None:
+            raise SessionError(f"Session with {self.peer} closed during {op}")
+        self.saw(reply.get("vv"))
+        self.completed += 1
+        return reply, sent + waiter[2]
+
+    def serve(self):
+        """Read frames until the session closes.
+
+        Replies wake the request waiting for them, requests from the peer
+        are answered in turn on this thread.
+        """
+        try:
+            while not self.closed.is_set():
+                try:
+                    message, size = self.receive(idle_ok=True)
+                except Idle:
+                    idle = time.monotonic() - self.last_used
+                    if not self.client or idle > LINGER:
+                        logger.log.info("Closing idle session with %s", self.peer)
+                        break
+                    self.ping()
+                    continue
+
+                if "re" in message:
+                    with self.waiting_lock:
+                        waiter = self.waiting.get(message["re"])
+                    if waiter is not None:
+                        waiter[1], waiter[2] = message, size
+                        waiter[0].set()
+                    continue
+
+                reply = self.answer(message.get("op"), message.get("args"))
+                if "id" in message:
+                    reply["re"] = message["id"]
+                    self.send(reply)
+        except OSError as e:
+            if not self.closed.is_set():
+                logger.log.info("Session with %s ended: %s", self.peer, e)
+        finally:
+            self.close()
+
+    def rejected(self, reason):
+        """Count a frame or request refused by admission control."""
+        if self.admission is not None:
+            self.admission.reject(reason, self.peer)
+
+    def ping(self):
+        """Send a keepalive without waiting for its reply."""
+        self.send({"id": next(self.ids), "op": sync_operations["PING"].name})
+
+    def notify(self, op, args):
+        """Send a message that expects no reply, return its size on the wire."""
+        return self.send({"op": op, "args": args})
+
+    def saw(self, vv):
+        """Record that the peer has seen everything up to version vector vv."""
+        if isinstance(vv, dict):
+            with self.vv_lock:
+                self.peer_vv = join_vv(self.peer_vv, vv)
+
+    def seen(self):
+        """Return what the peer is known to have seen."""
+        with self.vv_lock:
+            return dict(self.peer_vv)
+
+    def close(self):
+        """Close the session and fail every request still waiting."""
+        if self.closed.is_set():
+            return
+        self.closed.set()
+        if self.subscribed and settings.DB is not None:
+            settings.DB.change_stream.discard(self)
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+        with self.waiting_lock:
+            for waiter in self.waiting.values():
+                waiter[0].set()
+
+    # answering the peer
+
+    def answer(self, op, args):
+        """Answer one request from the peer, return the reply message."""
+        if not isinstance(args, dict):
+            args = {}
+
+        # chunks continue a transfer already admitted, and streamed
+        # changes expect no reply, neither is counted against the peer
+        exempt = ("CHUNK", "PING", "CHANGES")
+        if self.admission is not None and op not in exempt:
+            if not self.admission.allow(self.peer[0]):
+                self.rejected("rate")
+                msg = "Too many requests, try again later"
+                return {"op": sync_operations["REJECT"].name, "msg": msg}
+
+        if op == sync_operations["PULL_REQUEST"].name:
+            return self.answer_pull(args)
+        if op == sync_operations["PUSH_DATA"].name:
+            return self.answer_push(args)
+        if op == sync_operations["SUBSCRIBE"].name:
+            return self.answer_subscribe(args)
+        if op == sync_operations["CHANGES"].name:
+            return self.answer_changes(args)
+        if op == sync_operations["CHUNK"].name:
+            return self.answer_chunk(args)
+        if op == sync_operations["PING"].name:
+            return {"op": sync_operations["ACCEPT"].name}
+        logger.log.warning("Unknown session request %s from %s", op, self.peer)
+        return {"op": sync_operations["REJECT"].name}
+
+    def answer_pull(self, args):
+        """Answer a pull with the state the peer has not seen."""
+        logger.log.info("received PULL_REQUEST from %s", self.peer)
+        metrics.incr("server.pull_requests")
+        if not settings.options["pull"] or settings.DB is None:
+            logger.log.info("PULL_REQUEST denied")
+            return {"op": sync_operations["REJECT"].name}
+
+        since, seen = parse_pull_args(args)
+        self.saw(since)
+
+        # continue a transfer the peer did not finish, from the same snapshot
+        resumed = offers.resume(args.get("resume"))
+        if resumed is not None:
+            manifest, extra = resumed
+            metrics.incr("transfer.resumed")
+            return dict(extra, op=sync_operations["ACCEPT"].name, transfer=manifest)
+
+        with self.transfer() as admitted:
+            if not admitted:
+                return busy()
+            version, vv, delta = pull_state(since or {}, seen)
+            if delta is None:
+                metrics.incr("server.not_modified")
+                return {"op": sync_operations["NOT_MODIFIED"].name, "vv": vv}
+
+            data = {"crdt": delta, "version": version}
+            text = json.dumps(data)
+            if len(text) > CHUNK_SIZE:
+                manifest = offers.offer(text, vv=vv)
+                return {
+                    "op": sync_operations["ACCEPT"].name,
+                    "transfer": manifest,
+                    "vv": vv,
+                }
+            return {"op": sync_operations["ACCEPT"].name, "data": data, "vv": vv}
+
+    def transfer(self):
+        """Hold a transfer slot of a server, clients are never limited."""
+        if self.admission is None:
+            return contextlib.nullcontext(True)
+        return self.admission.transfer(self.peer)
+
+    def answer_chunk(self, args):
+        """Send one chunk of a payload we offered."""
+        text = offers.chunk(args.get("id"), args.get("index"))
+        if text is None:
+            return {"op": sync_operations["REJECT"].name}
+        metrics.incr("transfer.chunks_sent")
+        return {"op": sync_operations["ACCEPT"].name, "data": text}
+
+    def answer_push(self, args):
+        """Merge a delta pushed by the peer."""
+        logger.log.info("PUSH_DATA from %s", self.peer)
+        metrics.incr("server.push_requests")
+        if not settings.options["push"] or settings.DB is None:
+            msg = f"PUSH_DATA from {self.peer} denied"
+            if settings.DB is not None:
+                settings.DB.notify.emit("Sync Push", msg)
+            logger.log.warning(msg)
+            return {"op": sync_operations["REJECT"].name, "msg": msg}
+
+        if "transfer" in args:
+            return self.fetch_push(args)
+
+        with self.transfer() as admitted:
+            if not admitted:
+                return busy()
+            # the pusher has seen its own changes, they must not be streamed back
+            self.saw(args.get("vv"))
+            result, msg = json_helpers.merge_replica_delta(
+                args.get("crdt"), origin=str(self.peer)
+            )
+        op = sync_operations["ACCEPT" if result else "REJECT"].name
+        return {"op": op, "msg": msg, "vv": settings.DB.replica.version_vector()}
+
+    def fetch_push(self, args):
+        """Start fetching changes the peer offered in chunks.
+
+        They are fetched off the serving thread, which has to keep
+        reading the replies. A transfer slot is held from here until they
+        are merged, the peer is told the server is busy if none is free.
+        """
+        try:
+            download = Download(args["transfer"])
+        except TransferError as e:
+            return {"op": sync_operations["REJECT"].name, "msg": str(e)}
+        slot = contextlib.ExitStack()
+        if not slot.enter_context(self.transfer()):
+            slot.close()
+            return busy()
+        t = threading.Thread(
+            target=self.receive_push, args=(download, args.get("vv"), slot)
+        )
+        t.daemon = True
+        try:
+            t.start()
+        except RuntimeError:
+            slot.close()
+            raise
+        msg = f"Receiving {len(download.missing())} chunks of pushed changes"
+        return {"op": sync_operations["ACCEPT"].name, "msg": msg}
+
+    def receive_push(self, download, vv, slot):
+        """Fetch and merge a push offered in chunks, on a thread of its own.
+
+        slot holds the transfer slot, it is released once done.
+        """
+        with slot:
+            try:
+                data = json.loads(download.fetch(self, IDLE_TIMEOUT))
+            except (OSError, ValueError) as e:
+                logger.log.warning(
+                    "Pushed changes from %s not received: %s", self.peer, e
+                )
+                return
+            self.saw(vv)
+            if isinstance(data, dict):
+                json_helpers.merge_replica_delta(
+                    data.get("crdt"), origin=str(self.peer)
+                )
+
+    def answer_subscribe(self, args):
+        """Start streaming changes to and from the peer."""
+        logger.log.info("SUBSCRIBE from %s", self.peer)
+        metrics.incr("server.subscriptions")
+        if not settings.options["pull"] or settings.DB is None:
+            logger.log.info("SUBSCRIBE denied")
+            return {"op": sync_operations["REJECT"].name}
+
+        self.saw(args.get("since"))
+        settings.DB.change_stream.add(self)
+        return {
+            "op": sync_operations["ACCEPT"].name,
+            "vv": settings.DB.replica.version_vector(),
+        }
+
+    def answer_changes(self, args):
+        """Merge changes streamed by a peer we are subscribed with."""
+        if not self.subscribed or settings.DB is None:
+            return {"op": sync_operations["REJECT"].name}
+        if not self.client and not settings.options["push"]:
+            logger.log.info("CHANGES from %s ignored, pushes are denied", self.peer)
+            return {"op": sync_operations["REJECT"].name}
+
+        metrics.incr("stream.received")
+        if "transfer" in args:
+            return self.fetch_push(args)
+        self.saw(args.get("vv"))
+        result, msg = json_helpers.merge_replica_delta(
+            args.get("crdt"), origin=str(self.peer)
+        )
+        op = sync_operations["ACCEPT" if result else "REJECT"].name
+        return {"op": op, "msg": msg}
+
+
+class ChangeStream:
+    """Stream committed changes to every subscribed session.
+
+    Commits only wake the stream, a thread of its own waits BATCH_DELAY
+    for more to follow and then sends each subscriber one delta with
+    everything it has not seen, so a burst of edits costs one message and
+    nothing a peer sent us is echoed back to it.
+    """
+
+    def __init__(self, db):
+        """Create a stream of the changes committed to db."""
+        self.db = db
+        self.sessions = set()
+        self.lock = threading.Lock()
+        self.ready = threading.Event()
+        self.thread = None
+        # commits happen on any thread, waking the stream is thread safe
+        db.changed.connect(self.changed, QtCore.Qt.ConnectionType.DirectConnection)
+
+    def add(self, session):
+        """Stream changes to session, starting with what it has missed."""
+        with self.lock:
+            session.subscribed = True
+            self.sessions.add(session)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="change stream")
+                self.thread.daemon = True
+                self.thread.start()
+        self.ready.set()
+
+    def discard(self, session):
+        """Stop streaming to session."""
+        with self.lock:
+            session.subscribed = False
+            self.sessions.discard(session)
+
+    def changed(self, change):
+        """Wake the stream after a commit."""
+        if self.sessions:
+            self.ready.set()
+
+    def run(self):
+        """Send batched deltas to subscribers, on the stream thread."""
+        while True:
+            self.ready.wait()
+            time.sleep(BATCH_DELAY)
+            self.ready.clear()
+            with self.lock:
+                sessions = list(self.sessions)
+            for session in sessions:
+                self.flush(session)
+
+    def flush(self, session):
+        """Send session everything it has not seen yet."""
+        seen = session.seen()
+        replica = self.db.replica
+        if replica.covered_by(seen):
+            return
+        vv = replica.version_vector()
+        args = {"crdt": replica.delta(seen), "vv": vv}
+        # a burst too large for one frame is offered in chunks, like a push
+        text = json.dumps(args)
+        if len(text) > CHUNK_SIZE:
+            args = {"transfer": offers.offer(text), "vv": vv}
+        try:
+            nbytes = session.notify(sync_operations["CHANGES"].name, args)
+        except OSError as e:
+            logger.log.info("Streaming to %s failed: %s", session.peer, e)
+            session.close()
+            return
+        session.saw(vv)
+        metrics.incr("stream.sent")
+        metrics.incr("stream.bytes_sent", nbytes)
@@ -0,0 +1,158 @@
+"""SingleInstance.py
+
+Keep one running To-Do per user and configuration directory.
+
+The running instance listens on a QLocalServer. A later launch connects
+to it before doing anything else, sends its command line arguments and
+exits once they are acknowledged, the running instance applies them and
+raises its window. Forwarding touches neither the database nor the log,
+this module only imports the rest of To-Do once it knows it is the one
+instance.
+"""
+
+import hashlib
+import json
+
+from pathlib import Path
+
+from PyQt6.QtCore import QObject, pyqtSignal
+from PyQt6.QtNetwork import QLocalServer, QLocalSocket
+
+
+# milliseconds to wait on the running instance
+CONNECT_TIMEOUT = 250
+REPLY_TIMEOUT = 2000
+
+# times a later launch tries a running instance that does not answer
+FORWARD_ATTEMPTS = 3
+
+# largest forwarded message, in bytes
+MAX_MESSAGE = 64 * 1024
+
+ACK = b"ok\n"
+
+
+def server_name():
+    """Return the local server name, unique per configuration directory."""
+    app_dir = Path.home() / ".pytodo-qt"
+    return "pytodo-qt-" + hashlib.sha256(str(app_dir).encode("utf-8")).hexdigest()[:16]
+
+
+def forward(argv, name=None):
+    """Hand argv to the running instance.
+
+    Returns True once it acknowledged them, None if no instance is
+    running, or False if one is but did not answer in time.
+    """
+    socket = QLocalSocket()
+    socket.connectToServer(name or server_name())
+    if not socket.waitForConnected(CONNECT_TIMEOUT):
+        # a socket left behind by a crash refuses connections
+        gone = (
+            QLocalSocket.LocalSocketError.ServerNotFoundError,
+            QLocalSocket.LocalSocketError.ConnectionRefusedError,
+        )
+        return None if socket.error() in gone else False
+
+    socket.write(json.dumps(argv).encode("utf-8") + b"\n")
+    socket.waitForBytesWritten(REPLY_TIMEOUT)
+    reply = b""
+    while not reply.endswith(b"\n") and socket.waitForReadyRead(REPLY_TIMEOUT):
+        reply += bytes(socket.readAll())
+    socket.disconnectFromServer()
+    return reply == ACK
+
+
+class InstanceServer(QObject):
+    """Receive the arguments of later launches."""
+
+    # the command line arguments of a later launch
+    received = pyqtSignal(list)
+
+    def __init__(self, name=None):
+        """Create a server that is not listening yet."""
+        super().__init__()
+
+        # the log is only opened by the instance that keeps running
+        from ..core.Logger import Logger
+
+        self.logger = Logger(__name__)
+        self.name = name or server_name()
+        self.server = QLocalServer(self)
+        self.server.setSocketOptions(QLocalServer.SocketOption.UserAccessOption)
+        self.server.newConnection.connect(self.accept)
+        self.buffers = {}
+
+    def listen(self, argv):
+        """Become the running instance, or forward argv to the one there is.
+
+        Returns True if this is now the running instance. An instance
+        that is still starting or busy is tried again a few times, never
+        taken over, a server left behind by one that crashed is replaced.
+        """
+        # listening replaces a server of the same name, Qt renames a new
+        # socket into place when socket options are set, so a running
+        # instance has to be ruled out first
+        for _ in range(FORWARD_ATTEMPTS):
+            forwarded = forward(argv, self.name)
+            if forwarded:
+                return False
+            if forwarded is None:
+                break
+        else:
+            self.logger.log.warning(
+                "The running instance on %s does not answer, exiting", self.name
+            )
+            return False
+
+        QLocalServer.removeServer(self.name)
+        if self.server.listen(self.name):
+            self.logger.log.info("Listening for later launches on %s", self.name)
+        else:
+            self.logger.log.warning(
+                "Unable to listen for later launches: %s", self.server.errorString()
+            )
+        return True
+
+    def accept(self):
+        """Read the arguments of each new connection."""
+        while self.server.hasPendingConnections():
+            socket = self.server.nextPendingConnection()
+            self.buffers[socket] = b""
+            socket.readyRead.connect(lambda s=socket: self.read(s))
+            socket.disconnected.connect(lambda s=socket: self.drop(s))
+
+    def read(self, socket):
+        """Collect a message, handle it once complete."""
+        data = self.buffers.get(socket, b"") + bytes(socket.readAll())
+        if len(data) > MAX_MESSAGE:
+            self.logger.log.warning("Ignoring an oversized message from a launch")
+            socket.abort()
+            return
+        self.buffers[socket] = data
+        if not data.endswith(b"\n"):
+            return
+
+        try:
+            argv = json.loads(data)
+        except ValueError:
+            argv = None
+        if not isinstance(argv, list) or not all(isinstance(a, str) for a in argv):
+            self.logger.log.warning("Ignoring an invalid message from a launch")
+            socket.abort()
+            return
+
+        self.logger.log.info("Later launch forwarded %s", argv)
+        self.received.emit(argv)
+        socket.write(ACK)
+        socket.flush()
+        socket.disconnectFromServer()
+
+    def drop(self, socket):
+        """Forget a closed connection."""
+        self.buffers.pop(socket, None)
+        socket.deleteLater()
+
+    def close(self):
+        """Stop listening."""
+        self.server.close()
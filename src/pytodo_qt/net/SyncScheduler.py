@@ -0,0 +1,278 @@
+"""SyncScheduler.py
+
+Background synchronization with a saved list of peers.
+
+A QTimer on the GUI thread decides when each peer is due, the peers due
+together are synced concurrently from a daemon thread so the GUI never
+waits on the network. Each peer pulls periodically and is asked to pull
+from us shortly after a local change. With live updates on, every peer
+pulled from is also subscribed to, from then on changes flow both ways
+as they happen and periodic pulls only catch up after a broken session.
+A peer never has more than one sync in flight, unreachable peers are
+retried with jittered exponential backoff.
+"""
+
+import random
+import threading
+import time
+
+from PyQt6 import QtCore
+from PyQt6.QtCore import QObject, QTimer, pyqtSignal
+
+from ..core import metrics, settings
+from ..core.Logger import Logger
+from ..core.Transaction import LOCAL_ORIGINS
+from ..net.Session import is_local
+from ..net.sync_operations import sync_operations
+from ..net.tcp_client_lib import SyncResult
+
+
+logger = Logger(__name__)
+
+
+# backoff for unreachable peers, in seconds
+BACKOFF_BASE = 5
+BACKOFF_MAX = 600
+
+# how long to wait for more local changes before pushing, in milliseconds
+CHANGE_DELAY = 2000
+
+# how often due peers are checked, in milliseconds
+TICK = 1000
+
+# marks a peer given as the path of a local socket
+LOCAL_PREFIX = "unix:"
+
+
+def parse_peers(text, default_port):
+    """Parse "host[:port], ..." into a list of (host, port) tuples.
+
+    An entry "unix:path" is the local socket at path, kept as the path.
+    """
+    peers = []
+    for entry in text.replace(",", " ").split():
+        if entry.startswith(LOCAL_PREFIX):
+            path = entry[len(LOCAL_PREFIX) :]
+            if path and path not in peers:
+                peers.append(path)
+            continue
+        host, sep, port = entry.rpartition(":")
+        if not sep:
+            host, port = entry, default_port
+        try:
+            port = int(port)
+        except ValueError:
+            logger.log.warning("Ignoring peer with an invalid port: %s", entry)
+            continue
+        if (host, port) not in peers:
+            peers.append((host, port))
+    return peers
+
+
+def format_peer(host):
+    """Format one peer like parse_peers reads it."""
+    if is_local(host):
+        return f"{LOCAL_PREFIX}{host}"
+    return f"{host[0]}:{host[1]}"
+
+
+def format_peers(peers):
+    """Format peers for the configuration file."""
+    return ", ".join(format_peer(host) for host in peers)
+
+
+def backoff(failures):
+    """Return a jittered delay before retrying after failures in a row."""
+    delay = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** (failures - 1))
+    return random.uniform(delay / 2, delay)
+
+
+class PeerStatus:
+    """The sync state of one peer."""
+
+    def __init__(self, host):
+        """Create the state of a peer that is due now."""
+        self.host = host
+        self.in_flight = None
+        self.pending = None
+        self.next_due = time.monotonic()
+        self.failures = 0
+        self.last_sync = None
+        self.latency = None
+        self.bytes = None
+        self.message = "Not synced yet"
+
+
+class SyncScheduler(QObject):
+    """Periodic and change driven sync with every saved peer."""
+
+    # host, operation, result, message, latency in ms, bytes transferred
+    finished = pyqtSignal(object, str, bool, str, float, int)
+    status_changed = pyqtSignal()
+
+    def __init__(self, db):
+        """Create a stopped scheduler for the peers in the options."""
+        super().__init__()
+        self.db = db
+        self.peers = {}
+
+        self.timer = QTimer(self)
+        self.timer.setInterval(TICK)
+        self.timer.timeout.connect(self.tick)
+
+        self.change_timer = QTimer(self)
+        self.change_timer.setSingleShot(True)
+        self.change_timer.setInterval(CHANGE_DELAY)
+        self.change_timer.timeout.connect(self.push_all)
+
+        # results and changes arrive from other threads
+        self.finished.connect(
+            self.sync_finished, QtCore.Qt.ConnectionType.QueuedConnection
+        )
+        self.db.changed.connect(
+            self.db_changed, QtCore.Qt.ConnectionType.QueuedConnection
+        )
+
+        self.set_peers(settings.options["peers"])
+
+    def set_peers(self, peers):
+        """Replace the peer list, keeping the state of known peers."""
+        self.peers = {host: self.peers.get(host, PeerStatus(host)) for host in peers}
+        self.status_changed.emit()
+
+    def add_peer(self, host):
+        """Add a peer and save the peer list."""
+        if host in self.peers:
+            return
+        self.set_peers(list(self.peers) + [host])
+        self.save_peers()
+
+    def remove_peer(self, host):
+        """Remove a peer and save the peer list."""
+        self.set_peers([h for h in self.peers if h != host])
+        self.save_peers()
+
+    def save_peers(self):
+        """Write the peer list to the configuration file."""
+        settings.options["peers"] = list(self.peers)
+        self.db.write_config()
+
+    def start(self):
+        """Start checking for due peers."""
+        self.timer.start()
+
+    def stop(self):
+        """Stop starting new syncs, syncs in flight finish on their own."""
+        self.timer.stop()
+        self.change_timer.stop()
+
+    def tick(self):
+        """Pull from every idle peer that is due."""
+        if settings.options["sync_interval"] <= 0:
+            return
+        now = time.monotonic()
+        due = [
+            status
+            for status in self.peers.values()
+            if status.in_flight is None and now >= status.next_due
+        ]
+        if due:
+            self.submit(due, sync_operations["PULL_REQUEST"].name)
+
+    def db_changed(self, change):
+        """Push local changes once they settle, merges from peers are not echoed."""
+        if change.origin in LOCAL_ORIGINS and settings.options["sync_on_change"]:
+            if self.peers:
+                self.change_timer.start()
+
+    def push_all(self):
+        """Ask every reachable peer to pull our changes.
+
+        Peers we stream changes to already have them.
+        """
+        client = self.db.db_client
+        reachable = [
+            s
+            for s in self.peers.values()
+            if s.failures == 0 and not client.streaming(s.host)
+        ]
+        self.submit(reachable, sync_operations["PUSH_REQUEST"].name)
+
+    def sync_now(self, host=None):
+        """Pull from one peer, or all of them, ignoring any backoff."""
+        statuses = [s for s in self.peers.values() if host in (None, s.host)]
+        self.submit(statuses, sync_operations["PULL_REQUEST"].name)
+
+    def submit(self, statuses, operation):
+        """Sync with peers at once, queueing it behind any sync in flight."""
+        hosts = []
+        for status in statuses:
+            if status.in_flight is not None:
+                if status.in_flight != operation:
+                    status.pending = operation
+                continue
+            status.in_flight = operation
+            status.message = f"{operation} in progress"
+            hosts.append(status.host)
+        if not hosts:
+            return
+
+        t = threading.Thread(target=self.run, args=(hosts, operation))
+        t.daemon = True
+        t.start()
+        self.status_changed.emit()
+
+    def run(self, hosts, operation):
+        """Sync with peers concurrently, on a sync thread."""
+        client = self.db.db_client
+        try:
+            if operation == sync_operations["PULL_REQUEST"].name:
+                outcomes = client.sync_pull_many(hosts, quiet=True)
+            else:
+                outcomes = client.sync_push_many(hosts, quiet=True)
+        except Exception as e:
+            logger.log.exception("Background sync with %s failed: %s", hosts, e)
+            outcomes = {host: SyncResult(False, str(e), 0.0, 0) for host in hosts}
+        if operation == sync_operations["PULL_REQUEST"].name:
+            if settings.options["live_updates"]:
+                for host, outcome in outcomes.items():
+                    if outcome.result and not client.streaming(host):
+                        client.subscribe(host)
+        for host, outcome in outcomes.items():
+            self.finished.emit(host, operation, *outcome)
+
+    def sync_finished(self, host, operation, result, msg, latency, nbytes):
+        """Record the outcome of a sync and schedule the next one."""
+        status = self.peers.get(host)
+        if status is None:
+            return
+
+        status.in_flight = None
+        status.latency = latency
+        status.bytes = nbytes
+        status.message = msg
+
+        now = time.monotonic()
+        interval = max(settings.options["sync_interval"], 1)
+        if result:
+            status.failures = 0
+            status.last_sync = time.time()
+            status.next_due = now + random.uniform(0.9, 1.1) * interval
+        else:
+            status.failures += 1
+            status.next_due = now + backoff(status.failures)
+            status.pending = None
+            metrics.incr("sync.failures")
+            logger.log.warning(
+                "Sync with %s failed %d times, retrying in %.0f s: %s",
+                host,
+                status.failures,
+                status.next_due - now,
+                msg,
+            )
+
+        if status.pending is not None:
+            operation, status.pending = status.pending, None
+            self.submit([status], operation)
+
+        self.status_changed.emit()
@@ -0,0 +1,308 @@
+"""Transfer.py
+
+Resumable transfers of large sync payloads in checkpointed chunks.
+
+A payload too big for one session frame is offered instead: the sender
+keeps the text and answers with a manifest holding its size and a hash of
+every chunk, the receiver then asks for the chunks one by one. Each chunk
+is checked against the manifest and written to a spool directory as soon
+as it arrives, so after a dropped connection, or a restart, only the
+missing chunks are asked for again. Payloads are identified by their own
+hash, asking to resume a transfer therefore always continues the same
+snapshot of the data.
+
+Chunks hold to-do contents, so they are encrypted like the database
+files when it is, and not checkpointed at all while it is locked.
+"""
+
+import hashlib
+import json
+import math
+import shutil
+import threading
+import time
+
+from ..core import metrics, settings
+from ..core.Logger import Logger
+from ..crypto.FileCipher import is_encrypted, read_file, write_file
+from ..net.sync_operations import sync_operations
+
+
+logger = Logger(__name__)
+
+
+# characters per chunk, larger payloads are transferred in chunks
+CHUNK_SIZE = 256 * 1024
+
+# largest payload a receiver accepts, in characters
+MAX_TRANSFER = 1024 * 1024 * 1024
+
+# offered payloads kept by a sender, and for how long, in seconds
+MAX_OFFERS = 8
+OFFER_TTL = 3600
+
+# seconds an unfinished download is kept in the spool directory
+SPOOL_TTL = 24 * 3600
+
+# times a chunk is asked for again after failing verification
+CHUNK_RETRIES = 2
+
+spool_dir = settings.app_dir / "transfers"
+
+
+class TransferError(ValueError):
+    """Raised for an invalid manifest or a chunk that fails verification."""
+
+
+def digest(text):
+    """Return the hash of text used to identify and verify transfers."""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def spool_cipher():
+    """Return whether chunks may be checkpointed, and the cipher to use."""
+    if settings.DB is None:
+        return True, None
+    cipher = settings.DB.file_cipher
+    return cipher is not None or not settings.options.get("encrypt"), cipher
+
+
+def make_manifest(text, chunk_size=CHUNK_SIZE):
+    """Return the manifest of text split into chunks of chunk_size."""
+    digests = [
+        digest(text[i : i + chunk_size]) for i in range(0, len(text), chunk_size)
+    ]
+    return {
+        "id": digest(text),
+        "size": len(text),
+        "chunk_size": chunk_size,
+        "digests": digests,
+    }
+
+
+def check_manifest(manifest):
+    """Raise TransferError if a manifest received from a peer is invalid."""
+    try:
+        transfer_id = manifest["id"]
+        size = manifest["size"]
+        chunk_size = manifest["chunk_size"]
+        digests = manifest["digests"]
+    except (KeyError, TypeError) as e:
+        raise TransferError(f"Invalid transfer manifest: {e}") from e
+
+    if not (
+        isinstance(transfer_id, str)
+        and len(transfer_id) == 64
+        and all(c in "0123456789abcdef" for c in transfer_id)
+    ):
+        raise TransferError(f"Invalid transfer id {transfer_id!r}")
+    if not isinstance(size, int) or not 0 < size <= MAX_TRANSFER:
+        raise TransferError(f"Invalid transfer size {size!r}")
+    if not isinstance(chunk_size, int) or chunk_size < 1:
+        raise TransferError(f"Invalid chunk size {chunk_size!r}")
+    if not isinstance(digests, list) or len(digests) != math.ceil(size / chunk_size):
+        raise TransferError("Transfer manifest does not match its size")
+    if not all(isinstance(d, str) for d in digests):
+        raise TransferError("Invalid chunk hash in transfer manifest")
+
+
+class Offers:
+    """Payloads offered to peers, kept until fetched or expired."""
+
+    def __init__(self):
+        """Create an empty set of offers."""
+        self.lock = threading.Lock()
+        # transfer id -> (text, manifest, extra reply fields, last used)
+        self.offers = {}
+
+    def offer(self, text, **extra):
+        """Keep text for peers to fetch and return its manifest.
+
+        extra fields are returned along with the manifest when the
+        transfer is resumed.
+        """
+        manifest = make_manifest(text)
+        now = time.monotonic()
+        with self.lock:
+            self.offers[manifest["id"]] = (text, manifest, extra, now)
+            self.expire(now)
+        metrics.incr("transfer.offered")
+        return manifest
+
+    def resume(self, transfer_id):
+        """Return the manifest and extra fields of an offer, None if gone."""
+        with self.lock:
+            entry = self.offers.get(transfer_id)
+            if entry is None:
+                return None
+            text, manifest, extra, _ = entry
+            self.offers[transfer_id] = (text, manifest, extra, time.monotonic())
+            return manifest, extra
+
+    def chunk(self, transfer_id, index):
+        """Return chunk index of an offer, None if there is no such chunk."""
+        with self.lock:
+            entry = self.offers.get(transfer_id)
+            if entry is None:
+                return None
+            text, manifest, extra, _ = entry
+            self.offers[transfer_id] = (text, manifest, extra, time.monotonic())
+        if not isinstance(index, int) or not 0 <= index < len(manifest["digests"]):
+            return None
+        size = manifest["chunk_size"]
+        return text[index * size : (index + 1) * size]
+
+    def expire(self, now):
+        """Drop stale offers and the least recently used ones over the limit."""
+        for transfer_id, entry in list(self.offers.items()):
+            if now - entry[3] > OFFER_TTL:
+                del self.offers[transfer_id]
+        while len(self.offers) > MAX_OFFERS:
+            oldest = min(self.offers, key=lambda k: self.offers[k][3])
+            del self.offers[oldest]
+
+
+# payloads this process offers, to clients and servers alike
+offers = Offers()
+
+
+class Download:
+    """A transfer being received, checkpointed chunk by chunk on disk."""
+
+    def __init__(self, manifest, source=""):
+        """Open the spool of a transfer, keeping the chunks already verified.
+
+        Raises TransferError if manifest is invalid.
+        """
+        check_manifest(manifest)
+        self.manifest = manifest
+        self.path = spool_dir / manifest["id"]
+        self.chunks = {}
+        # bytes sent and received while fetching chunks
+        self.bytes = 0
+
+        self.checkpoint, self.cipher = spool_cipher()
+        if not self.checkpoint:
+            logger.log.info(
+                "Not checkpointing transfer %s, the database is locked", self.id
+            )
+            return
+
+        try:
+            self.path.mkdir(parents=True, exist_ok=True)
+            with open(self.path / "manifest.json", "w", encoding="utf-8") as f:
+                json.dump(dict(manifest, source=source), f)
+        except OSError as e:
+            logger.log.warning("Unable to checkpoint transfer %s: %s", self.id, e)
+
+        for i, expected in enumerate(manifest["digests"]):
+            part = self.path / f"{i}.part"
+            if self.cipher is not None and part.exists() and not is_encrypted(part):
+                # spooled before encryption was turned on, never read back
+                try:
+                    part.unlink()
+                except OSError:
+                    pass
+                continue
+            try:
+                text = read_file(part, self.cipher).decode("utf-8")
+            except (OSError, ValueError):
+                continue
+            if digest(text) == expected:
+                self.chunks[i] = text
+        if self.chunks:
+            logger.log.info(
+                "Resuming transfer %s, %d of %d chunks already received",
+                self.id,
+                len(self.chunks),
+                len(manifest["digests"]),
+            )
+
+    @property
+    def id(self):
+        return self.manifest["id"]
+
+    @staticmethod
+    def pending(source):
+        """Return the manifest of an unfinished download from source, or None.
+
+        Downloads left unfinished for too long are deleted.
+        """
+        if not spool_dir.exists():
+            return None
+        found = None
+        now = time.time()
+        for path in spool_dir.iterdir():
+            try:
+                if now - path.stat().st_mtime > SPOOL_TTL:
+                    shutil.rmtree(path, ignore_errors=True)
+                    continue
+                with open(path / "manifest.json", "r", encoding="utf-8") as f:
+                    manifest = json.load(f)
+            except (OSError, ValueError):
+                continue
+            if found is None and manifest.pop("source", None) == source:
+                found = manifest
+        return found
+
+    def missing(self):
+        """Return the indexes of the chunks not received yet."""
+        return [i for i in range(len(self.manifest["digests"])) if i not in self.chunks]
+
+    def store(self, index, text):
+        """Verify a received chunk and checkpoint it.
+
+        Raises TransferError if it does not match the manifest.
+        """
+        if not isinstance(text, str) or digest(text) != self.manifest["digests"][index]:
+            metrics.incr("transfer.bad_chunks")
+            raise TransferError(f"Chunk {index} of transfer {self.id} is corrupt")
+        self.chunks[index] = text
+        metrics.incr("transfer.chunks_received")
+        if not self.checkpoint:
+            return
+        try:
+            write_file(self.path / f"{index}.part", text, self.cipher)
+        except OSError as e:
+            logger.log.warning("Unable to checkpoint chunk %d of %s: %s", index, self.id, e)
+
+    def fetch(self, session, timeout=None):
+        """Ask session for every missing chunk and return the whole text.
+
+        Raises OSError if the session breaks, the chunks received so far
+        are kept for a later attempt, or TransferError if the peer no
+        longer offers the transfer or keeps sending corrupt chunks.
+        """
+        for index in self.missing():
+            for attempt in range(CHUNK_RETRIES + 1):
+                args = {"id": self.id, "index": index}
+                reply, nbytes = session.request(
+                    sync_operations["CHUNK"].name, args, timeout
+                )
+                self.bytes += nbytes
+                if reply.get("op") != sync_operations["ACCEPT"].name:
+                    self.discard()
+                    raise TransferError(f"Transfer {self.id} is no longer offered")
+                try:
+                    self.store(index, reply.get("data"))
+                    break
+                except TransferError:
+                    if attempt == CHUNK_RETRIES:
+                        raise
+        return self.assemble()
+
+    def assemble(self):
+        """Return the whole text of a complete transfer and delete its spool.
+
+        Raises TransferError if the text does not match the manifest.
+        """
+        text = "".join(self.chunks[i] for i in range(len(self.manifest["digests"])))
+        self.discard()
+        if digest(text) != self.id:
+            raise TransferError(f"Transfer {self.id} does not match its manifest")
+        metrics.incr("transfer.completed")
+        return text
+
+    def discard(self):
+        """Delete the spool of this transfer."""
+        shutil.rmtree(self.path, ignore_errors=True)
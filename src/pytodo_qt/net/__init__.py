@@ -6,15 +6,28 @@ A small TCP socket reader with a simple progress bar.
 from PyQt6 import QtWidgets, QtCore
 
 
+def on_gui_thread():
+    """Return True if called from the thread running the Qt application."""
+    app = QtCore.QCoreApplication.instance()
+    return app is not None and QtCore.QThread.currentThread() == app.thread()
+
+
 def recv_all(sock, size):
-    """Read data from a socket until it's finished."""
-    pd = QtWidgets.QProgressDialog("Sync To-Do lists", "Abort sync", 0, size, None)
-    pd.setMinimumWidth(375)
-    pd.setWindowModality(QtCore.Qt.WindowModality.WindowModal)
-    pd.setValue(0)
-    pd.forceShow()
+    """Read data from a socket until it's finished.
+
+    A progress dialog is only shown on the GUI thread, widgets must never
+    be created from the network server threads.
+    """
+    pd = None
+    if on_gui_thread():
+        pd = QtWidgets.QProgressDialog("Sync To-Do lists", "Abort sync", 0, size, None)
+        pd.setMinimumWidth(375)
+        pd.setWindowModality(QtCore.Qt.WindowModality.WindowModal)
+        pd.setValue(0)
+        pd.forceShow()
     data = bytearray()
-    while chunk := sock.recv(1):
+    while chunk := sock.recv(65536):
         data.extend(chunk)
-        pd.setValue(len(data))
+        if pd is not None:
+            pd.setValue(len(data))
     return data
@@ -0,0 +1,638 @@
+"""load_test.py
+
+Load generator for sizing how many peers one sync server can serve.
+
+    python -m pytodo_qt.net.load_test --peers 100 --sizes 1000,10000
+
+A server is started in a process of its own, in a scratch home directory
+and with a database of the requested size, then simulated peers in one or
+more further processes sync with it over localhost for a fixed time. Each
+peer is a DatabaseClient with a session of its own, it first pulls the
+whole database like a new peer would, then keeps pulling what changed,
+pulling everything again or pushing new to-dos in the proportions of
+--mix. Peers only count what they receive, nothing is merged, so the load
+generator stays light and the numbers describe the server.
+
+The report gives throughput, latency percentiles and error rates per
+operation, and the server's memory and CPU use sampled once a second,
+for every server implementation and database size asked for, so they
+can be compared side by side. Memory and CPU are read from /proc and
+are only reported on Linux.
+"""
+
+import argparse
+import json
+import logging
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+from pathlib import Path
+
+# server implementations that can be compared, by name
+SERVERS = {
+    "threaded": "DatabaseServer",
+    "pooled": "PooledDatabaseServer",
+}
+
+# operations a peer mixes, a peer's first pull is always "initial"
+OPERATIONS = ("pull", "full", "push")
+
+# to-dos per list in a generated database
+LIST_SIZE = 1000
+
+# the list pushed to-dos go to
+PUSH_LIST = "load test"
+
+# most seconds a peer waits before going on after an error
+ERROR_DELAY = 0.5
+
+# seconds between samples of the server's memory and CPU
+SAMPLE_INTERVAL = 1.0
+
+
+def parse_mix(text):
+    """Parse "pull=80,push=15,full=5" into operation weights."""
+    mix = {}
+    for entry in text.split(","):
+        op, _, weight = entry.partition("=")
+        op = op.strip()
+        if op not in OPERATIONS:
+            raise argparse.ArgumentTypeError(f"Unknown operation {op!r}")
+        try:
+            mix[op] = float(weight)
+        except ValueError as e:
+            raise argparse.ArgumentTypeError(f"Invalid weight for {op}") from e
+    if sum(mix.values()) <= 0:
+        raise argparse.ArgumentTypeError("The mix needs a positive weight")
+    return mix
+
+
+def parse_sizes(text):
+    """Parse "1000,10000" into database sizes."""
+    try:
+        return [int(size) for size in text.split(",")]
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(f"Invalid database sizes {text!r}") from e
+
+
+def percentile(ordered, p):
+    """Return the p-th percentile of an ascending list of samples."""
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(round(p / 100.0 * (len(ordered) - 1))))]
+
+
+def quiet_logging():
+    """Keep only warnings, logging every request would slow down the test."""
+    logging.disable(logging.INFO)
+
+
+# the server process
+
+
+def serve(args):
+    """Run a server with a generated database until stdin closes."""
+    if args.quiet:
+        quiet_logging()
+
+    from PyQt6.QtCore import QCoreApplication
+
+    from ..core import settings
+    from ..core.TodoDatabase import TodoDatabase
+    from ..net import tcp_server_lib
+
+    app = QCoreApplication(sys.argv)
+    settings.options.update(
+        key=args.key, run="no", address="127.0.0.1", port=0, peers=""
+    )
+    if not args.admission:
+        # lift the limits, they would only measure themselves
+        settings.options.update(
+            rate_limit=0,
+            max_connections=args.connections,
+            max_transfers=args.connections,
+        )
+    settings.DB = db = TodoDatabase()
+    db.sync_scheduler.stop()
+    settings.options["pull"] = settings.options["push"] = True
+
+    with db.transaction() as t:
+        for i in range(args.size):
+            name = f"list {i // LIST_SIZE}"
+            if i % LIST_SIZE == 0:
+                t.add_list(name)
+            todo = {
+                "complete": i % 7 == 0,
+                "reminder": f"to-do {i}",
+                "priority": i % 3 + 1,
+            }
+            t.add_todo(name, todo)
+
+    db.start_server(getattr(tcp_server_lib, SERVERS[args.server]))
+    print("ready", db.db_server.server_address[1], flush=True)
+
+    # queued signals are delivered while waiting, so they never pile up
+    stop = threading.Event()
+
+    def wait_for_eof():
+        sys.stdin.read()
+        stop.set()
+
+    threading.Thread(target=wait_for_eof, daemon=True).start()
+    while not stop.wait(0.05):
+        app.processEvents()
+
+    print(json.dumps(db.db_server.admission.rejected), flush=True)
+    db.stop_server()
+
+
+# the peers process
+
+
+class SimulatedPeer:
+    """One peer syncing with the server as fast as its mix allows."""
+
+    def __init__(self, host, args, seed):
+        """Create a peer that has not synced yet."""
+        from ..net.tcp_client_lib import DatabaseClient
+
+        self.host = host
+        self.args = args
+        self.random = random.Random(seed)
+        self.client = DatabaseClient()
+        self.replica_id = uuid.uuid4().hex[:12]
+        self.clock = 0
+        self.vv = {}
+        # operation -> latencies in ms, operation -> error kind -> count
+        self.latencies = {op: [] for op in ("initial",) + OPERATIONS}
+        self.errors = {op: {} for op in self.latencies}
+        # seconds since the start -> operations completed during it
+        self.timeline = {}
+        self.bytes = 0
+
+    def run(self, start, deadline):
+        """Sync until deadline, on a thread of its own."""
+        self.client.local.bytes = 0
+        op = "initial"
+        ops = list(self.args.mix)
+        weights = [self.args.mix[o] for o in ops]
+        while time.monotonic() < deadline:
+            t0 = time.monotonic()
+            error = self.sync(op)
+            now = time.monotonic()
+            if error is None:
+                self.latencies[op].append((now - t0) * 1000.0)
+                second = int(now - start)
+                self.timeline[second] = self.timeline.get(second, 0) + 1
+            else:
+                self.errors[op][error] = self.errors[op].get(error, 0) + 1
+                time.sleep(self.random.uniform(0, ERROR_DELAY))
+            if error is None or op != "initial":
+                op = self.random.choices(ops, weights)[0]
+            if self.args.interval:
+                time.sleep(self.random.uniform(0, 2 * self.args.interval))
+        self.bytes = self.client.local.bytes
+        self.client.close_sessions()
+
+    def sync(self, op):
+        """Run one operation, return None or what kind of error it met."""
+        from ..net.Session import join_vv
+        from ..net.sync_operations import sync_operations
+
+        if op == "push":
+            request = sync_operations["PUSH_DATA"].name
+            request_args = self.push_args()
+        else:
+            request = sync_operations["PULL_REQUEST"].name
+            since = self.vv if op == "pull" else {}
+            request_args = {"since": since}
+
+        try:
+            reply = self.client.session_request(
+                self.host, request, request_args, self.args.timeout
+            )
+            if reply is None:
+                return "no session"
+            if reply.get("op") == sync_operations["REJECT"].name:
+                return "rejected"
+            if "transfer" in reply:
+                self.client.download(self.host, reply["transfer"], self.args.timeout)
+        except TimeoutError:
+            return "timeout"
+        except (OSError, ValueError) as e:
+            return type(e).__name__
+        if isinstance(reply.get("vv"), dict):
+            self.vv = join_vv(self.vv, reply["vv"])
+        return None
+
+    def push_args(self):
+        """Return a push of new to-dos written by this peer."""
+        items = {}
+        for _ in range(self.args.push_size):
+            self.clock += 1
+            stamp = [self.clock, self.replica_id]
+            items[uuid.uuid4().hex] = {
+                "complete": stamp + [False],
+                "reminder": stamp + [f"pushed by {self.replica_id} at {self.clock}"],
+                "priority": stamp + [self.random.randint(1, 3)],
+                "list": stamp + [PUSH_LIST],
+            }
+        lists = {PUSH_LIST: [self.clock, self.replica_id, True]}
+        self.vv[self.replica_id] = self.clock
+        delta = {
+            "replica": self.replica_id,
+            "items": items,
+            "removed": {},
+            "lists": lists,
+        }
+        return {"crdt": delta, "vv": {self.replica_id: self.clock}}
+
+
+def run_peers(args):
+    """Run simulated peers against a server, print what they measured."""
+    quiet_logging()
+
+    from PyQt6.QtCore import QCoreApplication
+
+    from ..core import settings
+    from ..core.TodoDatabase import TodoDatabase
+
+    app = QCoreApplication(sys.argv)
+    settings.options.update(key=args.key, run="no", peers="")
+    settings.DB = db = TodoDatabase()
+    db.sync_scheduler.stop()
+
+    host = ("127.0.0.1", args.port)
+    peers = [
+        SimulatedPeer(host, args, args.seed * 100003 + i) for i in range(args.peers)
+    ]
+    start = time.monotonic()
+    deadline = start + args.duration
+    threads = [
+        threading.Thread(target=p.run, args=(start, deadline), daemon=True)
+        for p in peers
+    ]
+    for t in threads:
+        t.start()
+    while any(t.is_alive() for t in threads):
+        app.processEvents()
+        time.sleep(0.05)
+        if time.monotonic() > deadline + args.timeout:
+            break
+
+    result = {"latencies": {}, "errors": {}, "timeline": {}, "bytes": 0}
+    for p in peers:
+        for op, samples in p.latencies.items():
+            result["latencies"].setdefault(op, []).extend(samples)
+        for op, kinds in p.errors.items():
+            for kind, count in kinds.items():
+                errors = result["errors"].setdefault(op, {})
+                errors[kind] = errors.get(kind, 0) + count
+        for second, count in p.timeline.items():
+            result["timeline"][second] = result["timeline"].get(second, 0) + count
+        result["bytes"] += p.bytes
+    print(json.dumps(result), flush=True)
+
+
+# the driver
+
+
+def sample_process(pid):
+    """Return the resident memory in bytes and CPU seconds of pid, or None."""
+    try:
+        with open(f"/proc/{pid}/stat", "r", encoding="utf-8") as f:
+            fields = f.read().rpartition(")")[2].split()
+        with open(f"/proc/{pid}/statm", "r", encoding="utf-8") as f:
+            resident = int(f.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        return None
+    cpu = (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+    return resident * os.sysconf("SC_PAGE_SIZE"), cpu
+
+
+class Sampler:
+    """Sample the memory and CPU use of a process once a second."""
+
+    def __init__(self, pid):
+        """Start sampling pid."""
+        self.pid = pid
+        # (seconds since start, resident bytes, CPU percent)
+        self.samples = []
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        """Take samples until stopped."""
+        start = time.monotonic()
+        last = None
+        while not self.stop.wait(SAMPLE_INTERVAL):
+            sample = sample_process(self.pid)
+            if sample is None:
+                return
+            now = time.monotonic()
+            rss, cpu = sample
+            if last is not None:
+                percent = 100.0 * (cpu - last[1]) / (now - last[0])
+                self.samples.append((round(now - start, 1), rss, round(percent, 1)))
+            last = (now, cpu)
+
+    def finish(self):
+        """Stop sampling and return the samples."""
+        self.stop.set()
+        self.thread.join()
+        return self.samples
+
+
+def module_command(*args):
+    """Return the command running this module with args."""
+    return [sys.executable, "-m", __spec__.name, *map(str, args)]
+
+
+def run_one(args, server, size, scratch):
+    """Load one server implementation holding size to-dos, return a report."""
+    key = uuid.uuid4().hex
+    env = dict(os.environ, HOME=str(scratch / f"{server}-{size}-server"))
+    Path(env["HOME"]).mkdir(parents=True)
+    command = ["serve", "--server", server, "--size", size, "--key", key]
+    command += ["--connections", args.peers + 16]
+    if args.admission:
+        command.append("--admission")
+    if args.quiet_server:
+        command.append("--quiet")
+    log = open(Path(env["HOME"]) / "server.log", "w", encoding="utf-8")
+    proc = subprocess.Popen(
+        module_command(*command),
+        env=env,
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=log,
+        text=True,
+    )
+    try:
+        ready = proc.stdout.readline().split()
+        if not ready or ready[0] != "ready":
+            raise RuntimeError(f"Server failed to start, see {log.name}")
+        port = int(ready[1])
+
+        sampler = Sampler(proc.pid)
+        workers = []
+        for i in range(args.processes):
+            count = args.peers // args.processes + (i < args.peers % args.processes)
+            if count == 0:
+                continue
+            home = scratch / f"{server}-{size}-peers-{i}"
+            home.mkdir(parents=True)
+            command = ["peers", "--port", port, "--key", key, "--peers", count]
+            command += ["--duration", args.duration, "--timeout", args.timeout]
+            command += ["--mix", args.mix_text, "--push-size", args.push_size]
+            command += ["--interval", args.interval, "--seed", args.seed + i]
+            workers.append(
+                subprocess.Popen(
+                    module_command(*command),
+                    env=dict(os.environ, HOME=str(home)),
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.DEVNULL,
+                    text=True,
+                )
+            )
+        results = []
+        for worker in workers:
+            out, _ = worker.communicate()
+            lines = out.strip().splitlines()
+            if worker.returncode != 0 or not lines:
+                raise RuntimeError(f"A peers process failed with {worker.returncode}")
+            results.append(json.loads(lines[-1]))
+        samples = sampler.finish()
+        proc.stdin.close()
+        lines = proc.stdout.read().strip().splitlines()
+        rejected = json.loads(lines[-1]) if lines else {}
+    finally:
+        if proc.poll() is None:
+            try:
+                proc.wait(10)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+        log.close()
+
+    return summarize(server, size, args, results, samples, rejected)
+
+
+def summarize(server, size, args, results, samples, rejected):
+    """Combine what every peers process measured into one report."""
+    latencies = {}
+    errors = {}
+    timeline = {}
+    for result in results:
+        for op, values in result["latencies"].items():
+            latencies.setdefault(op, []).extend(values)
+        for op, kinds in result["errors"].items():
+            for kind, count in kinds.items():
+                errors.setdefault(op, {})
+                errors[op][kind] = errors[op].get(kind, 0) + count
+        for second, count in result["timeline"].items():
+            timeline[int(second)] = timeline.get(int(second), 0) + count
+
+    operations = {}
+    for op, values in latencies.items():
+        failed = sum(errors.get(op, {}).values())
+        if not values and not failed:
+            continue
+        values.sort()
+        operations[op] = {
+            "count": len(values),
+            "errors": errors.get(op, {}),
+            "error_rate": failed / (len(values) + failed),
+            "p50": percentile(values, 50),
+            "p90": percentile(values, 90),
+            "p99": percentile(values, 99),
+            "max": values[-1] if values else 0.0,
+        }
+
+    # latencies once every peer has its initial copy
+    steady = sorted(
+        v for op, values in latencies.items() if op != "initial" for v in values
+    )
+    completed = sum(len(v) for v in latencies.values())
+    failed = sum(sum(k.values()) for k in errors.values())
+    return {
+        "server": server,
+        "size": size,
+        "peers": args.peers,
+        "duration": args.duration,
+        "throughput": completed / args.duration,
+        "error_rate": failed / (completed + failed) if completed + failed else 0.0,
+        "p50": percentile(steady, 50),
+        "p99": percentile(steady, 99),
+        "bytes": sum(r["bytes"] for r in results),
+        "operations": operations,
+        "timeline": [timeline.get(s, 0) for s in range(args.duration)],
+        "server_samples": samples,
+        "peak_rss": max((s[1] for s in samples), default=None),
+        "mean_cpu": (sum(s[2] for s in samples) / len(samples) if samples else None),
+        "rejected": rejected,
+    }
+
+
+def print_report(report):
+    """Print the report of one run."""
+    print(
+        f'\n{report["server"]} server, {report["size"]} to-dos, '
+        f'{report["peers"]} peers, {report["duration"]} s'
+    )
+    print(
+        f'{"operation":<10}{"count":>8}{"errors":>8}{"p50":>9}{"p90":>9}{"p99":>9}{"max":>9}'
+    )
+    for op, stats in report["operations"].items():
+        print(
+            f'{op:<10}{stats["count"]:>8}{sum(stats["errors"].values()):>8}'
+            f'{stats["p50"]:>9.1f}{stats["p90"]:>9.1f}{stats["p99"]:>9.1f}'
+            f'{stats["max"]:>9.1f}'
+        )
+        for kind, count in stats["errors"].items():
+            print(f"  {count} {kind}")
+    print("ops/s per second:", " ".join(str(n) for n in report["timeline"]))
+    if report["server_samples"]:
+        print(
+            "server RSS MB / CPU %:",
+            " ".join(
+                f"{rss / 2**20:.0f}/{cpu:.0f}"
+                for _, rss, cpu in report["server_samples"]
+            ),
+        )
+    if report["rejected"]:
+        print("rejected by admission control:", report["rejected"])
+
+
+def print_comparison(reports):
+    """Print one line per run, to compare servers and database sizes."""
+    print(
+        f'\n{"server":<10}{"to-dos":>9}{"ops/s":>9}{"errors %":>10}'
+        f'{"p50 ms":>9}{"p99 ms":>9}{"RSS MB":>9}{"CPU %":>8}'
+    )
+    for r in reports:
+        rss = "n/a" if r["peak_rss"] is None else f'{r["peak_rss"] / 2**20:.0f}'
+        cpu = "n/a" if r["mean_cpu"] is None else f'{r["mean_cpu"]:.0f}'
+        print(
+            f'{r["server"]:<10}{r["size"]:>9}{r["throughput"]:>9.1f}'
+            f'{100 * r["error_rate"]:>10.2f}{r["p50"]:>9.1f}{r["p99"]:>9.1f}'
+            f"{rss:>9}{cpu:>8}"
+        )
+
+
+def run(args):
+    """Load every server implementation with every database size."""
+    reports = []
+    with tempfile.TemporaryDirectory(prefix="pytodo-qt-load-") as scratch:
+        for server in args.servers:
+            for size in args.sizes:
+                report = run_one(args, server, size, Path(scratch))
+                print_report(report)
+                reports.append(report)
+    print_comparison(reports)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(reports, f, indent=2)
+
+
+def main(argv=None):
+    """Parse the command line and run the load test, or one of its processes."""
+    argv = sys.argv[1:] if argv is None else argv
+
+    if argv and argv[0] == "serve":
+        parser = argparse.ArgumentParser(prog="load_test serve")
+        parser.add_argument("--server", choices=SERVERS, default="threaded")
+        parser.add_argument("--size", type=int, default=1000)
+        parser.add_argument("--key", required=True)
+        parser.add_argument("--connections", type=int, default=64)
+        parser.add_argument("--admission", action="store_true")
+        parser.add_argument("--quiet", action="store_true")
+        return serve(parser.parse_args(argv[1:]))
+
+    if argv and argv[0] == "peers":
+        parser = argparse.ArgumentParser(prog="load_test peers")
+        parser.add_argument("--port", type=int, required=True)
+        parser.add_argument("--key", required=True)
+        parser.add_argument("--peers", type=int, default=10)
+        parser.add_argument("--duration", type=int, default=30)
+        parser.add_argument("--timeout", type=float, default=30)
+        parser.add_argument("--mix", type=parse_mix, default="pull=80,push=15,full=5")
+        parser.add_argument("--push-size", type=int, default=1)
+        parser.add_argument("--interval", type=float, default=0.0)
+        parser.add_argument("--seed", type=int, default=0)
+        return run_peers(parser.parse_args(argv[1:]))
+
+    parser = argparse.ArgumentParser(
+        prog="python -m pytodo_qt.net.load_test",
+        description="Load a local sync server with simulated peers",
+    )
+    parser.add_argument(
+        "--peers", type=int, default=50, help="simulated peers (default 50)"
+    )
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=max(1, min(4, (os.cpu_count() or 2) // 2)),
+        help="processes the peers are spread over",
+    )
+    parser.add_argument(
+        "--duration", type=int, default=30, help="seconds each run lasts (default 30)"
+    )
+    parser.add_argument(
+        "--sizes",
+        type=parse_sizes,
+        default=[1000, 10000],
+        help="comma separated database sizes in to-dos (default 1000,10000)",
+    )
+    parser.add_argument(
+        "--servers",
+        type=lambda text: text.split(","),
+        default=list(SERVERS),
+        help=f'comma separated server implementations, of {", ".join(SERVERS)}',
+    )
+    parser.add_argument(
+        "--mix",
+        default="pull=80,push=15,full=5",
+        help="operation weights, pull what changed, pull everything and push "
+        "(default pull=80,push=15,full=5)",
+    )
+    parser.add_argument(
+        "--push-size", type=int, default=1, help="to-dos per push (default 1)"
+    )
+    parser.add_argument(
+        "--interval",
+        type=float,
+        default=0.0,
+        help="mean seconds a peer waits between operations (default 0)",
+    )
+    parser.add_argument(
+        "--timeout", type=float, default=30, help="seconds to wait for a reply"
+    )
+    parser.add_argument(
+        "--admission",
+        action="store_true",
+        help="keep the configured admission control limits",
+    )
+    parser.add_argument(
+        "--quiet-server", action="store_true", help="only log server warnings"
+    )
+    parser.add_argument("--seed", type=int, default=0, help="random seed")
+    parser.add_argument("--json", help="also write the full reports to this file")
+    args = parser.parse_args(argv)
+
+    parse_mix(args.mix)
+    args.mix_text = args.mix
+    for server in args.servers:
+        if server not in SERVERS:
+            parser.error(f"Unknown server {server!r}, choose from {', '.join(SERVERS)}")
+    return run(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -14,5 +14,12 @@ sync_operations = Enum(
         ("REJECT", 3),
         ("ACCEPT", 4),
         ("NO_DATA", 5),
+        ("NOT_MODIFIED", 6),
+        ("SESSION", 7),
+        ("PUSH_DATA", 8),
+        ("PING", 9),
+        ("SUBSCRIBE", 10),
+        ("CHANGES", 11),
+        ("CHUNK", 12),
     ],
 )
@@ -4,25 +4,58 @@ This module implements the To-Do database network client.
 """
 
 import json
+import math
 import socket
+import threading
 import time
 
-from pathlib import Path
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait
 
 from PyQt6.QtCore import QObject, pyqtSignal
 
-from ..core import settings, json_helpers
+from ..core import json_helpers, metrics, settings, timed
 from ..core.Logger import Logger
+from ..core.Replica import join_deltas, parse_delta
+from ..core.Transaction import TransactionError
 from ..crypto.AESCipher import AESCipher
+from ..crypto.PlainCipher import PlainCipher
 from ..net import recv_all
+from ..net.Session import AuthError, Session, SessionError, is_local
+from ..net.Transfer import CHUNK_SIZE, Download, offers
 from ..net.sync_operations import sync_operations
 
 
 logger = Logger(__name__)
 
 
+# seconds to wait on a host before giving up on it
+TIMEOUT = 30
+
+# most hosts contacted at the same time by a fan-out sync
+MAX_WORKERS = 32
+
+# seconds before offering a session again to a host that refused one
+LEGACY_RETRY = 3600
+
+# sessions opened to finish one interrupted transfer
+RESUME_ATTEMPTS = 5
+
+# the outcome of a sync with one host, latency in ms
+SyncResult = namedtuple("SyncResult", "result msg latency bytes")
+
+
+def is_delta(todo_lists):
+    """Return True if lists received from a peer are a replica state delta."""
+    return isinstance(todo_lists, dict) and isinstance(todo_lists.get("crdt"), dict)
+
+
 class DatabaseClient(QObject):
-    """To-Do database client class."""
+    """To-Do database client class.
+
+    Hosts are (address, port) tuples, or the path of a local socket for
+    a To-Do running on this machine, which is only reached by sessions.
+    """
 
     sync_occurred = pyqtSignal(str)
 
@@ -31,75 +64,138 @@ class DatabaseClient(QObject):
         super().__init__()
         self.buf_size = 4096
         self.aes_cipher = AESCipher(settings.options["key"])
+        # host -> content hash of its lists at our last pull
+        self.peer_versions = {}
+        # per sync thread: bytes transferred and whether to stay quiet
+        self.local = threading.local()
+        # host -> open Session, host -> when it last refused a session
+        self.sessions = {}
+        self.legacy_hosts = {}
+        self.sessions_lock = threading.Lock()
+
+    def announce(self, msg):
+        """Tell the GUI about a sync event, unless this sync is quiet."""
+        if not getattr(self.local, "quiet", False):
+            self.sync_occurred.emit(msg)
+
+    def transferred(self):
+        """Return the bytes sent and received by this thread's last sync."""
+        return getattr(self.local, "bytes", 0)
 
     def send_request(self, host, sock, request):
         """Send a request to remote connection."""
         logger.log.info("sending %s to %s", request, host)
         encrypted_request = self.aes_cipher.encrypt(request)
         sock.send(encrypted_request)
+        self.local.bytes += len(encrypted_request)
 
     def get_response(self, sock):
-        """Get a response from remote connection."""
+        """Get a response from remote connection, None if it is unreadable."""
         encrypted_data = sock.recv(self.buf_size)
+        self.local.bytes += len(encrypted_data)
         decrypted_data = self.aes_cipher.decrypt(encrypted_data)
-        response = decrypted_data.decode("utf-8")
-        return response
+        if decrypted_data is None:
+            return None
+        try:
+            return decrypted_data.decode("utf-8")
+        except UnicodeDecodeError:
+            return None
 
     def process_response(self, host, sock, request, response):
         """Process remote host's response to a request."""
         msg = f"{host} responded to {request} with {response}"
         logger.log.info(msg)
-        self.sync_occurred.emit(msg)
+        self.announce(msg)
+
+        if response == sync_operations["NOT_MODIFIED"].name:
+            metrics.incr("sync.not_modified")
+            return True, f"{host} has not changed since the last pull"
 
         if response == sync_operations["ACCEPT"].name:
+            request = request.partition(" ")[0]
             if request == sync_operations["PULL_REQUEST"].name:
                 size_header = sock.recv(self.buf_size)
+                self.local.bytes += len(size_header)
                 decrypted_header = self.aes_cipher.decrypt(size_header)
-                size = int(decrypted_header)
+                try:
+                    size = int(decrypted_header)
+                except (TypeError, ValueError):
+                    msg = f"Invalid size header from {host}"
+                    logger.log.warning(msg)
+                    return False, msg
                 logger.log.info("remote lists is %d bytes", size)
                 time.sleep(1)
                 data = recv_all(sock, size)
-                self.process_data(host, data)
+                metrics.incr("sync.bytes_received", len(data))
+                self.local.bytes += len(data)
+                return self.process_data(host, data)
             elif request == sync_operations["PUSH_REQUEST"].name:
-                pass
-            else:
-                return False, msg
+                return True, msg
 
-        return True, msg
+        return False, msg
 
     def process_data(self, host, data):
         """Process encrypted data received."""
         # decrypt and decode received data
         decrypted_data = self.aes_cipher.decrypt(data)
+        if decrypted_data is None:
+            msg = f"Unable to decrypt the lists from {host}, check the key"
+            logger.log.warning(msg)
+            return False, msg
         try:
             deserialized = json.loads(decrypted_data)
-        except OSError as e:
-            logger.log.exception(e)
-            return False, e
+        except ValueError as e:
+            msg = f"Invalid data from {host}: {e}"
+            logger.log.exception(msg)
+            return False, msg
 
-        # write data to a temporary file, then read it in
-        tmp = Path.joinpath(settings.app_dir, ".todo_lists.tmp")
+        # merge the lists straight into the database, this may run on a
+        # server thread so there is no shared temporary file to race on
         try:
-            with open(tmp, "w", encoding="utf-8") as f:
-                f.write(deserialized)
-            msg = f"Pull from {host} successful."
-            logger.log.info(msg)
-            result, e = json_helpers.read_json_data(tmp)
-            if not result:
-                return False, e
-            Path.unlink(tmp)
-            self.sync_occurred.emit(msg)
-            return True, msg
-        except IOError as e:
-            msg = f"Unable to write temporary file: {e}"
+            todo_lists = json.loads(deserialized)
+        except ValueError as e:
+            msg = f"Invalid to-do lists from {host}: {e}"
             logger.log.exception(msg)
             return False, msg
+        return self.process_lists(host, todo_lists)
+
+    def process_lists(self, host, todo_lists):
+        """Merge decoded to-do lists or a replica delta received from host."""
+        # a fan-out pull keeps what it received, to merge it all at once
+        received = getattr(self.local, "received", None)
+        if received is not None:
+            if is_delta(todo_lists):
+                try:
+                    parse_delta(todo_lists["crdt"])
+                except TransactionError as e:
+                    msg = f"Invalid replica state from {host}: {e}"
+                    logger.log.warning(msg)
+                    return False, msg
+            received.append(todo_lists)
+            return True, f"Received to-do lists from {host}"
+
+        # peers with a replica send a state delta, older ones whole lists
+        if is_delta(todo_lists):
+            result, e = json_helpers.merge_replica_delta(
+                todo_lists["crdt"], origin=str(host)
+            )
+            if result and isinstance(todo_lists.get("version"), str):
+                self.peer_versions[host] = todo_lists["version"]
+        else:
+            result, e = json_helpers.load_todo_lists(todo_lists, origin=str(host))
+        if not result:
+            return False, e
+        msg = f"Pull from {host} successful. {e}."
+        logger.log.info(msg)
+        self.announce(msg)
+        return True, msg
 
-    def synchronize(self, host, request):
+    def synchronize(self, host, request, timeout=TIMEOUT):
         """Synchronize to-do lists with other hosts."""
+        self.local.bytes = 0
         try:
             with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
-                sock.settimeout(30)
+                sock.settimeout(timeout)
                 try:
                     sock.connect(host)
                 except socket.error as err:
@@ -108,27 +204,382 @@ class DatabaseClient(QObject):
                     return False, msg
                 self.send_request(host, sock, request)
                 response = self.get_response(sock)
+                if response is None:
+                    msg = f"Unable to read the response of {host}, check the key"
+                    logger.log.warning(msg)
+                    return False, msg
                 return self.process_response(host, sock, request, response)
         except OSError as e:
             msg = f"Unable to connect to host {host}: {e}"
             logger.log.exception(msg)
             return False, msg
 
-    def sync_pull(self, host):
-        """Synchronize database with another by pulling it from a host."""
+    def session(self, host, timeout=TIMEOUT):
+        """Return an open session with host, None if host is too old for one.
+
+        Sessions are kept open and reused by later syncs. Raises OSError
+        if host cannot be reached.
+        """
+        with self.sessions_lock:
+            refused = self.legacy_hosts.get(host)
+            if refused is not None and time.monotonic() - refused < LEGACY_RETRY:
+                return None
+            session = self.sessions.get(host)
+            if session is not None and not session.closed.is_set():
+                return session
+
+        cipher = PlainCipher() if is_local(host) else self.aes_cipher
+        try:
+            session = Session.connect(host, cipher, timeout)
+        except AuthError:
+            # a peer with another key is misconfigured, not an older version
+            raise
+        except SessionError as e:
+            if is_local(host):
+                raise
+            logger.log.info("%s does not support sync sessions: %s", host, e)
+            with self.sessions_lock:
+                self.legacy_hosts[host] = time.monotonic()
+            return None
+        metrics.incr("sync.sessions_opened")
+
+        with self.sessions_lock:
+            self.legacy_hosts.pop(host, None)
+            current = self.sessions.get(host)
+            if current is not None and not current.closed.is_set():
+                session.close()
+                return current
+            self.sessions[host] = session
+            return session
+
+    def close_sessions(self):
+        """Close every open session."""
+        with self.sessions_lock:
+            sessions, self.sessions = list(self.sessions.values()), {}
+        for session in sessions:
+            session.close()
+
+    def session_request(self, host, op, args, timeout):
+        """Send a request to host over a session.
+
+        Returns the reply, or None if host does not support sessions.
+        A session that turns out to have gone stale since its last use
+        is replaced once. Raises OSError if the request fails.
+        """
+        for attempt in range(2):
+            session = self.session(host, timeout)
+            if session is None:
+                return None
+            try:
+                logger.log.info("sending %s to %s", op, host)
+                reply, nbytes = session.request(op, args, timeout)
+            except OSError:
+                if attempt == 0 and session.completed > 0:
+                    continue
+                raise
+            self.local.bytes += nbytes
+            return reply
+
+    def process_reply(self, host, request, reply):
+        """Process a session reply to a request."""
+        response = reply.get("op")
+        msg = f"{host} responded to {request} with {response}"
+        logger.log.info(msg)
+        self.announce(msg)
+
+        if response == sync_operations["NOT_MODIFIED"].name:
+            metrics.incr("sync.not_modified")
+            return True, f"{host} has not changed since the last pull"
+
+        if response != sync_operations["ACCEPT"].name:
+            return False, reply.get("msg", msg)
+
+        if request == sync_operations["PULL_REQUEST"].name:
+            metrics.incr("sync.bytes_received", self.local.bytes)
+            return self.process_lists(host, reply.get("data"))
+        return True, reply.get("msg", msg)
+
+    def session_sync(self, host, request, timeout):
+        """Sync with host over a session, return None if it has none."""
+        if request == sync_operations["PULL_REQUEST"].name:
+            args = self.pull_args(host)
+            pending = Download.pending(str(host))
+            if pending is not None:
+                args["resume"] = pending["id"]
+        else:
+            session = self.session(host, timeout)
+            if session is None:
+                return None
+            delta = settings.DB.replica.delta(session.seen())
+            if not (delta["items"] or delta["removed"] or delta["lists"]):
+                return True, f"{host} already has all our changes"
+            request = sync_operations["PUSH_DATA"].name
+            args = {"crdt": delta, "vv": settings.DB.replica.version_vector()}
+            text = json.dumps(args)
+            if len(text) > CHUNK_SIZE:
+                args = {"transfer": offers.offer(text), "vv": args["vv"]}
+
+        reply = self.session_request(host, request, args, timeout)
+        if reply is None:
+            return None
+
+        # large payloads are offered in chunks, fetched after the reply
+        if "transfer" in reply and request == sync_operations["PULL_REQUEST"].name:
+            try:
+                text = self.download(host, reply["transfer"], timeout)
+                reply = dict(reply, data=json.loads(text))
+            except ValueError as e:
+                msg = f"Transfer from {host} failed: {e}"
+                logger.log.warning(msg)
+                return False, msg
+        return self.process_reply(host, request, reply)
+
+    def download(self, host, manifest, timeout):
+        """Fetch a payload host offered in chunks and return its text.
+
+        A broken session is replaced and the transfer continues from the
+        last verified chunk, chunks already on disk from an earlier sync
+        are not fetched again. Raises OSError if host stays unreachable,
+        the chunks received are kept for the next pull, or TransferError.
+        """
+        download = Download(manifest, source=str(host))
+        try:
+            for attempt in range(RESUME_ATTEMPTS):
+                session = self.session(host, timeout)
+                if session is None:
+                    raise SessionError(f"{host} no longer supports sessions")
+                try:
+                    return download.fetch(session, timeout)
+                except OSError as e:
+                    if attempt == RESUME_ATTEMPTS - 1:
+                        raise
+                    logger.log.info("Transfer from %s interrupted: %s", host, e)
+                    metrics.incr("transfer.interrupted")
+        finally:
+            self.local.bytes += download.bytes
+
+    def sync(self, host, request, timeout):
+        """Sync with host over a session, or a connection of its own."""
+        self.local.bytes = 0
+        try:
+            outcome = self.session_sync(host, request, timeout)
+        except OSError as e:
+            msg = f"Unable to sync with host {host}: {e}"
+            logger.log.warning(msg)
+            return False, msg
+        if outcome is not None:
+            return outcome
+
+        # hosts without sessions predate pull arguments and only answer
+        # the bare request, peers that take arguments have sessions
+        return self.synchronize(host, request, timeout)
+
+    def subscribe(self, host, timeout=TIMEOUT):
+        """Stream changes to and from host as they happen.
+
+        Needs a session with host. The subscription lasts as long as the
+        session, subscribing again while it is live does nothing.
+        """
+        self.local.bytes = 0
+        try:
+            session = self.session(host, timeout)
+            if session is None:
+                return False, f"{host} does not support live updates"
+            if session.subscribed:
+                return True, f"Already subscribed to {host}"
+            args = {"since": settings.DB.replica.version_vector()}
+            reply = self.session_request(
+                host, sync_operations["SUBSCRIBE"].name, args, timeout
+            )
+        except OSError as e:
+            msg = f"Unable to subscribe to {host}: {e}"
+            logger.log.warning(msg)
+            return False, msg
+
+        if reply is None or reply.get("op") != sync_operations["ACCEPT"].name:
+            return False, f"{host} refused live updates"
+        settings.DB.change_stream.add(session)
+        logger.log.info("Subscribed to %s", host)
+        return True, f"Subscribed to {host}"
+
+    def streaming(self, host):
+        """Return True if changes are streamed to host as they happen."""
+        with self.sessions_lock:
+            session = self.sessions.get(host)
+        return session is not None and session.subscribed
+
+    @timed("sync.pull")
+    def sync_pull(self, host, quiet=False, timeout=TIMEOUT):
+        """Synchronize database with another by pulling it from a host.
+
+        Quiet syncs, made in the background, do not announce themselves.
+        """
         logger.log.info("Performing a Sync Pull")
-        result, msg = self.synchronize(host, sync_operations["PULL_REQUEST"].name)
-        self.sync_occurred.emit(f"PULL_REQUEST sent to {host}")
+        self.local.quiet = quiet
+        result, msg = self.sync(host, sync_operations["PULL_REQUEST"].name, timeout)
+        self.announce(f"PULL_REQUEST sent to {host}")
         return result, msg
 
-    def sync_push(self, host):
+    def pull_args(self, host):
+        """Return pull arguments asking host only for what we have not seen."""
+        return {
+            "since": settings.DB.replica.version_vector(),
+            "version": self.peer_versions.get(host),
+        }
+
+    @timed("sync.push")
+    def sync_push(self, host, quiet=False, timeout=TIMEOUT):
         """Synchronize lists between devices by pushing them to a host.
 
-        To-Do doesn't really support pushing because that is rude.
-        In our terminology, if you do a push, it really means asking
-        the device you want your to-do lists on to pull from you.
+        Over a session our changes are sent along with the request. Older
+        hosts are asked to connect back and pull from us instead.
         """
         logger.log.info("Performing a Sync Push")
-        result, msg = self.synchronize(host, sync_operations["PUSH_REQUEST"].name)
-        self.sync_occurred.emit(f"PUSH_REQUEST sent to {host}")
+        self.local.quiet = quiet
+        result, msg = self.sync(host, sync_operations["PUSH_REQUEST"].name, timeout)
+        self.announce(f"PUSH_REQUEST sent to {host}")
         return result, msg
+
+    def fan_out(self, hosts, work, timeout, failed):
+        """Run work(host) for every host concurrently.
+
+        Hosts that have not finished after timeout seconds, counted from
+        when their turn to run came, are reported as failed and anything
+        they send later is dropped. Returns a dictionary of host to what
+        work returned, None for hosts that timed out, or what
+        failed(host, error) returned for hosts whose work raised, so one
+        broken host never costs the results of the others.
+        """
+        workers = min(len(hosts), MAX_WORKERS)
+        rounds = math.ceil(len(hosts) / workers)
+        pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="sync")
+        futures = {pool.submit(work, host): host for host in hosts}
+        done, _ = wait(futures, timeout=timeout * rounds)
+        for future in futures:
+            future.cancel()
+        pool.shutdown(wait=False)
+        results = {}
+        for future, host in futures.items():
+            if future not in done:
+                results[host] = None
+            elif future.exception() is not None:
+                results[host] = failed(host, future.exception())
+            else:
+                results[host] = future.result()
+        return results
+
+    def timed_out(self, host, timeout):
+        """Return the outcome of a host that did not finish in time."""
+        msg = f"{host} did not finish syncing within {timeout} seconds"
+        logger.log.warning(msg)
+        return SyncResult(False, msg, timeout * 1000, 0)
+
+    def failed(self, host, error):
+        """Return the outcome of a host whose sync raised error."""
+        msg = f"Sync with {host} failed: {error!r}"
+        logger.log.warning(msg, exc_info=error)
+        return SyncResult(False, msg, 0.0, 0)
+
+    @timed("sync.pull_many")
+    def sync_pull_many(self, hosts, timeout=TIMEOUT, quiet=False):
+        """Pull from several hosts at once and merge what they sent together.
+
+        Every host is contacted concurrently, so the sync takes about as
+        long as the slowest host that answers, and none is waited on for
+        more than timeout seconds. What arrives is merged in host order in
+        one transaction, older peers that send whole lists in a second
+        one. Returns a dictionary of host to SyncResult.
+        """
+        hosts = sorted(set(hosts), key=str)
+        if not hosts:
+            return {}
+        logger.log.info("Performing a Sync Pull from %d hosts", len(hosts))
+
+        def fetch(host):
+            self.local.received = []
+            start = time.perf_counter()
+            try:
+                result, msg = self.sync_pull(host, quiet, timeout)
+            finally:
+                received, self.local.received = self.local.received, None
+            latency = (time.perf_counter() - start) * 1000
+            outcome = SyncResult(bool(result), str(msg), latency, self.transferred())
+            return outcome, received[0] if result and received else None
+
+        def fetch_failed(host, error):
+            return self.failed(host, error), None
+
+        outcomes = {}
+        deltas = []
+        legacy = []
+        for host, fetched in self.fan_out(hosts, fetch, timeout, fetch_failed).items():
+            if fetched is None:
+                outcomes[host] = self.timed_out(host, timeout)
+                continue
+            outcomes[host], todo_lists = fetched
+            if todo_lists is None:
+                continue
+            if is_delta(todo_lists):
+                deltas.append((host, todo_lists))
+            elif not isinstance(todo_lists, dict):
+                msg = f"Invalid to-do lists from {host}: not a JSON object"
+                outcomes[host] = outcomes[host]._replace(result=False, msg=msg)
+            else:
+                legacy.append((host, todo_lists))
+
+        if deltas:
+            result, msg = json_helpers.merge_replica_delta(
+                join_deltas(lists["crdt"] for _, lists in deltas),
+                origin=", ".join(str(host) for host, _ in deltas),
+            )
+            for host, lists in deltas:
+                if result and isinstance(lists.get("version"), str):
+                    self.peer_versions[host] = lists["version"]
+                self.merged(outcomes, host, result, msg)
+        if legacy:
+            result, msg = json_helpers.load_todo_lists(
+                *(lists for _, lists in legacy),
+                origin=", ".join(str(host) for host, _ in legacy),
+            )
+            for host, _ in legacy:
+                self.merged(outcomes, host, result, msg)
+
+        self.local.quiet = quiet
+        ok = sum(outcome.result for outcome in outcomes.values())
+        self.announce(f"Pulled from {ok} of {len(hosts)} hosts")
+        return outcomes
+
+    def merged(self, outcomes, host, result, msg):
+        """Record the result of merging what host sent."""
+        outcome = outcomes[host]
+        if result:
+            msg = f"Pull from {host} successful. {msg}."
+        outcomes[host] = outcome._replace(result=bool(result), msg=str(msg))
+
+    @timed("sync.push_many")
+    def sync_push_many(self, hosts, timeout=TIMEOUT, quiet=False):
+        """Ask several hosts at once to pull from us.
+
+        Like sync_pull_many every host is contacted concurrently and
+        waited on for no more than timeout seconds. Returns a dictionary
+        of host to SyncResult.
+        """
+        hosts = sorted(set(hosts), key=str)
+        if not hosts:
+            return {}
+        logger.log.info("Performing a Sync Push to %d hosts", len(hosts))
+
+        def push(host):
+            start = time.perf_counter()
+            result, msg = self.sync_push(host, quiet, timeout)
+            latency = (time.perf_counter() - start) * 1000
+            return SyncResult(bool(result), str(msg), latency, self.transferred())
+
+        outcomes = {
+            host: outcome or self.timed_out(host, timeout)
+            for host, outcome in self.fan_out(hosts, push, timeout, self.failed).items()
+        }
+        self.local.quiet = quiet
+        ok = sum(outcome.result for outcome in outcomes.values())
+        self.announce(f"Pushed to {ok} of {len(hosts)} hosts")
+        return outcomes
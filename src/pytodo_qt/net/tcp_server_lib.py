@@ -4,35 +4,233 @@ This module implements a threaded tcp socket server and request handler for To-D
 """
 
 import json
+import os
+import socket
 import socketserver
+import struct
 import sys
+import threading
 import time
 
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
-from PyQt6.QtWidgets import QMessageBox
-
-from ..core import error_on_none_db, settings
+from ..core import error_on_none_db, metrics, settings, timed
 from ..core.Logger import Logger
-from ..crypto.AESCipher import AESCipher
+from ..crypto.AESCipher import CHUNKED, AESCipher
+from ..crypto.FileCipher import is_encrypted
+from ..crypto.PlainCipher import PlainCipher
+from ..net.Admission import Admission
+from ..net.Session import (
+    IDLE_TIMEOUT,
+    Session,
+    busy,
+    open_signed,
+    parse_pull_args,
+    pull_state,
+)
 from ..net.sync_operations import sync_operations
 
 
 logger = Logger(__name__)
 
 
+# the peer name of processes connected to the local socket
+LOCAL_PEER = ("local", 0)
+
+
 class DatabaseServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
     """Threaded tcp server."""
 
     allow_reuse_address = True
 
+    # open sessions must not keep the application from exiting
+    daemon_threads = True
+
+    def __init__(self, *args, **kwargs):
+        """Create a server with no open sessions."""
+        super().__init__(*args, **kwargs)
+        self.sessions = set()
+        self.sessions_lock = threading.Lock()
+        self.admission = Admission(
+            settings.options["rate_limit"],
+            settings.options["rate_burst"],
+            settings.options["max_connections"],
+            settings.options["max_transfers"],
+        )
+
+    def cipher(self):
+        """Return the cipher protecting requests to this server."""
+        return AESCipher(settings.options["key"])
+
+    def verify_request(self, request, client_address):
+        """Refuse a connection before a thread is started for it."""
+        if self.admission.connect(client_address[0]):
+            return True
+        self.refuse(request)
+        return False
+
+    def refuse(self, request):
+        """Tell a refused peer so, without waiting on it.
+
+        The refusal is answered like a one off request, so a peer asking
+        for a session does not take us for a server too old for one.
+        """
+        reply = self.cipher().encrypt(sync_operations["REJECT"].name)
+        try:
+            request.setblocking(False)
+            # reading what already arrived lets the close end cleanly
+            request.recv(4096)
+        except OSError:
+            pass
+        try:
+            request.send(reply)
+        except OSError:
+            pass
+
+    def process_request_thread(self, request, client_address):
+        """Handle a connection, then give its slot back."""
+        try:
+            super().process_request_thread(request, client_address)
+        finally:
+            self.admission.disconnect()
+
+    def add_session(self, session):
+        """Track a session so it can be closed with the server."""
+        with self.sessions_lock:
+            self.sessions.add(session)
+
+    def discard_session(self, session):
+        """Forget a session that has ended."""
+        with self.sessions_lock:
+            self.sessions.discard(session)
+
+    def close_sessions(self):
+        """Close every open session."""
+        with self.sessions_lock:
+            sessions, self.sessions = self.sessions, set()
+        for session in sessions:
+            session.close()
+
+
+class PooledDatabaseServer(DatabaseServer):
+    """Tcp server handling connections on a fixed pool of threads.
+
+    Threads are started once instead of per connection, admission control
+    already bounds the connections open at once, so none has to wait for
+    a free thread.
+    """
+
+    def __init__(self, *args, **kwargs):
+        """Create a server with a thread for every connection it admits."""
+        super().__init__(*args, **kwargs)
+        self.pool = ThreadPoolExecutor(
+            max_workers=max(settings.options["max_connections"], 1),
+            thread_name_prefix="server",
+        )
+        # connections submitted to the pool and not handled yet
+        self.queued = {}
+        self.queued_lock = threading.Lock()
+
+    def process_request(self, request, client_address):
+        """Handle a connection on a pooled thread."""
+        future = self.pool.submit(
+            self.process_request_thread, request, client_address
+        )
+        with self.queued_lock:
+            self.queued[future] = request
+        future.add_done_callback(self.dequeue)
+
+    def dequeue(self, future):
+        """Forget a connection the pool is done with."""
+        with self.queued_lock:
+            self.queued.pop(future, None)
+
+    def server_close(self):
+        """Close the server, drop waiting connections and stop its threads."""
+        super().server_close()
+        with self.queued_lock:
+            queued = list(self.queued.items())
+        for future, request in queued:
+            if future.cancel():
+                self.shutdown_request(request)
+        self.pool.shutdown(wait=False)
+
+
+class LocalDatabaseServer(DatabaseServer):
+    """Threaded server on a Unix domain socket, for processes on this machine.
+
+    Only the user running To-Do may connect: the socket is created with
+    owner only permissions and, where the system tells, the user of every
+    peer is checked. Requests are therefore neither encrypted nor signed.
+    """
+
+    address_family = socket.AF_UNIX
+
+    def __init__(self, path, *args, **kwargs):
+        """Create a server listening on the socket at path."""
+        self.inode = None
+        super().__init__(str(path), *args, **kwargs)
+        # every peer is the user running To-Do, only the caps apply
+        self.admission.rate = 0
+
+    def cipher(self):
+        """Return the cipher of the local socket, which encrypts nothing."""
+        return PlainCipher()
+
+    def server_bind(self):
+        """Bind the socket readable and writable by its owner only.
+
+        A socket left behind by a process that is gone is replaced, one
+        still being served by another To-Do raises OSError.
+        """
+        path = self.server_address
+        if os.path.exists(path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(path)
+            except OSError:
+                os.unlink(path)
+            else:
+                raise OSError(f"Another To-Do is serving {path}")
+            finally:
+                probe.close()
+
+        umask = os.umask(0o177)
+        try:
+            super().server_bind()
+        finally:
+            os.umask(umask)
+        self.inode = os.stat(path).st_ino
+
+    def server_close(self):
+        """Close the server and remove its socket, unless it was replaced."""
+        super().server_close()
+        try:
+            if os.stat(self.server_address).st_ino == self.inode:
+                os.unlink(self.server_address)
+        except OSError:
+            pass
+
+    def verify_request(self, request, client_address):
+        """Refuse peers run by another user, then apply admission control."""
+        if hasattr(socket, "SO_PEERCRED"):
+            ucred = struct.Struct("3i")
+            _, uid, _ = ucred.unpack(
+                request.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, ucred.size)
+            )
+            if uid != os.getuid():
+                self.admission.reject("auth", f"uid {uid}")
+                return False
+        return super().verify_request(request, (LOCAL_PEER[0],))
+
 
 class TCPRequestHandler(socketserver.StreamRequestHandler):
     """Socket server request handler."""
 
     def __init__(self, request, client_address, server):
         """Initialize request handler."""
-        self.aes_cipher = AESCipher(settings.options["key"])
+        self.aes_cipher = server.cipher()
         self.buf_size = 4096
         self.peer_name = None
         self.host = None
@@ -47,19 +245,55 @@ class TCPRequestHandler(socketserver.StreamRequestHandler):
     def process_request(self):
         """Process a request."""
         self.encrypted_data = self.request.recv(self.buf_size)
-        self.decrypted_data = self.aes_cipher.decrypt(self.encrypted_data)
-        self.command = self.decrypted_data.decode("utf-8")
+        if not self.encrypted_data:
+            return
+        # sessions are signed, the MAC is checked before anything is
+        # decrypted, older clients still send unsigned one off requests
+        signed = b"." in self.encrypted_data
+        if signed:
+            self.decrypted_data = open_signed(self.aes_cipher, self.encrypted_data)
+        else:
+            self.decrypted_data = self.aes_cipher.decrypt(self.encrypted_data)
+        if self.decrypted_data is None:
+            self.server.admission.reject("auth", self.peer_name)
+            if signed:
+                # answer in a frame the peer cannot authenticate, so a peer
+                # with another key does not take us for an older server
+                session = Session(
+                    self.request, self.peer_name, self.aes_cipher, client=False
+                )
+                session.send({"op": sync_operations["REJECT"].name})
+            return
+        try:
+            request = self.decrypted_data.decode("utf-8")
+        except UnicodeDecodeError:
+            self.server.admission.reject("auth", self.peer_name)
+            return
+        self.command, _, args = request.partition(" ")
+        if self.command == sync_operations["SESSION"].name and not signed:
+            self.server.admission.reject("auth", self.peer_name)
+            return
 
         if self.command == sync_operations["PULL_REQUEST"].name:
-            self.pull()
+            self.pull(args)
         elif self.command == sync_operations["PUSH_REQUEST"].name:
             self.push()
+        elif self.command == sync_operations["SESSION"].name:
+            self.session(args)
         else:
             pass
 
-    def pull(self):
-        """Pull to-do lists from remote host."""
+    @timed("server.pull")
+    def pull(self, args=""):
+        """Pull to-do lists from remote host.
+
+        A peer sending its version vector in args gets a replica state
+        delta, older peers get the whole lists. A peer that has already
+        seen everything, or that sends the content hash it got from its
+        last pull, is told NOT_MODIFIED and nothing else is sent.
+        """
         logger.log.info("received PULL_REQUEST from %s", self.peer_name)
+        metrics.incr("server.pull_requests")
         if not settings.options["pull"]:
             logger.log.info("PULL_REQUEST denied")
             self.encrypted_reply = self.aes_cipher.encrypt(
@@ -68,10 +302,55 @@ class TCPRequestHandler(socketserver.StreamRequestHandler):
             self.request.send(self.encrypted_reply)
             return
 
-        if Path.exists(settings.db_fn):
+        since = None
+        seen = None
+        if args:
+            try:
+                since, seen = parse_pull_args(json.loads(args))
+            except ValueError as e:
+                logger.log.warning("Ignoring invalid PULL_REQUEST arguments: %s", e)
+
+        with self.server.admission.transfer(self.peer_name) as admitted:
+            if admitted:
+                self.send_pull_reply(since, seen)
+            else:
+                msg = busy()["msg"]
+                logger.log.info("PULL_REQUEST denied: %s", msg)
+                self.encrypted_reply = self.aes_cipher.encrypt(
+                    sync_operations["REJECT"].name
+                )
+                self.request.send(self.encrypted_reply)
+
+    def send_pull_reply(self, since, seen):
+        """Send the delta, or whole lists, a pulling peer asked for."""
+        if settings.DB is not None and since is not None:
+            version, _, delta = pull_state(since, seen)
+            if delta is None:
+                self.data = None
+            else:
+                self.data = json.dumps({"crdt": delta, "version": version})
+            if self.data is None:
+                self.send_not_modified()
+            else:
+                self.send_data_reply()
+            return
+
+        # serve a pinned in-memory snapshot, edits made during the transfer
+        # go into newer versions and never block or tear this one
+        if settings.DB is not None:
+            with settings.DB.read_snapshot() as snapshot:
+                self.data = snapshot.serialize()
+                self.send_data_reply()
+            return
+
+        if Path.exists(settings.db_fn) and not is_encrypted(settings.db_fn):
             with settings.db_fn.open(mode="r", encoding="utf-8") as db_file:
                 self.data = db_file.read()
 
+        self.send_data_reply()
+
+    def send_data_reply(self):
+        """Accept the pull and send the data, or tell the peer there is none."""
         if self.data is not None:
             logger.log.info("PULL_REQUEST ACCEPTED")
             self.encrypted_reply = self.aes_cipher.encrypt(
@@ -86,6 +365,15 @@ class TCPRequestHandler(socketserver.StreamRequestHandler):
             )
             self.request.send(self.encrypted_reply)
 
+    def send_not_modified(self):
+        """Tell the peer it already has everything, in one small reply."""
+        logger.log.info("PULL_REQUEST NOT_MODIFIED")
+        metrics.incr("server.not_modified")
+        self.encrypted_reply = self.aes_cipher.encrypt(
+            sync_operations["NOT_MODIFIED"].name
+        )
+        self.request.sendall(self.encrypted_reply)
+
     def send_size_header(self):
         """Send the size of the to-do lists."""
         size = sys.getsizeof(self.data)
@@ -103,19 +391,22 @@ class TCPRequestHandler(socketserver.StreamRequestHandler):
             return False, e
         self.encrypted_data = self.aes_cipher.encrypt(serialized)
         self.request.sendall(self.encrypted_data)
+        metrics.incr("sync.bytes_sent", len(self.encrypted_data))
         return True
 
+    @timed("server.push")
     @error_on_none_db
     def push(self):
         """Push to-do lists to remote hosts."""
         logger.log.info("PUSH_REQUEST from %s", self.peer_name)
+        metrics.incr("server.push_requests")
         if not settings.options["push"]:
             msg = f"PUSH_REQUEST from {self.peer_name} denied"
             self.encrypted_reply = self.aes_cipher.encrypt(
                 sync_operations["REJECT"].name
             )
             self.request.send(self.encrypted_reply)
-            QMessageBox.warning(None, "Sync Push", msg)
+            settings.DB.notify.emit("Sync Push", msg)
             logger.log.warning(msg)
             return
 
@@ -127,7 +418,7 @@ class TCPRequestHandler(socketserver.StreamRequestHandler):
             self.host = (self.peer_name[0], settings.options["port"])
         else:
             msg = "Not performing push sync, no host peer"
-            QMessageBox.warning(None, "Push Sync", msg)
+            settings.DB.notify.emit("Push Sync", msg)
             logger.log.warning(msg)
             return
 
@@ -135,7 +426,45 @@ class TCPRequestHandler(socketserver.StreamRequestHandler):
             logger.log.info("Performing a sync pull")
             settings.DB.sync_pull(self.host)
 
+    @error_on_none_db
+    def session(self, args=""):
+        """Serve a persistent session until the peer leaves or goes quiet.
+
+        The reply to the handshake names the cipher mode both ends use
+        from then on, if the peer offered one this server knows.
+        """
+        logger.log.info("SESSION from %s", self.peer_name)
+        metrics.incr("server.sessions")
+        session = Session(
+            self.request,
+            self.peer_name,
+            self.aes_cipher,
+            client=False,
+            admission=self.server.admission,
+        )
+        self.request.settimeout(IDLE_TIMEOUT)
+        try:
+            hello = json.loads(args)
+            ciphers = hello.get("ciphers", []) if isinstance(hello, dict) else []
+        except ValueError:
+            ciphers = []
+        accept = {
+            "op": sync_operations["ACCEPT"].name,
+            "vv": settings.DB.replica.version_vector(),
+        }
+        if isinstance(ciphers, list) and CHUNKED in ciphers:
+            accept["cipher"] = CHUNKED
+        session.send(accept)
+        session.chunked = "cipher" in accept
+        self.server.add_session(session)
+        try:
+            session.serve()
+        finally:
+            self.server.discard_session(session)
+
+    @timed("server.handle")
     def handle(self):
         """Handle requests."""
-        self.peer_name = self.request.getpeername()
+        # processes on the local socket have no address
+        self.peer_name = self.request.getpeername() or LOCAL_PEER
         self.process_request()
@@ -0,0 +1,58 @@
+"""Shared fixtures.
+
+pytodo_qt keeps its files under ~/.pytodo-qt and reads the path when it
+is first imported, so HOME points at a scratch directory before any test
+module imports it.
+"""
+
+import os
+import shutil
+import tempfile
+
+os.environ["HOME"] = tempfile.mkdtemp(prefix="pytodo-qt-tests-")
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+import pytest  # noqa: E402
+
+from PyQt6.QtCore import QCoreApplication  # noqa: E402
+
+from pytodo_qt.core import settings  # noqa: E402
+
+
+def new_database():
+    """Return a TodoDatabase with its server and background syncs off."""
+    from pytodo_qt.core.TodoDatabase import TodoDatabase
+
+    settings.options.update(run=False, address="127.0.0.1", port=0, peers="")
+    db = TodoDatabase()
+    db.sync_scheduler.stop()
+    return db
+
+
+def close_database(db):
+    """Stop everything a TodoDatabase started."""
+    db.sync_scheduler.stop()
+    db.db_client.close_sessions()
+    if db.server_running():
+        db.stop_server()
+
+
+@pytest.fixture(scope="session")
+def qapp():
+    """The application, signals and timers need one."""
+    return QCoreApplication.instance() or QCoreApplication([])
+
+
+@pytest.fixture
+def db(qapp):
+    """A fresh database, installed as settings.DB, over empty files."""
+    for path in settings.app_dir.iterdir():
+        if path.is_dir():
+            shutil.rmtree(path)
+        elif path.name != "pytodo-qt.log":
+            path.unlink()
+    settings.options.clear()
+    settings.DB = new_database()
+    yield settings.DB
+    close_database(settings.DB)
+    settings.DB = None
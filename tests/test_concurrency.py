@@ -0,0 +1,99 @@
+"""Concurrent writers, readers and network pulls on one database."""
+
+import json
+import random
+import threading
+
+from pytodo_qt.core import json_helpers, settings
+
+WRITERS = 8
+PUSHES = 10
+PULLERS = 3
+PULLS = 3
+
+
+def test_concurrent_pushes_leave_no_corruption(db):
+    """Merges, file writes, server pulls and readers running at once."""
+    settings.options.update(pull=True, push=True)
+    db.start_server()
+    host = db.db_server.server_address
+    json_helpers.load_todo_lists(
+        {"base": [{"complete": False, "reminder": "x", "priority": 1}]}
+    )
+
+    errors = []
+    expected = {"base": 1}
+    stop = threading.Event()
+
+    def reader():
+        while not stop.is_set():
+            with db.lock.read_locked():
+                total = sum(len(todos) for todos in db.todo_lists.values())
+                if total != db.todo_total:
+                    errors.append(("total", total, db.todo_total))
+            snapshot = db.snapshot()
+            if snapshot.todo_total() != sum(len(t) for t in snapshot.lists.values()):
+                errors.append(("snapshot", snapshot.version))
+
+    def pusher(n):
+        rng = random.Random(n)
+        for j in range(PUSHES):
+            name = f"peer{n}-{j}"
+            todos = [
+                {"complete": False, "reminder": f"r{k}", "priority": 2}
+                for k in range(rng.randint(1, 50))
+            ]
+            expected[name] = len(todos)
+            result, msg = json_helpers.load_todo_lists({name: todos})
+            if not result:
+                errors.append(("merge", msg))
+            json_helpers.write_json_data()
+
+    def puller():
+        for _ in range(PULLS):
+            result, msg = db.sync_pull(host)
+            if not result:
+                errors.append(("pull", msg))
+
+    readers = [threading.Thread(target=reader) for _ in range(4)]
+    writers = [threading.Thread(target=pusher, args=(n,)) for n in range(WRITERS)]
+    writers += [threading.Thread(target=puller) for _ in range(PULLERS)]
+    for t in readers + writers:
+        t.start()
+    for t in writers:
+        t.join()
+    stop.set()
+    for t in readers:
+        t.join()
+
+    assert errors == []
+    assert {name: len(todos) for name, todos in db.todo_lists.items()} == expected
+
+    # the last write holds every list, whole
+    json_helpers.write_json_data()
+    with open(settings.db_fn, encoding="utf-8") as f:
+        on_disk = json.load(f)
+    assert on_disk == db.snapshot().to_dict()
+
+
+def test_worker_notifications_reach_the_gui_thread(db, qapp):
+    """notify emitted on a network thread is delivered on the main thread."""
+    from PyQt6.QtCore import QObject, Qt, pyqtSlot
+
+    class Receiver(QObject):
+        def __init__(self):
+            super().__init__()
+            self.threads = []
+
+        @pyqtSlot(str, str)
+        def show(self, title, msg):
+            self.threads.append(threading.get_ident())
+
+    receiver = Receiver()
+    db.notify.connect(receiver.show, Qt.ConnectionType.QueuedConnection)
+    worker = threading.Thread(target=db.notify.emit, args=("Sync", "done"))
+    worker.start()
+    worker.join()
+    qapp.processEvents()
+
+    assert receiver.threads == [threading.get_ident()]
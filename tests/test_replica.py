@@ -0,0 +1,134 @@
+"""Replicas converge whatever order edits and merges happen in."""
+
+import json
+import random
+
+import pytest
+
+from pytodo_qt.core.Replica import Replica
+from pytodo_qt.core.Transaction import TransactionError
+
+from conftest import close_database, new_database
+
+SEEDS = range(25)
+
+
+def sync(dst, src):
+    """Merge what dst is missing from src, the way a peer sends it."""
+    delta = json.loads(json.dumps(src.replica.delta(dst.replica.version_vector())))
+    with dst.transaction(persist=False, origin="peer") as txn:
+        txn.merge_replica(delta)
+
+
+def state(db):
+    """Return the lists of a database, comparable across peers."""
+    return {
+        name: [(t["id"], t["reminder"], t["priority"], t["complete"]) for t in todos]
+        for name, todos in db.todo_lists.items()
+    }
+
+
+def random_edit(db, rng):
+    """Make one random local edit, some of them invalid."""
+    lists = list(db.todo_lists)
+    k = rng.random()
+    try:
+        with db.transaction(persist=False) as txn:
+            if not lists or k < 0.05:
+                txn.add_list(f"L{rng.randint(0, 6)}")
+            elif k < 0.08:
+                txn.delete_list(rng.choice(lists))
+            elif k < 0.10:
+                txn.rename_list(rng.choice(lists), f"L{rng.randint(0, 6)}")
+            else:
+                name = rng.choice(lists)
+                todos = db.todo_lists[name]
+                k = rng.random()
+                if not todos or k < 0.35:
+                    index = None
+                    if todos and rng.random() < 0.5:
+                        index = rng.randint(0, len(todos))
+                    todo = {
+                        "complete": False,
+                        "reminder": f"r{rng.randint(0, 999)}",
+                        "priority": rng.randint(1, 3),
+                    }
+                    txn.add_todo(name, todo, index=index)
+                elif k < 0.5:
+                    txn.delete_todo(name, rng.choice(todos)["id"])
+                elif k < 0.8:
+                    fields = rng.choice(
+                        [
+                            {"complete": True},
+                            {"priority": rng.randint(1, 3)},
+                            {"reminder": f"e{rng.randint(0, 99)}"},
+                        ]
+                    )
+                    txn.update_todo(name, rng.choice(todos)["id"], **fields)
+                else:
+                    index = 0 if rng.random() < 0.5 else None
+                    txn.move_todo(
+                        name, rng.choice(todos)["id"], rng.choice(lists), index=index
+                    )
+    except TransactionError:
+        pass
+
+
+@pytest.fixture
+def peers(db):
+    """Up to five databases, the first one is settings.DB."""
+    extra = [new_database() for _ in range(4)]
+    yield [db] + extra
+    for peer in extra:
+        close_database(peer)
+
+
+@pytest.mark.parametrize("seed", SEEDS)
+def test_peers_converge(peers, seed):
+    """Random edits and partial syncs, then gossip, leave equal peers."""
+    rng = random.Random(seed)
+    peers = peers[: rng.randint(2, 5)]
+    for _ in range(rng.randint(50, 300)):
+        if rng.random() < 0.7:
+            random_edit(rng.choice(peers), rng)
+        else:
+            sync(*rng.sample(peers, 2))
+
+    for _ in range(3):
+        for a in peers:
+            for b in peers:
+                if a is not b:
+                    sync(a, b)
+
+    states = [state(peer) for peer in peers]
+    assert all(s == states[0] for s in states)
+
+
+@pytest.mark.parametrize("seed", SEEDS[:5])
+def test_replica_matches_lists(peers, seed, tmp_path):
+    """The replica view equals the lists and survives a save and load."""
+    rng = random.Random(seed)
+    peers = peers[:3]
+    for _ in range(200):
+        if rng.random() < 0.7:
+            random_edit(rng.choice(peers), rng)
+        else:
+            sync(*rng.sample(peers, 2))
+
+    for n, peer in enumerate(peers):
+        replica = peer.replica
+        for name, todos in peer.todo_lists.items():
+            ids = sorted(
+                replica.members.get(name, ()),
+                key=lambda i: replica.position(i, replica.items[i]),
+            )
+            assert ids == [t["id"] for t in todos]
+            assert [replica.materialize(i, replica.items[i]) for i in ids] == todos
+
+        path = tmp_path / f"replica-{n}.json"
+        path.write_text(replica.serialize())
+        loaded = Replica(peer)
+        loaded.load(path)
+        assert loaded.delta() == json.loads(json.dumps(replica.delta()))
+        assert loaded.vv == replica.vv
+        assert loaded.clock == replica.clock
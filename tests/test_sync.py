@@ -0,0 +1,55 @@
+"""Syncing to-do lists with hosts over the network."""
+
+from concurrent.futures import ThreadPoolExecutor
+
+from pytodo_qt.core import json_helpers, settings
+from pytodo_qt.net import tcp_server_lib
+
+
+def test_pull_without_sessions_sends_bare_request(db, monkeypatch):
+    """Hosts without sessions get the request older servers understand."""
+    settings.options.update(pull=True, push=True)
+    db.start_server()
+    json_helpers.load_todo_lists(
+        {"home": [{"complete": False, "reminder": "x", "priority": 1}]}
+    )
+
+    received = []
+    pull = tcp_server_lib.TCPRequestHandler.pull
+
+    def recording_pull(self, args=""):
+        received.append(args)
+        return pull(self, args)
+
+    monkeypatch.setattr(tcp_server_lib.TCPRequestHandler, "pull", recording_pull)
+    monkeypatch.setattr(db.db_client, "session", lambda host, timeout=0: None)
+
+    # off the GUI thread, like background syncs, so no progress dialog
+    with ThreadPoolExecutor(1) as pool:
+        future = pool.submit(
+            db.db_client.sync_pull, db.db_server.server_address, True, 5
+        )
+        result, msg = future.result()
+
+    assert result, msg
+    assert received == [""]
+
+
+def test_pooled_server_serves_and_closes(db):
+    """A pull from the pooled server succeeds and the server shuts down."""
+    settings.options.update(pull=True, push=True, max_connections=2)
+    db.start_server(tcp_server_lib.PooledDatabaseServer)
+    json_helpers.load_todo_lists(
+        {"home": [{"complete": False, "reminder": "x", "priority": 1}]}
+    )
+
+    with ThreadPoolExecutor(1) as pool:
+        future = pool.submit(
+            db.db_client.sync_pull, db.db_server.server_address, True, 5
+        )
+        result, msg = future.result()
+    assert result, msg
+
+    db.db_client.close_sessions()
+    db.stop_server()
+    assert not db.server_running()
@@ -0,0 +1,179 @@
+"""Chunked pulls survive connections cut in the middle of a transfer."""
+
+import os
+import random
+import socket
+import subprocess
+import sys
+import threading
+
+import pytest
+
+from pytodo_qt.core import settings
+from pytodo_qt.crypto.FileCipher import FileCipher, is_encrypted
+from pytodo_qt.net import Transfer, tcp_client_lib
+from pytodo_qt.net.Transfer import Download
+
+# to-dos the server holds, enough for a transfer of several chunks
+SIZE = 30000
+
+
+class FaultyProxy:
+    """Forward connections to a server, cutting the first few replies short."""
+
+    def __init__(self, target, faults, seed=0):
+        self.target = target
+        self.faults = faults
+        self.rng = random.Random(seed)
+        self.connections = 0
+        self.listener = socket.create_server(("127.0.0.1", 0))
+        self.address = self.listener.getsockname()
+        threading.Thread(target=self.accept, daemon=True).start()
+
+    def accept(self):
+        """Pipe every connection both ways, with a byte limit on replies."""
+        while True:
+            try:
+                client, _ = self.listener.accept()
+            except OSError:
+                return
+            self.connections += 1
+            server = socket.create_connection(self.target)
+            limit = None
+            if self.connections <= self.faults:
+                limit = self.rng.randint(100_000, 400_000)
+            for args in ((client, server, None), (server, client, limit)):
+                threading.Thread(target=self.pipe, args=args, daemon=True).start()
+
+    @staticmethod
+    def pipe(src, dst, limit):
+        """Copy src to dst, dropping both once limit bytes went through."""
+        sent = 0
+        try:
+            while True:
+                data = src.recv(65536)
+                if not data:
+                    break
+                if limit is not None and sent + len(data) > limit:
+                    dst.sendall(data[: limit - sent])
+                    break
+                sent += len(data)
+                dst.sendall(data)
+        except OSError:
+            pass
+        for s in (src, dst):
+            try:
+                s.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            s.close()
+
+    def close(self):
+        """Stop accepting connections."""
+        self.listener.close()
+
+
+@pytest.fixture
+def server(db, tmp_path):
+    """Address of a load_test server holding SIZE to-dos."""
+    package = os.path.dirname(os.path.dirname(settings.__file__))
+    env = dict(os.environ, HOME=str(tmp_path), PYTHONPATH=os.path.dirname(package))
+    command = [
+        sys.executable,
+        "-m",
+        "pytodo_qt.net.load_test",
+        "serve",
+        "--size",
+        str(SIZE),
+        "--key",
+        settings.options["key"],
+        "--quiet",
+    ]
+    proc = subprocess.Popen(
+        command,
+        env=env,
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        text=True,
+    )
+    try:
+        ready = proc.stdout.readline().split()
+        assert ready and ready[0] == "ready", "load_test server did not start"
+        yield ("127.0.0.1", int(ready[1]))
+    finally:
+        proc.stdin.close()
+        proc.wait(timeout=30)
+
+
+def todo_total(db):
+    """Return the number of to-dos in all lists of db."""
+    return sum(len(todos) for todos in db.todo_lists.values())
+
+
+def test_pull_resumes_after_cut_connections(db, server):
+    """A pull cut short twice finishes over new sessions."""
+    proxy = FaultyProxy(server, faults=2)
+    try:
+        result, msg = db.db_client.sync_pull(proxy.address, quiet=True, timeout=5)
+    finally:
+        proxy.close()
+
+    assert result, msg
+    assert proxy.connections > 1
+    assert todo_total(db) == SIZE
+    assert Download.pending(str(proxy.address)) is None
+
+
+def test_unfinished_pull_continues_next_sync(db, server, monkeypatch):
+    """Chunks from a failed pull are kept and the next pull completes it."""
+    monkeypatch.setattr(tcp_client_lib, "RESUME_ATTEMPTS", 1)
+    proxy = FaultyProxy(server, faults=1)
+    try:
+        result, _ = db.db_client.sync_pull(proxy.address, quiet=True, timeout=5)
+        assert not result
+        assert Download.pending(str(proxy.address)) is not None
+        db.db_client.close_sessions()
+
+        result, msg = db.db_client.sync_pull(proxy.address, quiet=True, timeout=5)
+    finally:
+        proxy.close()
+
+    assert result, msg
+    assert todo_total(db) == SIZE
+
+
+def test_spooled_chunks_are_encrypted(db, server, monkeypatch):
+    """An encrypted database spools its chunks encrypted too."""
+    monkeypatch.setattr(tcp_client_lib, "RESUME_ATTEMPTS", 1)
+    settings.options["encrypt"] = True
+    db.file_cipher = FileCipher("spool passphrase")
+    proxy = FaultyProxy(server, faults=1)
+    try:
+        result, _ = db.db_client.sync_pull(proxy.address, quiet=True, timeout=5)
+        assert not result
+        parts = list(Transfer.spool_dir.glob("*/*.part"))
+        assert parts
+        assert all(is_encrypted(part) for part in parts)
+        db.db_client.close_sessions()
+
+        result, msg = db.db_client.sync_pull(proxy.address, quiet=True, timeout=5)
+    finally:
+        proxy.close()
+
+    assert result, msg
+    assert todo_total(db) == SIZE
+
+
+def test_locked_database_spools_nothing(db, server, monkeypatch):
+    """Without the passphrase of an encrypted database nothing is spooled."""
+    monkeypatch.setattr(tcp_client_lib, "RESUME_ATTEMPTS", 1)
+    settings.options["encrypt"] = True
+    proxy = FaultyProxy(server, faults=1)
+    try:
+        result, _ = db.db_client.sync_pull(proxy.address, quiet=True, timeout=5)
+    finally:
+        proxy.close()
+
+    assert not result
+    assert not list(Transfer.spool_dir.glob("*/*.part"))
+    assert Download.pending(str(proxy.address)) is None